@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class AccountsConfig(AppConfig):
     name = 'accounts'
+
+    def ready(self):
+        # invalidation of the cached permissions (accounts/backends.py)
+        from . import signals  # noqa: F401
@@ -0,0 +1,111 @@
+import time
+
+from allauth.account.auth_backends import AuthenticationBackend
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.db import transaction
+
+"""
+Cross-request permission cache
+
+ModelBackend remembers a user's permissions on the user object, which lives
+for a single request. So every request that checks a permission
+(PermissionRequiredMixin on BookDetailView, the per-user key of the site
+cache, ...) runs two queries: the user's own permissions and the
+permissions of their groups.
+
+CachedPermissionsMixin keeps both sets in the shared cache instead, so a
+warm permission check costs no database query at all. The entries are
+dropped (accounts/signals.py)
+- for one user, when their user_permissions or groups change or the user
+  is saved (is_active and is_superuser matter too),
+- for everybody, by bumping PERMISSIONS_VERSION_KEY, when a Permission or
+  a Group is edited or deleted or a group's permissions change, since we
+  can't cheaply tell which users that touches.
+Both happen right away and once more when the transaction commits.
+
+Both backends in AUTHENTICATION_BACKENDS use it: ModelBackend and allauth's
+AuthenticationBackend (which is a ModelBackend) share the same entries.
+"""
+
+PERMISSIONS_VERSION_KEY = 'accounts:permissions-version'
+PERMISSION_SOURCES = ('user', 'group')
+
+
+def permissions_version():
+    version = cache.get(PERMISSIONS_VERSION_KEY)
+    if version is None:
+        cache.add(PERMISSIONS_VERSION_KEY, time.time_ns() // 1000, None)
+        version = cache.get(PERMISSIONS_VERSION_KEY)
+    return version
+
+
+def _after_commit(function, *args):
+    """
+    Run function now, and again once the surrounding transaction commits:
+    a request that comes in before the commit reads the old permissions and
+    would cache them for PERMISSION_CACHE_SECONDS (see bump_catalog_version()
+    in books/cache.py). The admin saves everything in a transaction.
+    """
+    function(*args)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: function(*args))
+
+
+def _bump():
+    previous = cache.get(PERMISSIONS_VERSION_KEY) or 0
+    cache.set(PERMISSIONS_VERSION_KEY, max(time.time_ns() // 1000, previous + 1), None)
+
+
+def bump_permissions_version():
+    _after_commit(_bump)
+
+
+def _permission_cache_key(version, user_pk, from_name):
+    return 'accounts:perms:%s:%s:%s' % (version, user_pk, from_name)
+
+
+def _forget(user_pk):
+    version = permissions_version()
+    cache.delete_many([_permission_cache_key(version, user_pk, name) for name in PERMISSION_SOURCES])
+
+
+def forget_user_permissions(user_pk):
+    _after_commit(_forget, user_pk)
+
+
+class CachedPermissionsMixin:
+
+    def _get_permissions(self, user_obj, obj, from_name):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        perm_cache_name = '_%s_perm_cache' % from_name
+        if not hasattr(user_obj, perm_cache_name):
+            self._load_cached_permissions(user_obj)
+        if not hasattr(user_obj, perm_cache_name):
+            # cache miss: ModelBackend queries and sets the attribute
+            perms = super()._get_permissions(user_obj, obj, from_name)
+            cache.set(
+                _permission_cache_key(user_obj._perm_cache_version, user_obj.pk, from_name),
+                perms, settings.PERMISSION_CACHE_SECONDS)
+        return getattr(user_obj, perm_cache_name)
+
+    def _load_cached_permissions(self, user_obj):
+        """ one round trip for both sets, they are nearly always needed together """
+        if not hasattr(user_obj, '_perm_cache_version'):
+            user_obj._perm_cache_version = permissions_version()
+        keys = {
+            _permission_cache_key(user_obj._perm_cache_version, user_obj.pk, name): name
+            for name in PERMISSION_SOURCES
+        }
+        for key, perms in cache.get_many(list(keys)).items():
+            setattr(user_obj, '_%s_perm_cache' % keys[key], perms)
+
+
+class CachedModelBackend(CachedPermissionsMixin, ModelBackend):
+    pass
+
+
+class CachedAuthenticationBackend(CachedPermissionsMixin, AuthenticationBackend):
+    pass
@@ -0,0 +1,65 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from accounts.sessions import write_behind
+
+"""
+Database round trips per request: default session engine against accounts.sessions
+
+$ docker-compose exec web python manage.py bench_sessions --requests 500
+$ docker-compose exec web python manage.py bench_sessions --activity-resolution 300 / /books/
+
+A temporary user logs in and browses the given paths with each engine; the
+queries are counted per request, the ones on django_session separately.
+The write-behind flush at the end is included (spread over the requests).
+--activity-resolution 0 (the default) records activity on every request,
+the worst case for the database engine. Everything is rolled back at the end.
+"""
+
+ENGINES = (
+    ('db (django default)', 'django.contrib.sessions.backends.db'),
+    ('accounts.sessions', 'accounts.sessions'),
+)
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Count database queries per request for each session engine.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', default=['/', '/books/'])
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--activity-resolution', type=int, default=0)
+
+    def handle(self, *args, **options):
+        for name, engine in ENGINES:
+            with override_settings(
+                    SESSION_ENGINE=engine,
+                    SESSION_ACTIVITY_RESOLUTION=options['activity_resolution']):
+                total, session = self.run(options['paths'], options['requests'])
+            self.stdout.write('%-20s %6.2f queries/request, %6.2f on django_session' % (
+                name, total / options['requests'], session / options['requests']))
+
+    def run(self, paths, requests):
+        total = session = 0
+        try:
+            with transaction.atomic():
+                user = get_user_model().objects.create_user(
+                    username='bench-sessions', email='bench-sessions@example.com')
+                client = Client(SERVER_NAME='localhost')
+                client.force_login(user)
+                with CaptureQueriesContext(connection) as queries:
+                    for number in range(requests):
+                        client.get(paths[number % len(paths)], secure=True)
+                    write_behind.flush()
+                total = len(queries)
+                session = sum('django_session' in query['sql'] for query in queries)
+                raise Rollback
+        except Rollback:
+            pass
+        return total, session
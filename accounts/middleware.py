@@ -0,0 +1,26 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.utils.deprecation import MiddlewareMixin
+from .sessions import ACTIVITY_KEY
+
+"""
+Last activity of logged in users
+
+Records when a logged in user was last seen and rolls the session expiry
+forward, at most once every SESSION_ACTIVITY_RESOLUTION seconds. With
+SESSION_ENGINE = 'accounts.sessions' such a save only touches the cache;
+the database gets it later, coalesced with other sessions (write-behind).
+"""
+
+
+class SessionActivityMiddleware(MiddlewareMixin):
+
+    def process_request(self, request):
+        session = request.session
+        if session.session_key is None or not session.get(SESSION_KEY):
+            return
+        now = int(time.time())
+        if now - session.get(ACTIVITY_KEY, 0) >= settings.SESSION_ACTIVITY_RESOLUTION:
+            session[ACTIVITY_KEY] = now
@@ -0,0 +1,179 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.contrib.sessions.models import Session
+from django.db import DatabaseError, connections
+from django.db.models import Case, DateTimeField, F, Value, When
+from django.utils import timezone
+
+"""
+Sessions: cache first, database behind
+
+With the default engine every request of a logged in user reads its row
+from django_session, and a changed session (or a rolling expiry) writes it
+back. SESSION_ENGINE = 'accounts.sessions' keeps sessions in the shared
+cache and uses the database only as the durable copy:
+
+- reads come from the cache, the database is only read after a cache miss
+  (that part is Django's cached_db engine),
+- real changes (logging in or out, data a view stores) are written through
+  to the database straight away, so nothing important can be lost,
+- saves that only record activity (SessionActivityMiddleware bumps
+  ACTIVITY_KEY, which also rolls the expiry forward) update the cache right
+  away but reach the database write-behind: only the new expire_date is
+  queued per process, coalesced per session (only the latest value of a
+  session is kept) and written with one UPDATE per
+  SESSION_WRITE_BEHIND_BATCH sessions at most every
+  SESSION_WRITE_BEHIND_SECONDS, and at exit. A request that queues
+  flushes when that is due; an idle worker has a timer thread that does
+  it, or its queue could wait past the grace period of clear_expired().
+  A database error is logged and the queue kept for the next flush: the
+  activity is not worth failing a request for. The queue is local to the
+  process, so it never writes session_data: that would put the copy it
+  was based on over a real change another process wrote through
+  meanwhile. And it only ever moves an expiry forward. A crash loses at
+  most that many seconds of expiry extension; the cache has the current
+  value (and the activity timestamp) anyway.
+- clear_expired() (manage.py clearsessions) deletes in batches instead of one
+  huge DELETE, and leaves a grace period so a session whose newer expiry is
+  still waiting in a queue is not purged.
+
+$ python manage.py bench_sessions  # database round trips per request
+"""
+
+ACTIVITY_KEY = '_last_activity'
+
+logger = logging.getLogger(__name__)
+
+
+def _fingerprint(data):
+    """ hash of the session data, ignoring the activity timestamp """
+    data = {key: value for key, value in data.items() if key != ACTIVITY_KEY}
+    return hashlib.md5(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class WriteBehindQueue:
+    """ Pending expire_date per session key, flushed in bulk. """
+
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+        self.timer_pid = None
+
+    def put(self, session_key, expire_date):
+        with self.lock:
+            if self.timer_pid != os.getpid():
+                self._start_timer()
+            self.pending[session_key] = expire_date
+            due = (len(self.pending) >= settings.SESSION_WRITE_BEHIND_BATCH
+                   or time.monotonic() - self.last_flush >= settings.SESSION_WRITE_BEHIND_SECONDS)
+        if due:
+            self.flush()
+
+    def _start_timer(self):
+        # one per process: a thread of the parent doesn't survive a fork
+        self.timer_pid = os.getpid()
+        threading.Thread(target=self._timer, name='session-write-behind', daemon=True).start()
+
+    def _timer(self):
+        while True:
+            time.sleep(settings.SESSION_WRITE_BEHIND_SECONDS / 2)
+            with self.lock:
+                due = self.pending and (
+                    time.monotonic() - self.last_flush >= settings.SESSION_WRITE_BEHIND_SECONDS)
+            if due:
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception('Session expiry write-behind failed.')
+                finally:
+                    connections.close_all()  # this thread's connections only
+
+    def discard(self, session_key):
+        with self.lock:
+            self.pending.pop(session_key, None)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.monotonic()
+        if not pending:
+            return 0
+        items = list(pending.items())
+        batch_size = settings.SESSION_WRITE_BEHIND_BATCH
+        try:
+            for offset in range(0, len(items), batch_size):
+                batch = items[offset:offset + batch_size]
+                # never moves an expiry back, e.g. below one written through since
+                Session.objects.filter(session_key__in=[key for key, expire_date in batch]).update(
+                    expire_date=Case(
+                        *[When(session_key=key, expire_date__lt=expire_date, then=Value(expire_date))
+                          for key, expire_date in batch],
+                        default=F('expire_date'), output_field=DateTimeField()))
+        except DatabaseError:
+            logger.exception('Session expiry write-behind failed, %d sessions kept for the next flush.',
+                             len(pending))
+            # unless a newer value arrived meanwhile
+            with self.lock:
+                for key, value in pending.items():
+                    self.pending.setdefault(key, value)
+            return 0
+        return len(items)
+
+
+write_behind = WriteBehindQueue()
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        write_behind.flush()
+    except Exception:
+        pass
+
+
+class SessionStore(CachedDBStore):
+    cache_key_prefix = 'accounts.sessions'
+
+    def load(self):
+        data = super().load()
+        self._loaded_fingerprint = _fingerprint(data)
+        return data
+
+    def save(self, must_create=False):
+        if (must_create or self.session_key is None
+                or getattr(self, '_loaded_fingerprint', None) is None
+                or _fingerprint(self._get_session()) != self._loaded_fingerprint):
+            # new session or real changes: write through
+            write_behind.discard(self.session_key)
+            super().save(must_create)
+            self._loaded_fingerprint = _fingerprint(self._session)
+            return
+        self._cache.set(self.cache_key, self._session, self.get_expiry_age())
+        write_behind.put(self.session_key, self.get_expiry_date())
+
+    def delete(self, session_key=None):
+        write_behind.discard(session_key or self.session_key)
+        super().delete(session_key)
+
+    @classmethod
+    def clear_expired(cls, batch_size=None):
+        batch_size = batch_size or settings.SESSION_PURGE_BATCH_SIZE
+        cutoff = timezone.now() - timedelta(seconds=2 * settings.SESSION_WRITE_BEHIND_SECONDS)
+        expired = Session.objects.filter(expire_date__lt=cutoff)
+        deleted = 0
+        while True:
+            # the expire_date index finds a batch, each DELETE is a short transaction
+            keys = list(expired.values_list('session_key', flat=True)[:batch_size])
+            if not keys:
+                return deleted
+            deleted += Session.objects.filter(session_key__in=keys).delete()[0]
@@ -0,0 +1,48 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from .backends import bump_permissions_version, forget_user_permissions
+
+"""
+Invalidation of the permission cache, see accounts/backends.py
+"""
+
+User = get_user_model()
+
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+def user_permissions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        # user.user_permissions.add(...) / user.groups.remove(...)
+        forget_user_permissions(instance.pk)
+    elif pk_set:
+        # permission.user_set.add(users) / group.user_set.remove(users)
+        for user_pk in pk_set:
+            forget_user_permissions(user_pk)
+    else:
+        # group.user_set.clear(): the users are already gone from the table
+        bump_permissions_version()
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def group_permissions_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_permissions_version()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    forget_user_permissions(instance.pk)
+
+
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def permission_or_group_changed(sender, **kwargs):
+    bump_permissions_version()
@@ -7,9 +7,22 @@ application or a user flow like payment that covers multiple screens
 
 To write unit tests in Django we use TestCase which is, itself, an extension of Python's TestCase.
 """
+import threading
+from datetime import timedelta
+from unittest import mock
+
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.contrib.auth.models import Group, Permission
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.db import DatabaseError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse, resolve
+from django.utils import timezone
+from books.models import Book
+from .backends import _permission_cache_key, permissions_version
+from .sessions import ACTIVITY_KEY, SessionStore, WriteBehindQueue, write_behind
 """
 We have imported both get_user_model and TestCase before creating a
 CustomUserTests class. Within it are two separate tests. 
@@ -100,3 +113,160 @@ class SignupTests(TestCase):
                          [0].username, self.username)
         self.assertEqual(get_user_model().objects.all()
                          [0].email, self.email)
+
+
+class PermissionCacheTests(TestCase):
+    """
+    Permissions are cached across requests (accounts/backends.py) and the
+    cache is dropped by the signals in accounts/signals.py.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            username='reader', email='reader@email.com', password='testpass123')
+        self.permission = Permission.objects.get(codename='special_status')
+        self.book = Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+
+    def fresh_user(self):
+        # a new object, like on the next request
+        return get_user_model().objects.get(pk=self.user.pk)
+
+    def test_warm_permission_check_costs_no_queries(self):
+        self.user.user_permissions.add(self.permission)
+        self.assertTrue(self.fresh_user().has_perm('books.special_status'))
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm('books.special_status'))
+
+    def test_detail_view_checks_permissions_from_cache(self):
+        self.user.user_permissions.add(self.permission)
+        self.client.login(email='reader@email.com', password='testpass123')
+        url = reverse('book_detail', args=[self.book.pk])
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertFalse([query for query in queries if 'auth_permission' in query['sql']])
+
+    def test_user_permission_changes_invalidate(self):
+        self.assertFalse(self.fresh_user().has_perm('books.special_status'))
+        self.user.user_permissions.add(self.permission)
+        self.assertTrue(self.fresh_user().has_perm('books.special_status'))
+        self.permission.user_set.remove(self.user)
+        self.assertFalse(self.fresh_user().has_perm('books.special_status'))
+
+    def test_group_changes_invalidate(self):
+        group = Group.objects.create(name='readers')
+        self.user.groups.add(group)
+        self.assertFalse(self.fresh_user().has_perm('books.special_status'))
+        group.permissions.add(self.permission)
+        self.assertTrue(self.fresh_user().has_perm('books.special_status'))
+        group.user_set.clear()
+        self.assertFalse(self.fresh_user().has_perm('books.special_status'))
+
+
+
+class PermissionCacheCommitTests(TransactionTestCase):
+    """ on_commit callbacks only run outside TestCase's transaction """
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            username='reader', email='reader@email.com', password='testpass123')
+        self.permission = Permission.objects.get(codename='special_status')
+        self.user.user_permissions.add(self.permission)
+
+    def test_revocation_survives_a_request_before_the_commit(self):
+        with transaction.atomic():
+            self.user.user_permissions.remove(self.permission)
+            # another request, before the commit, still reads the old
+            # permissions and caches them
+            cache.set(_permission_cache_key(permissions_version(), self.user.pk, 'user'),
+                      {'books.special_status'}, None)
+            cache.set(_permission_cache_key(permissions_version(), self.user.pk, 'group'), set(), None)
+        user = get_user_model().objects.get(pk=self.user.pk)
+        self.assertFalse(user.has_perm('books.special_status'))
+
+
+class SessionStoreTests(TestCase):
+    """ accounts/sessions.py: cache first, activity written behind """
+
+    def setUp(self):
+        cache.clear()
+        write_behind.pending.clear()  # left over by other tests' requests
+        session = SessionStore()
+        session['cart'] = 'book-1'
+        session.save()
+        self.session_key = session.session_key
+
+    def test_activity_is_written_behind(self):
+        Session.objects.update(expire_date=timezone.now() + timedelta(minutes=1))
+        session = SessionStore(self.session_key)
+        self.assertEqual(session['cart'], 'book-1')
+        session[ACTIVITY_KEY] = 12345
+        with self.assertNumQueries(0):
+            session.save()
+        # the cache already has it
+        self.assertEqual(SessionStore(self.session_key)[ACTIVITY_KEY], 12345)
+        with self.assertNumQueries(1):
+            self.assertEqual(write_behind.flush(), 1)
+        row = Session.objects.get(session_key=self.session_key)
+        self.assertGreater(row.expire_date, timezone.now() + timedelta(days=1))
+
+    def test_write_behind_never_undoes_another_process_write_through(self):
+        queue_a, queue_b = WriteBehindQueue(), WriteBehindQueue()
+        session_a = SessionStore(self.session_key)
+        session_a[ACTIVITY_KEY] = 12345
+        with mock.patch('accounts.sessions.write_behind', queue_a):
+            session_a.save()
+        cache.clear()
+        session_b = SessionStore(self.session_key)
+        session_b['cart'] = 'book-2'
+        with mock.patch('accounts.sessions.write_behind', queue_b):
+            session_b.save()
+        self.assertEqual(queue_a.flush(), 1)
+        row = Session.objects.get(session_key=self.session_key)
+        self.assertEqual(row.get_decoded()['cart'], 'book-2')
+
+    # the activity is not worth a 500, it is written with the next flush
+    def test_database_errors_keep_the_queue(self):
+        queue = WriteBehindQueue()
+        queue.put(self.session_key, timezone.now() + timedelta(days=1))
+        with mock.patch.object(Session.objects, 'filter', side_effect=DatabaseError('gone')), \
+                self.assertLogs('accounts.sessions', 'ERROR'):
+            self.assertEqual(queue.flush(), 0)
+        self.assertIn(self.session_key, queue.pending)
+        self.assertEqual(queue.flush(), 1)
+
+    # an idle worker must not keep expiry extensions past clearsessions' grace period
+    def test_idle_queue_is_flushed_by_its_timer(self):
+        queue = WriteBehindQueue()
+        flushed = threading.Event()
+        with override_settings(SESSION_WRITE_BEHIND_SECONDS=0.05), \
+                mock.patch.object(queue, 'flush', side_effect=lambda: flushed.set()):
+            queue.put(self.session_key, timezone.now() + timedelta(days=1))
+            self.assertTrue(flushed.wait(5))
+        queue.pending.clear()
+
+    def test_real_changes_are_written_through(self):
+        session = SessionStore(self.session_key)
+        session['cart'] = 'book-2'
+        session.save()
+        row = Session.objects.get(session_key=self.session_key)
+        self.assertEqual(row.get_decoded()['cart'], 'book-2')
+
+    def test_clear_expired_in_batches(self):
+        expired = timezone.now() - timedelta(days=1)
+        Session.objects.bulk_create([
+            Session(session_key='expired%03d' % number, session_data='', expire_date=expired)
+            for number in range(7)
+        ])
+        self.assertEqual(SessionStore.clear_expired(batch_size=3), 7)
+        self.assertEqual(Session.objects.count(), 1)
+
+    def test_activity_middleware(self):
+        get_user_model().objects.create_user(
+            username='reader', email='reader@email.com', password='testpass123')
+        self.client.login(email='reader@email.com', password='testpass123')
+        self.client.get(reverse('home'))
+        self.assertIn(ACTIVITY_KEY, self.client.session)
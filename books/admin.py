@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Book, Review
+from .models import Author, Book, Review
 # we can access Models Data via admin panel by simple configuration
 # we can login to admin and add a book entry to our database
 """
@@ -16,7 +16,17 @@ class BookAdmin(admin.ModelAdmin):
     inlines = [
         ReviewInline,
     ]
-    list_display = ("title", "author", "price",)
+    list_display = ("title", "author", "price", "review_count", "rating_avg",)
 
 admin.site.register(Book, BookAdmin)
 
+
+
+class AuthorAdmin(admin.ModelAdmin):
+    list_display = ("name", "sort_name",)
+    search_fields = ("sort_name",)
+    # follows the name (Author.save()), renaming to the name of another
+    # author merges the two
+    readonly_fields = ("sort_name",)
+
+admin.site.register(Author, AuthorAdmin)
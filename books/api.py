@@ -0,0 +1,215 @@
+import hashlib
+import uuid
+
+from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
+from django.http import Http404, JsonResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, urlencode
+from django.views.generic import View
+from .cache import catalog_version
+from .models import Book, Review
+from .pagination import KeysetPaginator
+from .search import search_books
+
+"""
+Read-only JSON API
+
+The mobile client and partners used to scrape the HTML pages. These views
+return the same data as JSON, and are built to be cheap:
+- rows are read with .values(): plain dicts straight from the database
+  cursor, no model instances, no template rendering,
+- ?fields=title,price selects only the columns the client asks for
+  (sparse fieldsets), so less is read and less is sent,
+- every response has an ETag and Last-Modified. A client that sends them back
+  (If-None-Match/If-Modified-Since) gets a 304 without a body. The list and
+  search ETags are made from the catalog version (books/cache.py) and the
+  query string, so a 304 is answered without any database query at all; the
+  detail ETag and Last-Modified use the version and updated_at of the
+  book, which change with the book and with its reviews.
+
+GET /books/api/?sort=price&fields=title,price&cursor=...
+GET /books/api/<uuid>?fields=title
+GET /books/api/search/?q=potter&page=2
+
+Access is the same as for the HTML pages (login for the list, the
+special_status permission for the detail), but answered with a JSON 403
+instead of a redirect to the login page.
+"""
+
+BOOK_FIELDS = ('id', 'title', 'author', 'price', 'cover', 'review_count', 'rating_avg', 'url')
+# 'url' is built from the id, the other fields are columns
+BOOK_COLUMNS = {
+    'id': 'id', 'title': 'title', 'author': 'author', 'price': 'price', 'cover': 'cover',
+    'review_count': 'review_count', 'rating_avg': 'rating_avg',
+}
+
+_URL_PLACEHOLDER = uuid.UUID(int=0)
+
+
+class ApiError(Exception):
+    pass
+
+
+class ApiAccessMixin:
+    """ put in front of LoginRequiredMixin/PermissionRequiredMixin: 403 JSON, no login redirect """
+
+    def handle_no_permission(self):
+        return JsonResponse({'error': 'Authentication and permission required.'}, status=403)
+
+
+class ApiView(View):
+    per_page = 20
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except ApiError as error:
+            return JsonResponse({'error': str(error)}, status=400)
+        except Http404 as error:
+            return JsonResponse({'error': str(error) or 'Not found.'}, status=404)
+
+    def get_fields(self):
+        raw = self.request.GET.get('fields')
+        if not raw:
+            return BOOK_FIELDS
+        fields = tuple(dict.fromkeys(field.strip() for field in raw.split(',') if field.strip()))
+        unknown = set(fields) - set(BOOK_FIELDS)
+        if unknown:
+            raise ApiError('Unknown fields: %s. Choose from %s.' % (
+                ', '.join(sorted(unknown)), ', '.join(BOOK_FIELDS)))
+        return fields
+
+    def get_columns(self, fields, *extra):
+        """ the columns to read for fields; id is always read (url, cursors) """
+        columns = {'id'}
+        columns.update(BOOK_COLUMNS[field] for field in fields if field in BOOK_COLUMNS)
+        columns.update(extra)
+        return sorted(columns)
+
+    def serializer(self, fields):
+        """ a function turning a .values() row into the dict we send """
+        url_template = reverse('api_book_detail', args=[_URL_PLACEHOLDER]).replace(
+            str(_URL_PLACEHOLDER), '%s')
+        storage = Book._meta.get_field('cover').storage
+
+        def serialize(row):
+            book = {}
+            for field in fields:
+                if field == 'url':
+                    book['url'] = url_template % row['id']
+                elif field == 'cover':
+                    book['cover'] = storage.url(row['cover']) if row['cover'] else None
+                else:
+                    book[field] = row[field]
+            return book
+        return serialize
+
+    def page_url(self, **params):
+        query = self.request.GET.copy()
+        for name, value in params.items():
+            query[name] = value
+        return '%s?%s' % (self.request.path, urlencode(sorted(query.items())))
+
+    def conditional(self, etag_parts, last_modified, build):
+        """
+        Answer with 304 (or 412) when the client's copy is current, otherwise
+        call build() for the data. Either way the validators are attached.
+        """
+        digest = hashlib.md5('|'.join(map(str, etag_parts)).encode()).hexdigest()
+        etag = '"%s"' % digest
+        response = get_conditional_response(self.request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = JsonResponse(build())
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        # the data depends on who is asking; revalidate on every use
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+class BookListApiView(ApiAccessMixin, LoginRequiredMixin, ApiView):
+    orderings = {
+        'title': ('title', 'id'),
+        'author': ('author', 'id'),
+        'price': ('price', 'id'),
+        'rating': ('-rating_avg', '-rating_count', 'id'),
+        'reviews': ('-review_count', 'id'),
+    }
+
+    def get(self, request, *args, **kwargs):
+        fields = self.get_fields()
+        sort = request.GET.get('sort', 'title')
+        if sort not in self.orderings:
+            raise ApiError('Unknown sort %r.' % sort)
+        version = catalog_version()
+
+        def build():
+            keys = self.orderings[sort]
+            rows = Book.objects.values(*self.get_columns(fields, *(key.lstrip('-') for key in keys)))
+            page = KeysetPaginator(rows, keys, self.per_page, name=sort).page(request.GET.get('cursor'))
+            serialize = self.serializer(fields)
+            return {
+                'results': [serialize(row) for row in page],
+                'next': self.page_url(cursor=page.next_cursor) if page.has_next() else None,
+                'previous': self.page_url(cursor=page.previous_cursor) if page.has_previous() else None,
+            }
+        return self.conditional(
+            ('list', version, request.GET.urlencode()), version // 10 ** 6, build)
+
+
+class BookDetailApiView(ApiAccessMixin, LoginRequiredMixin, PermissionRequiredMixin, ApiView):
+    """ A book and a page of its reviews (?cursor= for the next ones). """
+    permission_required = 'books.special_status'
+
+    def get(self, request, pk, *args, **kwargs):
+        fields = self.get_fields()
+        row = Book.objects.filter(pk=pk).values(*self.get_columns(fields, 'version', 'updated_at')).first()
+        if row is None:
+            raise Http404('No book found matching the query.')
+
+        def build():
+            book = self.serializer(fields)(row)
+            reviews = Review.objects.filter(book_id=pk).values('id', 'review', 'rating', 'author__username')
+            page = KeysetPaginator(reviews, ('id',), self.per_page, name='reviews').page(
+                request.GET.get('cursor'))
+            book['reviews'] = [
+                {'id': review['id'], 'author': review['author__username'], 'review': review['review'],
+                 'rating': review['rating']}
+                for review in page
+            ]
+            book['reviews_next'] = self.page_url(cursor=page.next_cursor) if page.has_next() else None
+            return book
+        # the book's own time: it moves with the book and its reviews, like the version
+        return self.conditional(
+            ('detail', pk, row['version'], request.GET.urlencode()), int(row['updated_at'].timestamp()), build)
+
+
+class SearchApiView(ApiView):
+    """
+    Relevance ordered, so paged with ?page= like the HTML search. One extra
+    row is fetched to know whether there is a next page (no COUNT query).
+    """
+
+    def get(self, request, *args, **kwargs):
+        fields = self.get_fields()
+        query = request.GET.get('q', '').strip()
+        try:
+            number = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            raise ApiError('page must be a number.')
+        version = catalog_version()
+
+        def build():
+            offset = (number - 1) * self.per_page
+            rows = list(search_books(query).values(*self.get_columns(fields))[
+                offset:offset + self.per_page + 1])
+            serialize = self.serializer(fields)
+            return {
+                'query': query,
+                'results': [serialize(row) for row in rows[:self.per_page]],
+                'next': self.page_url(page=number + 1) if len(rows) > self.per_page else None,
+                'previous': self.page_url(page=number - 1) if number > 1 else None,
+            }
+        return self.conditional(
+            ('search', version, request.GET.urlencode()), version // 10 ** 6, build)
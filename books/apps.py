@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class BooksConfig(AppConfig):
     name = 'books'
+
+    def ready(self):
+        # importing the module connects the @receiver handlers
+        from . import signals  # noqa: F401
@@ -0,0 +1,173 @@
+import heapq
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.db import transaction
+from .models import Book
+
+"""
+Typeahead / autocomplete
+
+Every keystroke in the search box asks for "books starting with what I typed
+so far". Answering that with a database query per keystroke is wasteful, so
+each worker keeps an in-process prefix index of the normalized titles and
+authors and answers from memory.
+
+The index is a sorted list of (term, book id) pairs. All terms starting with
+a prefix sit next to each other in a sorted list, so a lookup is one binary
+search (bisect) followed by reading the next few entries: O(log n + k).
+A sorted list is far smaller in memory than a character trie with one Python
+object per node, which matters with a million books.
+
+Every word boundary of a title or author is indexed, so "pot" finds
+"Harry Potter" and "row" finds "JK Rowling".
+
+The matches are ranked before they are cut to the limit: a title equal to
+what was typed first, then matches in the title before matches in the
+author only, then the most reviewed books. That needs every match, so up
+to AUTOCOMPLETE_CANDIDATES of them are read; only one or two letter
+prefixes have more, and those are ranked among the first candidates.
+
+The index is built lazily on the first request a worker serves and then kept
+up to date from the post_save/post_delete signals of Book (books/signals.py),
+once the change is committed: a rolled back save must not leave a book in
+the index whose link is a 404. Signals only reach the worker that made the
+change, so the index is also rebuilt when it gets older than
+AUTOCOMPLETE_MAX_AGE seconds (which also refreshes the review counts).
+"""
+
+
+def normalize(text):
+    """ lowercase, strip accents and turn punctuation into single spaces """
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    return ' '.join(''.join(c if c.isalnum() else ' ' for c in text).split())
+
+
+def terms_for(*texts):
+    terms = set()
+    for text in texts:
+        words = normalize(text).split(' ')
+        for start in range(len(words)):
+            term = ' '.join(words[start:])
+            if term:
+                terms.add(term)
+    return terms
+
+
+class PrefixIndex:
+
+    def __init__(self):
+        self._entries = []  # sorted (term, book id)
+        self._books = {}  # book id -> (title, author, title terms, author terms, popularity)
+        self._lock = threading.Lock()
+        self.built_at = time.monotonic()
+
+    def __len__(self):
+        return len(self._books)
+
+    def _book(self, title, author, popularity):
+        title_terms = terms_for(title)
+        return title, author, title_terms, terms_for(author) - title_terms, popularity
+
+    def add(self, book_id, title, author, popularity=0):
+        book_id = str(book_id)
+        book = self._book(title, author, popularity)
+        with self._lock:
+            self._discard(book_id)
+            for term in book[2] | book[3]:
+                insort(self._entries, (term, book_id))
+            self._books[book_id] = book
+
+    def remove(self, book_id):
+        with self._lock:
+            self._discard(str(book_id))
+
+    def _discard(self, book_id):
+        book = self._books.pop(book_id, None)
+        if book is None:
+            return
+        for term in book[2] | book[3]:
+            position = bisect_left(self._entries, (term, book_id))
+            if position < len(self._entries) and self._entries[position] == (term, book_id):
+                del self._entries[position]
+
+    def bulk_load(self, rows):
+        """ rows is an iterable of (book id, title, author, popularity), sorted once at the end """
+        entries = []
+        for book_id, title, author, popularity in rows:
+            book_id = str(book_id)
+            book = self._books[book_id] = self._book(title, author, popularity)
+            entries.extend((term, book_id) for term in book[2] | book[3])
+        entries.sort()
+        self._entries = entries
+
+    def search(self, prefix, limit=10):
+        """ Return the best limit (book id, title, author) whose terms start with prefix. """
+        prefix = normalize(prefix)
+        if not prefix or limit <= 0:
+            return []
+        candidates = settings.AUTOCOMPLETE_CANDIDATES
+        ranked = []
+        with self._lock:
+            entries = self._entries
+            position = bisect_left(entries, (prefix,))
+            seen = set()
+            while position < len(entries) and len(seen) < candidates:
+                term, book_id = entries[position]
+                if not term.startswith(prefix):
+                    break
+                if book_id not in seen:
+                    seen.add(book_id)
+                    title, author, title_terms, author_terms, popularity = self._books[book_id]
+                    in_title = any(term.startswith(prefix) for term in title_terms)
+                    score = (normalize(title) != prefix, not in_title, -popularity, title, book_id)
+                    ranked.append((score, book_id, title, author))
+                position += 1
+        return [(book_id, title, author) for score, book_id, title, author in heapq.nsmallest(limit, ranked)]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """ The index of this worker, built on first use. """
+    global _index
+    index = _index
+    max_age = getattr(settings, 'AUTOCOMPLETE_MAX_AGE', 300)
+    if index is not None and time.monotonic() - index.built_at < max_age:
+        return index
+    with _index_lock:
+        if _index is None or time.monotonic() - _index.built_at >= max_age:
+            index = PrefixIndex()
+            index.bulk_load(
+                Book.objects.values_list('id', 'title', 'author', 'review_count').iterator(chunk_size=5000))
+            _index = index
+    return _index
+
+
+def _on_commit(update):
+    def apply():
+        if _index is not None:
+            update(_index)
+    transaction.on_commit(apply)
+
+
+def book_saved(book):
+    book_id, title, author, popularity = book.pk, book.title, book.author, book.review_count
+    _on_commit(lambda index: index.add(book_id, title, author, popularity))
+
+
+def book_deleted(book):
+    book_id = book.pk
+    _on_commit(lambda index: index.remove(book_id))
+
+
+def reset_index():
+    global _index
+    with _index_lock:
+        _index = None
@@ -0,0 +1,184 @@
+import json
+import platform
+import statistics
+import subprocess
+import threading
+import time
+
+import django
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.db import connections, router
+from django.test import Client
+from django.urls import reverse
+from . import seeding
+from .models import Book, Review
+
+"""
+Benchmark runner behind manage.py benchmark
+
+Each scenario is a session kind and a list of requests (method, path, data)
+sent round robin by --concurrency threads with their own django.test.Client,
+so the whole stack runs in process: middleware (site cache, sessions,
+profiling), views, templates and the database, but no web server or
+network. That makes the numbers reproducible enough to compare two releases
+on the same machine and data (seed the database with manage.py seed_catalog
+first).
+
+    home         the home page, anonymous
+    book_list    /books/ in every ?sort= order, logged in
+    book_detail  detail pages of the first books, with special_status
+    search       /books/search/ for the words of the synthetic titles
+    login        posting the allauth login form (mostly password hashing), a
+                 new session every time since allauth redirects logged in users
+
+The session kinds are 'user' (logged in as benchmark_user()), 'anonymous'
+and 'new' (cookies dropped before every request).
+
+Per scenario the result has the throughput (requests/s over all threads)
+and the p50/p95/p99/max latency in milliseconds. Responses with a status
+of 400 or more count as errors and are left out of the latencies.
+
+compare() checks a result against a baseline: a scenario regressed when its
+p95 grew, or its throughput shrank, by more than the threshold.
+"""
+
+USER_EMAIL = 'benchmark@example.com'
+USER_PASSWORD = 'benchmark-password'
+
+
+def percentile(timings, fraction):
+    """ nearest rank on sorted timings """
+    return timings[round(fraction * (len(timings) - 1))]
+
+
+def benchmark_user():
+    """ the logged in user of the scenarios, allowed to see the detail pages """
+    User = get_user_model()
+    user = User.objects.filter(email=USER_EMAIL).first()
+    if user is None:
+        user = User.objects.create_user(username='benchmark', email=USER_EMAIL, password=USER_PASSWORD)
+        user.user_permissions.add(Permission.objects.get(codename='special_status'))
+    return user
+
+
+def scenarios(seed):
+    book_ids = list(Book.objects.order_by('pk').values_list('pk', flat=True)[:50])
+    login = [{'login': USER_EMAIL, 'password': USER_PASSWORD}]
+    seeded = get_user_model().objects.filter(email=seeding.email(seed, 0)).exists()
+    if seeded:
+        login = [{'login': seeding.email(seed, n), 'password': seeding.PASSWORD} for n in range(10)]
+    return {
+        'home': ('anonymous', [('get', reverse('home'), None)]),
+        'book_list': ('user', [
+            ('get', reverse('book_list') + query, None)
+            for query in ('', '?sort=title', '?sort=author', '?sort=price')]),
+        'book_detail': ('user', [
+            ('get', reverse('book_detail', args=[pk]), None) for pk in book_ids]),
+        'search': ('anonymous', [
+            ('get', reverse('search_results') + '?q=' + word, None) for word in seeding.WORDS[:20]]),
+        'login': ('new', [('post', reverse('account_login'), data) for data in login]),
+    }
+
+
+def run_scenario(session, requests, count, concurrency=1, warmup=10):
+    user = benchmark_user() if session == 'user' else None
+    timings, errors = [], []
+    lock = threading.Lock()
+    counter = iter(range(count))
+
+    def worker(in_thread):
+        client = Client(SERVER_NAME='localhost')
+        if user is not None:
+            client.force_login(user)
+        for number in range(warmup):
+            method, path, data = requests[number % len(requests)]
+            if session == 'new':
+                client.cookies.clear()
+            getattr(client, method)(path, data, secure=True)
+        local_timings, local_errors = [], 0
+        while True:
+            with lock:
+                number = next(counter, None)
+            if number is None:
+                break
+            method, path, data = requests[number % len(requests)]
+            if session == 'new':
+                client.cookies.clear()
+            start = time.perf_counter()
+            response = getattr(client, method)(path, data, secure=True)
+            elapsed = (time.perf_counter() - start) * 1000
+            if response.status_code >= 400:
+                local_errors += 1
+            else:
+                local_timings.append(elapsed)
+        with lock:
+            timings.extend(local_timings)
+            errors.append(local_errors)
+        if in_thread:
+            connections.close_all()  # the connections of this thread
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        worker(False)
+    else:
+        threads = [threading.Thread(target=worker, args=(True,)) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - start
+
+    timings.sort()
+    if not timings:
+        timings = [0.0]
+    return {
+        'requests': count,
+        'errors': sum(errors),
+        'throughput': round(count / elapsed, 2) if elapsed else 0.0,
+        'p50': round(statistics.median(timings), 3),
+        'p95': round(percentile(timings, 0.95), 3),
+        'p99': round(percentile(timings, 0.99), 3),
+        'max': round(timings[-1], 3),
+    }
+
+
+def _revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=5,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def environment():
+    return {
+        'revision': _revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connections[router.db_for_read(Book)].vendor,
+        'books': Book.objects.count(),
+        'reviews': Review.objects.count(),
+        'users': get_user_model().objects.count(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """ [(scenario, metric, baseline value, new value)] that got worse than the threshold allows """
+    regressions = []
+    for name, new in results['scenarios'].items():
+        old = baseline.get('scenarios', {}).get(name)
+        if old is None:
+            continue
+        if new['p95'] > old['p95'] * (1 + threshold):
+            regressions.append((name, 'p95', old['p95'], new['p95']))
+        if new['throughput'] < old['throughput'] * (1 - threshold):
+            regressions.append((name, 'throughput', old['throughput'], new['throughput']))
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,101 @@
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from config.metrics import record_cache
+
+"""
+Catalog version
+
+Everything we cache about the catalog (whole pages, facet counts, ...) puts
+the current catalog version into its cache key. When a Book or a Review
+changes, books/signals.py bumps the version: from then on every request
+builds new keys, misses and renders fresh content, and the old entries are
+never read again and simply expire (or get evicted by memcached's LRU).
+That is much simpler and safer than trying to find and delete every key that
+might contain a given book.
+
+The version is a timestamp in microseconds, so it can double as the
+Last-Modified time of the catalog. It lives in the shared cache, so every
+worker and every node sees the same value. If the key is ever evicted a new
+(later) timestamp is used, which only means everything is re-rendered once.
+"""
+
+CATALOG_VERSION_KEY = 'books:catalog-version'
+
+
+def catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # add() so we don't overwrite a version another worker just bumped
+        cache.add(CATALOG_VERSION_KEY, time.time_ns() // 1000, None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def _bump():
+    previous = cache.get(CATALOG_VERSION_KEY) or 0
+    cache.set(CATALOG_VERSION_KEY, max(time.time_ns() // 1000, previous + 1), None)
+
+
+def bump_catalog_version():
+    """
+    Bump now, and again once the surrounding transaction commits: otherwise a
+    request could re-render the not yet committed (old) data under the new
+    version and keep serving it until the next change.
+    """
+    _bump()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(_bump)
+
+
+"""
+Fragment cache statistics
+
+{% bookcache %} (books/templatetags/book_cache.py) reports every hit and miss
+here. Counting in the shared cache on every fragment would add a round trip
+per fragment, so each worker counts in memory and adds its counts to the
+shared counters every FRAGMENT_STATS_FLUSH_EVERY events. The counts are
+shared by the threads of the process (gthread workers, the ASGI executor),
+so they are only touched under _fragment_lock, like config/metrics.Registry.
+$ python manage.py fragment_cache_stats
+"""
+
+FRAGMENT_STATS_KEYS = {True: 'books:fragment-hits', False: 'books:fragment-misses'}
+FRAGMENT_STATS_FLUSH_EVERY = 100
+_fragment_counts = {True: 0, False: 0}
+_fragment_lock = threading.Lock()
+
+
+def record_fragment(hit, count=1):
+    record_cache('fragment', hit, count)
+    with _fragment_lock:
+        _fragment_counts[hit] += count
+        due = _fragment_counts[True] + _fragment_counts[False] >= FRAGMENT_STATS_FLUSH_EVERY
+    if due:
+        flush_fragment_stats()
+
+
+def flush_fragment_stats():
+    with _fragment_lock:
+        counts = dict(_fragment_counts)
+        _fragment_counts[True] = _fragment_counts[False] = 0
+    for hit, key in FRAGMENT_STATS_KEYS.items():
+        count = counts[hit]
+        if count:
+            cache.add(key, 0, None)
+            try:
+                cache.incr(key, count)
+            except ValueError:  # evicted between add() and incr()
+                cache.set(key, count, None)
+
+
+def fragment_stats():
+    """ Shared hit/miss counters (plus what this process hasn't flushed yet). """
+    with _fragment_lock:
+        counts = dict(_fragment_counts)
+    hits = (cache.get(FRAGMENT_STATS_KEYS[True]) or 0) + counts[True]
+    misses = (cache.get(FRAGMENT_STATS_KEYS[False]) or 0) + counts[False]
+    total = hits + misses
+    return {'hits': hits, 'misses': misses, 'hit_ratio': hits / total if total else 0.0}
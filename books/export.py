@@ -0,0 +1,130 @@
+import csv
+import json
+import uuid
+from decimal import Decimal
+
+from .models import Book, Review
+
+"""
+Streaming catalog export
+
+Used by BookExportView (/books/export/<dataset>.<format>, staff only) and by
+manage.py export_books. Rows are read with .values_list().iterator(), which
+on PostgreSQL uses a server-side cursor: rows arrive chunk_size at a time
+instead of the whole table being loaded into memory first. Every row is
+turned into text and handed on straight away, so memory stays flat and the
+first bytes go out immediately however big the catalog is.
+
+Rows are not ordered on purpose: ORDER BY over millions of rows would make
+the database sort everything before sending the first row.
+"""
+
+DATASETS = {
+    'books': (
+        lambda: Book.objects.all(),
+        ('id', 'title', 'author', 'price', 'cover'),
+    ),
+    'reviews': (
+        lambda: Review.objects.all(),
+        ('id', 'book_id', 'book__title', 'author__email', 'review', 'rating'),
+    ),
+}
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def header(dataset):
+    return DATASETS[dataset][1]
+
+
+def iter_rows(dataset, chunk_size=DEFAULT_CHUNK_SIZE):
+    queryset, fields = DATASETS[dataset]
+    return queryset().order_by().values_list(*fields).iterator(chunk_size=chunk_size)
+
+
+def plain(value):
+    if isinstance(value, (uuid.UUID, Decimal)):
+        return str(value)
+    return value
+
+
+class _Echo:
+    """ csv.writer wants a file, this one just hands back what is written. """
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(dataset, chunk_size=DEFAULT_CHUNK_SIZE):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(header(dataset))
+    for row in iter_rows(dataset, chunk_size):
+        yield writer.writerow(row)
+
+
+def iter_jsonl(dataset, chunk_size=DEFAULT_CHUNK_SIZE):
+    fields = header(dataset)
+    for row in iter_rows(dataset, chunk_size):
+        yield json.dumps(dict(zip(fields, map(plain, row)))) + '\n'
+
+
+def iter_export(dataset, file_format, chunk_size=DEFAULT_CHUNK_SIZE):
+    if file_format == 'csv':
+        return iter_csv(dataset, chunk_size)
+    return iter_jsonl(dataset, chunk_size)
+
+
+def _model_field(model, path):
+    field = None
+    for name in path.split('__'):
+        field = model._meta.get_field(name)
+        model = field.related_model
+    return field.target_field if field.is_relation else field
+
+
+def _arrow_type(pyarrow, field):
+    """ explicit types, so every row group of the file has the same schema """
+    internal_type = field.get_internal_type()
+    if internal_type == 'DecimalField':
+        return pyarrow.decimal128(field.max_digits, field.decimal_places)
+    if internal_type in ('AutoField', 'BigAutoField', 'IntegerField', 'BigIntegerField',
+                         'PositiveIntegerField', 'PositiveSmallIntegerField', 'SmallIntegerField'):
+        return pyarrow.int64()
+    return pyarrow.string()
+
+
+def write_parquet(dataset, path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Parquet needs pyarrow, an optional dependency ($ pipenv install pyarrow).
+    A row group is written for every chunk, so memory stays bounded here too.
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    queryset, fields = DATASETS[dataset]
+    model = queryset().model
+    schema = pyarrow.schema([
+        (name, _arrow_type(pyarrow, _model_field(model, name))) for name in fields])
+
+    def write(writer, chunk):
+        columns = zip(*chunk)
+        writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=schema.field(name).type) for name, column in zip(fields, columns)],
+            schema=schema))
+
+    count = 0
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        chunk = []
+        for row in iter_rows(dataset, chunk_size):
+            chunk.append([str(value) if isinstance(value, uuid.UUID) else value for value in row])
+            if len(chunk) >= chunk_size:
+                write(writer, chunk)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            write(writer, chunk)
+            count += len(chunk)
+    return count
@@ -0,0 +1,142 @@
+import heapq
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from .cache import catalog_version
+from .models import PRICE_BANDS, Author, Book, price_band_q
+
+"""
+Faceted filtering of the book list
+
+?author= (the id of an Author) and ?price= (a slug of PRICE_BANDS, books/models.py)
+narrow the book list down. Next to the list, every author and price band is
+shown with the number of books the user would get by picking it, given the
+other filter:
+
+    Price                        Author
+    Under $10 (1,204)            JK Rowling (12)
+    $10 to $25 (3,310)           JRR Tolkien (9)
+    ...                          ...
+
+All those numbers come from one grouped query, one row per author with a
+count per price band:
+
+    SELECT written_by_id, COUNT(*) FILTER (WHERE price < 10), COUNT(*) FILTER (...), ...
+    FROM books_book GROUP BY written_by_id
+
+It groups by the integer key of the author rather than the name string, so
+the index on (written_by, price, id) that covers the query is much smaller
+and PostgreSQL answers it with an index only scan. The names of the top
+authors are then fetched by primary key in one more query. It still reads
+the whole catalog, so the result, boiled down to what the page shows (the
+band totals and the top authors per band), is cached under the catalog
+version like everything else about the catalog (books/cache.py).
+
+The price facet of a selected author is that author's row. It is fetched
+on its own (the same query with WHERE written_by_id = ..., a short range of
+the same index) and cached the same way: keeping a row for every author in
+the cached entry would make it too big for memcached with a large catalog.
+"""
+
+TOP_AUTHORS = 20
+BANDS = {slug: (label, low, high) for slug, label, low, high in PRICE_BANDS}
+SLUGS = [slug for slug, label, low, high in PRICE_BANDS]
+
+
+def band_filter(slug):
+    label, low, high = BANDS[slug]
+    return price_band_q(low, high)
+
+
+def _grouped(queryset):
+    """ one row per author: the author, its number of books and one count per band """
+    annotations = {'total': Count('id')}
+    for number, (slug, label, low, high) in enumerate(PRICE_BANDS):
+        annotations[slug] = Count('id', filter=price_band_q(low, high))
+    return queryset.order_by().values('written_by').annotate(**annotations)
+
+
+def compute_counts():
+    """
+    {'bands': {slug: books},
+     'authors': {slug, or '' for all: [(author id, name, books)]}}
+    """
+    rows = list(_grouped(Book.objects.all()))
+    bands = {slug: sum(row[slug] for row in rows) for slug in SLUGS}
+    # books saved before their author was resolved (migration 0014) have none
+    rows = [row for row in rows if row['written_by'] is not None]
+    top = {}
+    for slug in [''] + SLUGS:
+        column = slug or 'total'
+        top[slug] = [(row['written_by'], row[column]) for row in heapq.nlargest(
+            TOP_AUTHORS, rows, key=lambda row: (row[column], -row['written_by'])) if row[column]]
+    names = dict(Author.objects.filter(
+        pk__in={pk for counts in top.values() for pk, count in counts}).values_list('pk', 'name'))
+    authors = {slug: [(pk, names[pk], count) for pk, count in counts] for slug, counts in top.items()}
+    return {'bands': bands, 'authors': authors}
+
+
+def compute_author_counts(author_id):
+    """ {slug: books} of one author, plus 'total' """
+    # not .first(), its ORDER BY id would end up in the GROUP BY
+    rows = list(_grouped(Book.objects.filter(written_by=author_id)))
+    return {slug: rows[0][slug] if rows else 0 for slug in SLUGS + ['total']}
+
+
+def _cached(key, compute):
+    key = 'books:facets:%s:%s' % (catalog_version(), key)
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, settings.FACET_CACHE_SECONDS)
+    return value
+
+
+def get_counts():
+    return _cached('counts', compute_counts)
+
+
+def get_author_counts(author_id):
+    return _cached('author:%d' % author_id, lambda: compute_author_counts(author_id))
+
+
+def _url(params, **changes):
+    params = dict(params, **changes)
+    # a new filter starts from the first page
+    params.pop('cursor', None)
+    return '?' + urlencode(sorted((name, value) for name, value in params.items() if value))
+
+
+def facets(params, author=None, band=None):
+    """
+    The facet lists for the template, each item a dict with label, count,
+    selected and the url that toggles it. params are the current query
+    parameters (sort, author, price), author the selected Author.
+    """
+    counts = get_counts()
+    per_band = counts['bands'] if author is None else get_author_counts(author.pk)
+    price_items = [{
+        'label': BANDS[slug][0], 'count': per_band[slug], 'selected': slug == band,
+        'url': _url(params, price=None if slug == band else slug),
+    } for slug in SLUGS]
+
+    top = counts['authors'][band or '']
+    selected = author.pk if author is not None else None
+    if author is not None and selected not in [pk for pk, name, count in top]:
+        # the selected author stays visible even when it isn't a top one
+        top = top + [(selected, author.name, per_band[band or 'total'])]
+    author_items = [{
+        'label': name, 'count': count, 'selected': pk == selected,
+        'url': _url(params, author=None if pk == selected else pk),
+    } for pk, name, count in top]
+    return {'price': price_items, 'author': author_items}
+
+
+def filter_books(queryset, author=None, band=None):
+    if author is not None:
+        queryset = queryset.filter(written_by=author)
+    if band is not None:
+        queryset = queryset.filter(band_filter(band))
+    return queryset
@@ -0,0 +1,113 @@
+import os
+import re
+from io import BytesIO
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from PIL import Image
+
+"""
+Cover image derivatives
+
+The templates used to show the original upload (often a 1-2 MB photo) even
+where it is displayed 200px wide. For every cover we now generate resized
+copies in a few widths, as WebP and as JPEG, and store them next to the
+original:
+
+    covers/hpcover.jpg
+    covers/hpcover.w160.webp  covers/hpcover.w160.jpg
+    covers/hpcover.w320.webp  covers/hpcover.w320.jpg
+    covers/hpcover.w640.webp  covers/hpcover.w640.jpg
+
+The templates offer them to the browser with <picture>/srcset (see the
+{% cover_picture %} tag in templatetags/book_covers.py), so each client
+downloads the smallest file good enough for its screen, and WebP where it is
+supported.
+
+Derivatives are generated when a cover is saved (books/signals.py) and, for
+covers uploaded before this existed, lazily the first time they are rendered.
+To build them all up front:
+$ docker-compose exec web python manage.py build_cover_derivatives
+Unlike the uploads, a derivative can change under the same name (--force
+rebuilds them), so config/media.py doesn't serve them as immutable.
+"""
+
+COVER_WIDTHS = (160, 320, 640)
+# extension, Pillow format, save options
+COVER_FORMATS = (
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+WIDTHS_CACHE_TIMEOUT = 60 * 60 * 24
+# what reading a cover raises for a missing, unreadable or truncated file,
+# and for one so big that Pillow refuses to decode it (DecompressionBombError
+# is neither an OSError nor a ValueError)
+IMAGE_ERRORS = (OSError, ValueError, Image.DecompressionBombError)
+
+
+DERIVATIVE_RE = re.compile(r'\.w\d+\.(%s)$' % '|'.join(extension for extension, _, _ in COVER_FORMATS))
+
+
+def derivative_name(name, width, extension):
+    root, _ = os.path.splitext(name)
+    return '%s.w%d.%s' % (root, width, extension)
+
+
+def is_derivative(name):
+    return DERIVATIVE_RE.search(name) is not None
+
+
+def _widths_cache_key(name):
+    return 'books:cover-widths:%s' % name
+
+
+def ensure_derivatives(field_file, force=False):
+    """
+    Make sure every derivative of field_file exists and return the list of
+    widths available. Covers are never scaled up: a cover narrower than a
+    width only gets the widths it can fill, plus its own width.
+    """
+    if not field_file:
+        return []
+    key = _widths_cache_key(field_file.name)
+    if not force:
+        widths = cache.get(key)
+        if widths is not None:
+            return widths
+
+    storage = field_file.storage
+    with storage.open(field_file.name, 'rb') as original:
+        image = Image.open(original)
+        image.load()
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    widths = [width for width in COVER_WIDTHS if width <= image.width] or [image.width]
+    if image.width < COVER_WIDTHS[-1] and image.width not in widths:
+        widths.append(image.width)
+
+    for width in widths:
+        resized = None
+        for extension, image_format, options in COVER_FORMATS:
+            name = derivative_name(field_file.name, width, extension)
+            if storage.exists(name):
+                if not force:
+                    continue
+                storage.delete(name)
+            if resized is None:
+                height = max(1, round(image.height * width / image.width))
+                resized = image.resize((width, height), Image.LANCZOS)
+            buffer = BytesIO()
+            resized.save(buffer, image_format, **options)
+            storage.save(name, ContentFile(buffer.getvalue()))
+
+    cache.set(key, widths, WIDTHS_CACHE_TIMEOUT)
+    return widths
+
+
+def srcset(field_file, widths, extension):
+    storage = field_file.storage
+    return ', '.join(
+        '%s %dw' % (storage.url(derivative_name(field_file.name, width, extension)), width)
+        for width in widths
+    )
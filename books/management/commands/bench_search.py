@@ -0,0 +1,61 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections, router
+from books.models import Book
+from books.search import icontains_search, search_books
+from books.seeding import seed_books
+
+"""
+Compare search latency of the old icontains query with books/search.py.
+
+$ docker-compose exec web python manage.py bench_search --generate 1000000
+$ docker-compose exec web python manage.py bench_search --repeat 20 potter "lord rings" tolkien
+
+--generate inserts synthetic books first (books/seeding.py, in bulk, a
+million rows take a couple of minutes), run it once and then benchmark as
+often as you like.
+Each query is timed end to end: fetching the first page of 20 results plus
+the COUNT(*) the paginator needs.
+"""
+
+
+class Command(BaseCommand):
+    help = 'Benchmark icontains search against full-text/trigram search.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queries', nargs='*', default=['potter', 'lord rings', 'tolkien', 'hary poter'])
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument('--generate', type=int, default=0,
+                            help='insert this many synthetic books before benchmarking')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        if options['generate']:
+            self.generate(options['generate'], options['batch_size'], options['seed'])
+
+        vendor = connections[router.db_for_read(Book)].vendor
+        self.stdout.write('database: %s, books: %d' % (vendor, Book.objects.count()))
+        paths = (('icontains', lambda q: icontains_search(q, Book.objects.all())),
+                 ('search', search_books))
+        for query in options['queries']:
+            for name, search in paths:
+                timings = []
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    queryset = search(query)
+                    list(queryset[:20])
+                    total = queryset.count()
+                    timings.append((time.perf_counter() - start) * 1000)
+                timings.sort()
+                p95 = timings[round(0.95 * (len(timings) - 1))]
+                self.stdout.write(
+                    '%-12r %-10s hits=%-8d p50=%8.2fms p95=%8.2fms max=%8.2fms' % (
+                        query, name, total, statistics.median(timings), p95, timings[-1]))
+
+    def generate(self, count, batch_size, seed):
+        start = time.perf_counter()
+        seed_books(count, seed, batch_size)
+        self.stdout.write('generated %d books in %.1fs' % (count, time.perf_counter() - start))
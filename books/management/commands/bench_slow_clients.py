@@ -0,0 +1,151 @@
+import asyncio
+import json
+import statistics
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+from books.benchmark import percentile
+
+"""
+Slow client benchmark: WSGI (sync workers) against ASGI (uvicorn workers)
+
+A sync gunicorn worker handles one connection at a time. A client on a bad
+mobile network that takes seconds to send its request or to read the
+response keeps the worker busy the whole time, so a few hundred of them
+are enough to starve everybody else. An ASGI worker keeps such connections
+parked on its event loop.
+
+The benchmark opens --slow-clients connections that trickle their request
+out a byte at a time over --trickle seconds (and read the answer just as
+slowly), and at the same time runs --probes normal clients in a loop that
+measure how long a request takes. Start the server in one mode, run the
+benchmark, then the other mode:
+
+$ gunicorn config.wsgi -w 4 -b 127.0.0.1:8000
+$ python manage.py bench_slow_clients "http://127.0.0.1:8000/books/search/?q=potter"
+$ gunicorn config.asgi -w 4 -k uvicorn.workers.UvicornWorker -b 127.0.0.1:8000
+$ python manage.py bench_slow_clients "http://127.0.0.1:8000/books/search/?q=potter"
+
+It only needs the URL; no database or Django setup is involved.
+"""
+
+
+def _request(url):
+    parts = urlsplit(url)
+    if parts.scheme != 'http':
+        raise CommandError('Only http:// URLs are supported.')
+    target = parts.path or '/'
+    if parts.query:
+        target += '?' + parts.query
+    request = (
+        'GET %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: bench_slow_clients\r\n'
+        'Connection: close\r\n\r\n' % (target, parts.netloc)
+    ).encode()
+    return parts.hostname, parts.port or 80, request
+
+
+class Command(BaseCommand):
+    help = 'Measure latency under many slow clients (WSGI vs ASGI serving).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('url')
+        parser.add_argument('--slow-clients', type=int, default=200)
+        parser.add_argument('--trickle', type=float, default=5.0,
+                            help='seconds a slow client takes to send its request')
+        parser.add_argument('--probes', type=int, default=10,
+                            help='concurrent normal clients that are measured')
+        parser.add_argument('--duration', type=float, default=15.0)
+        parser.add_argument('--timeout', type=float, default=30.0)
+        parser.add_argument('--json', action='store_true', help='print the results as JSON')
+
+    def handle(self, *args, **options):
+        self.host, self.port, self.request = _request(options['url'])
+        self.options = options
+        results = asyncio.run(self.run())
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(
+            '%(url)s\n'
+            'slow clients=%(slow_clients)d probes=%(probes)d duration=%(duration).0fs\n'
+            'requests=%(requests)d errors=%(errors)d throughput=%(rps).1f req/s\n'
+            'p50=%(p50).1fms p95=%(p95).1fms p99=%(p99).1fms max=%(max).1fms' % results)
+
+    async def run(self):
+        deadline = time.monotonic() + self.options['duration']
+        timings, errors = [], []
+        slow = [asyncio.ensure_future(self.slow_client(deadline))
+                for _ in range(self.options['slow_clients'])]
+        # give the slow clients a head start so they hold their connections
+        await asyncio.sleep(min(1.0, self.options['trickle'] / 2))
+        start = time.monotonic()
+        await asyncio.gather(*(
+            self.probe(deadline, timings, errors) for _ in range(self.options['probes'])))
+        elapsed = time.monotonic() - start
+        for task in slow:
+            task.cancel()
+        await asyncio.gather(*slow, return_exceptions=True)
+
+        timings.sort()
+        return {
+            'url': self.options['url'],
+            'slow_clients': self.options['slow_clients'],
+            'probes': self.options['probes'],
+            'duration': elapsed,
+            'requests': len(timings),
+            'errors': len(errors),
+            'rps': len(timings) / elapsed if elapsed else 0.0,
+            'p50': statistics.median(timings) if timings else 0.0,
+            'p95': percentile(timings, 0.95) if timings else 0.0,
+            'p99': percentile(timings, 0.99) if timings else 0.0,
+            'max': timings[-1] if timings else 0.0,
+        }
+
+    async def probe(self, deadline, timings, errors):
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(self.fetch(), self.options['timeout'])
+            except (OSError, asyncio.TimeoutError) as error:
+                errors.append(repr(error))
+                await asyncio.sleep(0.1)
+                continue
+            if status >= 500:
+                errors.append('HTTP %d' % status)
+            else:
+                timings.append((time.perf_counter() - start) * 1000)
+
+    async def fetch(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(self.request)
+            await writer.drain()
+            status_line = await reader.readline()
+            await reader.read()  # Connection: close, the body ends with the connection
+        finally:
+            writer.close()
+        try:
+            return int(status_line.split()[1])
+        except (IndexError, ValueError):
+            raise OSError('bad response %r' % status_line)
+
+    async def slow_client(self, deadline):
+        delay = self.options['trickle'] / len(self.request)
+        while time.monotonic() < deadline:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError:
+                await asyncio.sleep(0.5)
+                continue
+            try:
+                for byte in range(len(self.request)):
+                    writer.write(self.request[byte:byte + 1])
+                    await writer.drain()
+                    await asyncio.sleep(delay)
+                while await reader.read(1024):
+                    await asyncio.sleep(0.2)
+            except OSError:
+                pass
+            finally:
+                writer.close()
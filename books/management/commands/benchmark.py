@@ -0,0 +1,74 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from books import benchmark
+
+"""
+Throughput and p50/p95/p99 latency of the main pages (books/benchmark.py)
+
+$ docker-compose exec web python manage.py seed_catalog
+$ docker-compose exec web python manage.py benchmark -o bench-1.4.json
+$ docker-compose exec web python manage.py benchmark --baseline bench-1.4.json --threshold 0.15
+
+The results are written as JSON (-o, or stdout with -o -) together with the
+revision, versions and catalog size they were measured on. With --baseline
+the run fails (exit status 1) when a scenario's p95 grew, or its throughput
+shrank, by more than --threshold (a fraction, 0.2 = 20%), so it can gate a
+release in CI. --cold turns the site cache off to measure the views
+themselves rather than the cache.
+"""
+
+
+class Command(BaseCommand):
+    help = 'Measure throughput and latency percentiles of the main pages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', help='default: all of them')
+        parser.add_argument('--requests', type=int, default=200, help='per scenario')
+        parser.add_argument('--concurrency', type=int, default=1)
+        parser.add_argument('--warmup', type=int, default=10, help='untimed requests per thread')
+        parser.add_argument('--seed', type=int, default=42, help='the seed_catalog seed, for the login users')
+        parser.add_argument('--cold', action='store_true', help='without the site cache')
+        parser.add_argument('-o', '--output', help='write the JSON results here ("-" for stdout)')
+        parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+        parser.add_argument('--threshold', type=float, default=0.2)
+
+    def handle(self, *args, **options):
+        available = benchmark.scenarios(options['seed'])
+        names = options['scenarios'] or list(available)
+        unknown = set(names) - set(available)
+        if unknown:
+            raise CommandError('Unknown scenario(s): %s (choose from %s)' % (
+                ', '.join(sorted(unknown)), ', '.join(available)))
+
+        results = {
+            'environment': benchmark.environment(),
+            'options': {name: options[name] for name in ('requests', 'concurrency', 'warmup', 'seed', 'cold')},
+            'scenarios': {},
+        }
+        overrides = {'CACHE_MIDDLEWARE_SECONDS': 0} if options['cold'] else {}
+        with override_settings(**overrides):
+            for name in names:
+                session, requests = available[name]
+                result = benchmark.run_scenario(
+                    session, requests, options['requests'], options['concurrency'], options['warmup'])
+                results['scenarios'][name] = result
+                self.stderr.write(
+                    '%-12s %8.1f req/s  p50=%7.2fms p95=%7.2fms p99=%7.2fms errors=%d' % (
+                        name, result['throughput'], result['p50'], result['p95'], result['p99'],
+                        result['errors']))
+
+        if options['output'] == '-':
+            self.stdout.write(json.dumps(results, indent=2))
+        elif options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if options['baseline']:
+            regressions = benchmark.compare(results, benchmark.load(options['baseline']), options['threshold'])
+            for name, metric, old, new in regressions:
+                self.stderr.write('REGRESSION %s %s: %s -> %s' % (name, metric, old, new))
+            if regressions:
+                raise CommandError('%d regression(s) beyond %.0f%%' % (len(regressions), options['threshold'] * 100))
+            self.stderr.write('no regressions beyond %.0f%%' % (options['threshold'] * 100))
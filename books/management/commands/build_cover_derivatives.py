@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from books.images import IMAGE_ERRORS, ensure_derivatives
+from books.models import Book
+
+"""
+Generate the resized WebP/JPEG covers (books/images.py) for every book.
+$ docker-compose exec web python manage.py build_cover_derivatives [--force]
+"""
+
+
+class Command(BaseCommand):
+    help = 'Generate thumbnail/WebP/JPEG derivatives of every book cover.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='regenerate derivatives that already exist')
+
+    def handle(self, *args, **options):
+        books = Book.objects.exclude(cover='').only('id', 'cover')
+        count = 0
+        for book in books.iterator(chunk_size=500):
+            try:
+                ensure_derivatives(book.cover, force=options['force'])
+            except IMAGE_ERRORS as error:
+                self.stderr.write('%s: %s' % (book.cover.name, error))
+                continue
+            count += 1
+        self.stdout.write('processed %d covers' % count)
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from books import export
+
+"""
+Stream the catalog (books) or the reviews to a file or to stdout.
+$ docker-compose exec web python manage.py export_books > books.csv
+$ docker-compose exec web python manage.py export_books --dataset reviews --format jsonl -o reviews.jsonl
+$ docker-compose exec web python manage.py export_books --format parquet -o books.parquet
+
+See books/export.py: server-side cursor, constant memory. Parquet needs
+pyarrow and an --output file.
+"""
+
+
+class Command(BaseCommand):
+    help = 'Export books or reviews as CSV, JSONL or Parquet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dataset', choices=sorted(export.DATASETS), default='books')
+        parser.add_argument('--format', choices=sorted(export.FORMATS) + ['parquet'], default='csv')
+        parser.add_argument('-o', '--output', help='file to write, defaults to stdout')
+        parser.add_argument('--chunk-size', type=int, default=export.DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        dataset, file_format = options['dataset'], options['format']
+        start = time.perf_counter()
+        if file_format == 'parquet':
+            if not options['output']:
+                raise CommandError('Parquet needs --output, it can not be streamed to stdout.')
+            try:
+                count = export.write_parquet(dataset, options['output'], options['chunk_size'])
+            except ImportError:
+                raise CommandError('Parquet export needs pyarrow: pipenv install pyarrow')
+        else:
+            out = open(options['output'], 'w', newline='') if options['output'] else self.stdout
+            count = -1 if file_format == 'csv' else 0  # don't count the csv header
+            try:
+                for chunk in export.iter_export(dataset, file_format, options['chunk_size']):
+                    out.write(chunk)
+                    count += 1
+            finally:
+                if out is not self.stdout:
+                    out.close()
+        # the rows go to stdout, so the summary goes to stderr
+        self.stderr.write('exported %d %s in %.1fs' % (count, dataset, time.perf_counter() - start))
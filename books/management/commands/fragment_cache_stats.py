@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from books.cache import fragment_stats
+
+"""
+How well is the {% bookcache %} fragment cache doing?
+$ docker-compose exec web python manage.py fragment_cache_stats
+"""
+
+
+class Command(BaseCommand):
+    help = 'Show hit/miss counters of the per-book fragment cache.'
+
+    def handle(self, *args, **options):
+        stats = fragment_stats()
+        self.stdout.write('hits:      %d' % stats['hits'])
+        self.stdout.write('misses:    %d' % stats['misses'])
+        self.stdout.write('hit ratio: %.1f%%' % (stats['hit_ratio'] * 100))
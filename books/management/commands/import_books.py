@@ -0,0 +1,234 @@
+import csv
+import io
+import json
+import os
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+from django.db.models import F
+from django.utils import timezone
+from books.cache import bump_catalog_version
+from books.models import Book
+
+"""
+Bulk catalog import
+
+Adding books one by one in the admin does not scale to a real catalog.
+$ docker-compose exec web python manage.py import_books books.csv
+$ docker-compose exec web python manage.py import_books books.jsonl --covers ./covers/
+
+The file is read as a stream (a row at a time), so its size does not matter.
+Rows need title, author and price, and may name a cover file found in the
+--covers directory. CSV needs a header row; JSONL is one JSON object per line.
+
+- Rows are written in batches of --batch-size inside one transaction each.
+- On PostgreSQL a batch is sent with COPY into a temporary table and merged
+  with INSERT ... ON CONFLICT, elsewhere bulk_update()/bulk_create() are used.
+- (title, author) is the natural key: an existing book gets its price (and
+  cover, when one is given) updated instead of being duplicated.
+- After every committed batch the number of rows done is written to a state
+  file. If the import dies, run it again with --resume to continue after the
+  last committed batch. Re-importing a batch is harmless thanks to the upsert.
+"""
+
+UPDATE_FIELDS = ('price', 'cover')
+
+
+class RowError(ValueError):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Stream books from a CSV or JSONL file into the catalog.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+                            help='defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--covers', help='directory containing the cover files')
+        parser.add_argument('--resume', action='store_true',
+                            help='skip the rows committed by a previous run')
+        parser.add_argument('--state-file',
+                            help='progress file, defaults to <path>.import-state')
+        parser.add_argument('--no-copy', action='store_true',
+                            help="don't use PostgreSQL COPY")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+        if file_format not in ('csv', 'jsonl'):
+            raise CommandError('Unknown format %r, use --format csv or --format jsonl.' % file_format)
+        self.covers = options['covers']
+        self.state_file = options['state_file'] or path + '.import-state'
+        self.connection = connections[router.db_for_write(Book)]
+        use_copy = self.connection.vendor == 'postgresql' and not options['no_copy']
+        write_batch = self.copy_batch if use_copy else self.orm_batch
+
+        skip = self.read_state(path) if options['resume'] else 0
+        if skip:
+            self.stdout.write('resuming after row %d' % skip)
+
+        self.created = self.updated = self.errors = 0
+        number = done = skip
+        start = time.perf_counter()
+        batch = {}
+        with open(path, newline='', encoding='utf-8') as f:
+            for number, record in enumerate(self.records(f, file_format), start=1):
+                if number <= skip:
+                    continue
+                try:
+                    book = self.build(record)
+                except RowError as error:
+                    self.errors += 1
+                    self.stderr.write('row %d: %s' % (number, error))
+                else:
+                    # the last row wins when a batch contains a key twice
+                    batch[(book.title, book.author)] = book
+                if number - done >= options['batch_size']:
+                    write_batch(list(batch.values()))
+                    batch, done = {}, number
+                    self.checkpoint(path, done, start, skip)
+            if number > done:
+                write_batch(list(batch.values()))
+                done = number
+                self.checkpoint(path, done, start, skip)
+
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(
+            'done: %d created, %d updated, %d rejected, %.0f rows/s' % (
+                self.created, self.updated, self.errors,
+                (done - skip) / max(time.perf_counter() - start, 1e-9))))
+
+    # reading
+
+    def records(self, f, file_format):
+        if file_format == 'csv':
+            yield from csv.DictReader(f)
+            return
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield {}  # reported as a rejected row by build()
+
+    def build(self, record):
+        title = (record.get('title') or '').strip()
+        author = (record.get('author') or '').strip()
+        if not title or not author:
+            raise RowError('title and author are required')
+        try:
+            price = Decimal(str(record.get('price', '')).strip())
+            # max_digits/decimal_places of Book.price
+            Book._meta.get_field('price').run_validators(price)
+        except (InvalidOperation, ValidationError):
+            raise RowError('invalid price %r' % record.get('price'))
+        book = Book(title=title[:200], author=author[:200], price=price)
+        cover = (record.get('cover') or '').strip()
+        if cover and self.covers:
+            book.cover = self.attach_cover(book, cover)
+        return book
+
+    def attach_cover(self, book, filename):
+        source = os.path.join(self.covers, os.path.basename(filename))
+        if not os.path.isfile(source):
+            raise RowError('cover %s not found' % source)
+        field = Book._meta.get_field('cover')
+        name = field.generate_filename(book, os.path.basename(filename))
+        # don't store the same cover again when a batch is re-imported
+        if field.storage.exists(name) and field.storage.size(name) == os.path.getsize(source):
+            return name
+        with open(source, 'rb') as f:
+            return field.storage.save(name, File(f))
+
+    # writing
+
+    def orm_batch(self, books):
+        updated = []
+        # bulk_update() doesn't run auto_now
+        now = timezone.now()
+        with transaction.atomic(using=self.connection.alias):
+            Book.objects.resolve_authors(books)
+            existing = {}
+            titles = list({book.title for book in books})
+            for offset in range(0, len(titles), 500):
+                for book in Book.objects.filter(title__in=titles[offset:offset + 500]):
+                    existing[(book.title, book.author)] = book
+            created = []
+            for book in books:
+                current = existing.get((book.title, book.author))
+                if current is None:
+                    created.append(book)
+                    continue
+                current.price = book.price
+                if book.cover:
+                    current.cover = book.cover
+                # relative, a review may have bumped it since the row was read
+                current.version = F('version') + 1
+                current.updated_at = now
+                updated.append(current)
+            Book.objects.bulk_update(updated, UPDATE_FIELDS + ('version', 'updated_at'), batch_size=500)
+            Book.objects.bulk_create(created, batch_size=500)
+        self.created += len(created)
+        self.updated += len(updated)
+
+    def copy_batch(self, books):
+        Book.objects.resolve_authors(books)
+        fields = [field for field in Book._meta.concrete_fields if field.name != 'search_vector']
+        columns = ', '.join(self.connection.ops.quote_name(field.column) for field in fields)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for book in books:
+            row = []
+            for field in fields:
+                value = field.get_db_prep_save(field.pre_save(book, True), self.connection)
+                row.append('\\N' if value is None else str(value))
+            writer.writerow(row)
+        buffer.seek(0)
+
+        table = Book._meta.db_table
+        with transaction.atomic(using=self.connection.alias), self.connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMPORARY TABLE import_books_batch (LIKE %s) ON COMMIT DROP' % table)
+            cursor.copy_expert(
+                "COPY import_books_batch (%s) FROM STDIN WITH (FORMAT csv, NULL '\\N')" % columns,
+                buffer)
+            # RETURNING (xmax = 0) is true for inserted and false for updated rows
+            cursor.execute(
+                'INSERT INTO {table} AS book ({columns}) SELECT {columns} FROM import_books_batch '
+                'ON CONFLICT (title, author) DO UPDATE SET price = EXCLUDED.price, '
+                "cover = CASE WHEN EXCLUDED.cover <> '' THEN EXCLUDED.cover ELSE book.cover END, "
+                'version = book.version + 1, updated_at = EXCLUDED.updated_at '
+                'RETURNING (xmax = 0)'.format(table=table, columns=columns))
+            for (inserted,) in cursor.fetchall():
+                if inserted:
+                    self.created += 1
+                else:
+                    self.updated += 1
+
+    # progress
+
+    def read_state(self, path):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return 0
+        if state.get('path') != os.path.abspath(path):
+            raise CommandError('%s belongs to another import (%s).' % (self.state_file, state.get('path')))
+        return state['rows']
+
+    def checkpoint(self, path, rows, start, skip):
+        with open(self.state_file, 'w') as f:
+            json.dump({'path': os.path.abspath(path), 'rows': rows}, f)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        self.stdout.write('%d rows (%.0f rows/s)' % (rows, (rows - skip) / elapsed))
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+from books import ratings
+from books.cache import bump_catalog_version
+
+"""
+Repair the per-book review aggregates (books/ratings.py)
+
+$ docker-compose exec web python manage.py reconcile_ratings --dry-run
+$ docker-compose exec web python manage.py reconcile_ratings
+
+Every book's review_count, rating_count, rating_sum and rating_avg are
+recomputed from its reviews, batch by batch, and the ones that drifted
+(bulk inserts, raw SQL, a bug) are written back. Safe to run while the site
+is up; run it after manage.py seed_catalog or a bulk review import.
+"""
+
+
+class Command(BaseCommand):
+    help = 'Recompute review counts and ratings of every book and fix the ones that drifted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='only report the drift')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        checked, drifted = ratings.reconcile(options['batch_size'], options['dry_run'])
+        if drifted and not options['dry_run']:
+            bump_catalog_version()
+        self.stdout.write('%d books checked, %d %s in %.1fs' % (
+            checked, drifted, 'drifted' if options['dry_run'] else 'fixed', time.perf_counter() - start))
@@ -0,0 +1,73 @@
+# Generated by Django 3.1.14 on 2026-10-18 17:06
+
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+"""
+The search indexes and the trigger that maintains Book.search_vector only make
+sense on PostgreSQL, so they are created with raw SQL that is skipped on any
+other database (e.g. SQLite used for quick local experiments).
+"""
+
+FORWARD_SQL = [
+    """
+    CREATE FUNCTION books_book_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('pg_catalog.english', coalesce(NEW.title, '')), 'A') ||
+            setweight(to_tsvector('pg_catalog.english', coalesce(NEW.author, '')), 'B');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+    """,
+    """
+    CREATE TRIGGER books_book_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, author ON books_book
+    FOR EACH ROW EXECUTE PROCEDURE books_book_search_vector_update();
+    """,
+    # backfill the books that already exist
+    "UPDATE books_book SET title = title;",
+    "CREATE INDEX book_search_vector_idx ON books_book USING gin (search_vector);",
+    # UPPER(...) matches the expression Django generates for icontains and the
+    # one books/search.py uses for similarity, so both can use these indexes.
+    "CREATE INDEX book_title_trgm_idx ON books_book USING gin (UPPER(title) gin_trgm_ops);",
+    "CREATE INDEX book_author_trgm_idx ON books_book USING gin (UPPER(author) gin_trgm_ops);",
+]
+
+BACKWARD_SQL = [
+    "DROP INDEX IF EXISTS book_author_trgm_idx;",
+    "DROP INDEX IF EXISTS book_title_trgm_idx;",
+    "DROP INDEX IF EXISTS book_search_vector_idx;",
+    "DROP TRIGGER IF EXISTS books_book_search_vector_trigger ON books_book;",
+    "DROP FUNCTION IF EXISTS books_book_search_vector_update();",
+]
+
+
+def run_postgres_sql(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0006_book_keyset_indexes'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='book',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(
+            run_postgres_sql(FORWARD_SQL),
+            run_postgres_sql(BACKWARD_SQL),
+        ),
+    ]
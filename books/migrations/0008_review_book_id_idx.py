@@ -0,0 +1,17 @@
+# Generated by Django 3.1.14 on 2026-10-18 17:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0007_book_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['book', 'id'], name='review_book_id_idx'),
+        ),
+    ]
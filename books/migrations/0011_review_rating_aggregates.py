@@ -0,0 +1,64 @@
+# Generated by Django 3.1.14 on 2026-10-18 17:43
+
+import django.core.validators
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+"""
+Existing reviews have no rating, but they count: review_count is filled in
+with one UPDATE ... SET review_count = (SELECT COUNT(*) ...) per book.
+manage.py reconcile_ratings does the same (and more) in batches if needed.
+"""
+
+
+def count_reviews(apps, schema_editor):
+    Book = apps.get_model('books', 'Book')
+    Review = apps.get_model('books', 'Review')
+    reviews = (Review.objects.filter(book=OuterRef('pk')).order_by().values('book')
+               .annotate(count=Count('id')).values('count'))
+    Book.objects.using(schema_editor.connection.alias).update(review_count=Coalesce(Subquery(reviews), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0010_book_natural_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='rating_avg',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='review',
+            name='rating',
+            field=models.PositiveSmallIntegerField(blank=True, choices=[(1, '★'), (2, '★★'), (3, '★★★'), (4, '★★★★'), (5, '★★★★★')], null=True, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(5)]),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['-rating_avg', '-rating_count', 'id'], name='book_top_rated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['-review_count', 'id'], name='book_most_reviewed_idx'),
+        ),
+        migrations.RunPython(count_reviews, migrations.RunPython.noop),
+    ]
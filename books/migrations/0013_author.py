@@ -0,0 +1,33 @@
+# Generated by Django 3.1.14 on 2026-10-18 17:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+"""
+The Author table and a nullable Book.written_by: adding a nullable column
+without a default only changes the catalog, so it is instant on a table of
+any size. 0014 fills it in batches, 0015 swaps the author indexes.
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0012_facet_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Author',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('sort_name', models.CharField(max_length=200, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='written_by',
+            field=models.ForeignKey(blank=True, db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='books', to='books.author'),
+        ),
+    ]
@@ -0,0 +1,70 @@
+import unicodedata
+from django.db import migrations, transaction
+
+"""
+Point every book at the Author of its author string.
+
+A single UPDATE over the whole table would hold the row locks of every book
+until it commits and write one huge transaction. This migration is not
+atomic instead: it walks the books still missing written_by in primary key
+order, BATCH_SIZE at a time, and commits every batch on its own (creating
+the batch's missing authors, then a bulk_update() of its books). Concurrent writes
+only ever wait for one batch, and an interrupted run picks up where it
+stopped when migrate runs again. Books saved meanwhile resolve their author
+themselves (Book.save()).
+"""
+
+BATCH_SIZE = 2000
+
+
+def author_sort_name(name):
+    # frozen copy of books.models.author_sort_name, the model one may change later
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(char for char in name if not unicodedata.combining(char))
+    last, comma, first = name.replace('.', '').casefold().partition(',')
+    if not comma:
+        # 'First Last'
+        *first, last = last.split() or ['']
+        first = ' '.join(first)
+    return ' '.join(last.split() + first.replace(',', ' ').split())
+
+
+def fill_written_by(apps, schema_editor):
+    Author = apps.get_model('books', 'Author')
+    Book = apps.get_model('books', 'Book')
+    using = schema_editor.connection.alias
+    last = None
+    while True:
+        with transaction.atomic(using=using):
+            books = Book.objects.using(using).filter(written_by__isnull=True).order_by('pk')
+            if last is not None:
+                books = books.filter(pk__gt=last)
+            rows = list(books.values_list('pk', 'author')[:BATCH_SIZE])
+            if not rows:
+                return
+            keys = {author: author_sort_name(author) for pk, author in rows}
+            authors = Author.objects.using(using)
+            ids = dict(authors.filter(sort_name__in=set(keys.values())).values_list('sort_name', 'id'))
+            missing = {}
+            for author, key in keys.items():
+                if key not in ids:
+                    missing.setdefault(key, author)
+            if missing:
+                authors.bulk_create(
+                    [Author(name=name, sort_name=key) for key, name in missing.items()], ignore_conflicts=True)
+                ids.update(authors.filter(sort_name__in=list(missing)).values_list('sort_name', 'id'))
+            Book.objects.using(using).bulk_update(
+                [Book(pk=pk, written_by_id=ids[keys[author]]) for pk, author in rows], ['written_by'])
+        last = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('books', '0013_author'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_written_by, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+from django.contrib.postgres.operations import AddIndexConcurrently, RemoveIndexConcurrently
+from django.db import migrations, models
+
+"""
+Swap the (author, ...) filter indexes of 0012 for (written_by, ...) ones,
+now that written_by is filled in (0014); building them after the backfill
+is cheaper than maintaining them during it.
+
+On PostgreSQL the indexes are built and dropped CONCURRENTLY, so the books
+table keeps taking writes while a big index builds. That can't run inside a
+transaction, hence atomic = False. Other databases get the plain operations.
+"""
+
+
+class PostgresConcurrently:
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+        return self.plain.database_forwards(self, app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+        return self.plain.database_backwards(self, app_label, schema_editor, from_state, to_state)
+
+
+class AddIndex(PostgresConcurrently, AddIndexConcurrently):
+    plain = migrations.AddIndex
+
+
+class RemoveIndex(PostgresConcurrently, RemoveIndexConcurrently):
+    plain = migrations.RemoveIndex
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('books', '0014_book_written_by_backfill'),
+    ]
+
+    operations = [
+        AddIndex(
+            model_name='book',
+            index=models.Index(fields=['written_by', 'title', 'id'], name='book_writer_title_id_idx'),
+        ),
+        AddIndex(
+            model_name='book',
+            index=models.Index(fields=['written_by', 'price', 'id'], name='book_writer_price_id_idx'),
+        ),
+        RemoveIndex(
+            model_name='book',
+            name='book_author_title_id_idx',
+        ),
+        RemoveIndex(
+            model_name='book',
+            name='book_author_price_id_idx',
+        ),
+    ]
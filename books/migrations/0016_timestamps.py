@@ -0,0 +1,42 @@
+# Generated by Django 3.1.14 on 2026-10-18 18:20
+
+from django.db import migrations, models
+import django.utils.timezone
+
+"""
+created_at/updated_at on Book and Review. The existing rows get the time of
+the migration: the default is evaluated once, so it is a constant, which
+PostgreSQL 11+ stores in the catalog instead of rewriting the tables.
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0015_author_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='review',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='review',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
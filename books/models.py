@@ -1,6 +1,9 @@
+import unicodedata
 import uuid
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.contrib.postgres.search import SearchVectorField
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import models, router, transaction
 from django.urls import reverse
 """
 model defines a Book, which has a title ,author ,price, cover
@@ -40,6 +43,131 @@ href="{% url 'book_list' %}
 """
 
 
+# maintained by books/ratings.py, never written back by Book.save()
+AGGREGATE_FIELDS = ('review_count', 'rating_count', 'rating_sum', 'rating_avg')
+
+# ?price= filter of the book list (books/facets.py): slug, label, from, below
+PRICE_BANDS = (
+    ('under-10', 'Under $10', None, 10),
+    ('10-25', '$10 to $25', 10, 25),
+    ('25-50', '$25 to $50', 25, 50),
+    ('50-plus', '$50 and more', 50, None),
+)
+
+
+def price_band_q(low, high):
+    condition = models.Q()
+    if low is not None:
+        condition &= models.Q(price__gte=low)
+    if high is not None:
+        condition &= models.Q(price__lt=high)
+    return condition
+
+
+def author_sort_name(name):
+    """
+    'J.K. Rowling' and 'Rowling, J.K.' -> 'rowling jk': accents and dots
+    dropped, case folded, whitespace collapsed, last name first. Two
+    spellings that only differ in those respects are the same author.
+    """
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(char for char in name if not unicodedata.combining(char))
+    last, comma, first = name.replace('.', '').casefold().partition(',')
+    if not comma:
+        # 'First Last'
+        *first, last = last.split() or ['']
+        first = ' '.join(first)
+    return ' '.join(last.split() + first.replace(',', ' ').split())
+
+
+class AuthorManager(models.Manager):
+
+    def ids_for(self, names):
+        """
+        {name: author id} for the given names, creating the authors that
+        don't exist yet; a few queries per 500 names however many books
+        carry them (bulk imports).
+        """
+        keys = {name: author_sort_name(name) for name in names}
+        wanted = list(set(keys.values()))
+        ids = {}
+        for offset in range(0, len(wanted), 500):
+            ids.update(self.filter(sort_name__in=wanted[offset:offset + 500]).values_list('sort_name', 'id'))
+        missing = {}
+        for name, key in keys.items():
+            if key not in ids:
+                missing.setdefault(key, name)  # the first spelling names the author
+        if missing:
+            # ignore_conflicts: another process may create the same author meanwhile
+            self.bulk_create(
+                [self.model(name=name, sort_name=key) for key, name in missing.items()],
+                batch_size=500, ignore_conflicts=True)
+            missing = list(missing)
+            for offset in range(0, len(missing), 500):
+                ids.update(self.filter(sort_name__in=missing[offset:offset + 500]).values_list('sort_name', 'id'))
+        return {name: ids[key] for name, key in keys.items()}
+
+
+class Author(models.Model):
+    """
+    Book.author used to be the only record of an author: free text repeated
+    on every book, so "books by X" meant comparing strings over the whole
+    table. Books now also point at an Author row (Book.written_by) and
+    everything that filters or groups by author (author pages, facets,
+    search) works with its integer key. Book.author stays as the name
+    printed on the book and as part of the (title, author) natural key.
+    """
+    name = models.CharField(max_length=200)
+    # author_sort_name(name), unique: it is how a name finds its author
+    sort_name = models.CharField(max_length=200, unique=True)
+
+    objects = AuthorManager()
+
+    def __str__(self):
+        return self.name
+
+    def get_absolute_url(self):
+        return reverse('author_detail', args=[self.pk])
+
+    def save(self, *args, **kwargs):
+        sort_name = author_sort_name(self.name)
+        if self.pk is None or sort_name == self.sort_name:
+            self.sort_name = sort_name
+            super().save(*args, **kwargs)
+            return
+        # renamed: the new name must find this author, not the old one.
+        # When it already names another author the two are the same person,
+        # this one is merged into it.
+        using = kwargs.get('using') or router.db_for_write(Author, instance=self)
+        with transaction.atomic(using=using):
+            other = Author.objects.using(using).filter(sort_name=sort_name).exclude(pk=self.pk).first()
+            if other is not None:
+                # bumped versions: their cached headers link to this author
+                Book.objects.using(using).filter(written_by_id=self.pk).update(
+                    written_by_id=other.pk, version=models.F('version') + 1)
+                Author.objects.using(using).filter(pk=self.pk).delete()
+                self.pk = other.pk
+            self.sort_name = sort_name
+            super().save(*args, **kwargs)
+
+
+class BookManager(models.Manager):
+    # search_vector is only read inside the database by books/search.py,
+    # there is no point shipping the tsvector to Python for every book we load.
+    def get_queryset(self):
+        return super().get_queryset().defer('search_vector')
+
+    def resolve_authors(self, books):
+        """
+        Set written_by of unsaved books from their author, for bulk_create()
+        and the other bulk writes that skip Book.save()
+        """
+        ids = Author.objects.ids_for({book.author for book in books if book.written_by_id is None})
+        for book in books:
+            if book.written_by_id is None:
+                book.written_by_id = ids[book.author]
+
+
 class Book(models.Model):
     #  uuid4 is used for the encryption.
     id = models.UUIDField(
@@ -48,12 +176,39 @@ class Book(models.Model):
         editable=False)
     title = models.CharField(max_length=200)
     author = models.CharField(max_length=200)
+    # the Author row of author (Book.save() looks it up), the integer key the
+    # author pages, facets and search filter on. No index of its own: the
+    # (written_by, title, id) index below starts with it.
+    written_by = models.ForeignKey(
+        Author, on_delete=models.PROTECT, related_name='books',
+        null=True, blank=True, editable=False, db_index=False)
     price = models.DecimalField(max_digits=6, decimal_places=2)
     # handle Image Upload as book cover (Media)
     # if we dont add blank=True , we will see error on migrations , 
     # some books that exist in database already doesnt have cover.
     # blank=True option will make it optional
     cover = models.ImageField(upload_to='covers/', blank=True) 
+    # tsvector over title and author used by full-text search (books/search.py).
+    # It is filled in by a PostgreSQL trigger, so it stays correct for bulk
+    # inserts and queryset.update() too. Its GIN index and the trigram indexes
+    # are created in migration 0007 because they only exist on PostgreSQL.
+    search_vector = SearchVectorField(null=True, editable=False)
+    # bumped on every save of the book and every review change, the templates
+    # put it in their fragment cache keys ({% bookcache %} in templatetags/book_cache.py)
+    version = models.PositiveIntegerField(default=1, editable=False)
+    # review aggregates, kept up to date with F() updates whenever a review is
+    # saved or deleted (books/ratings.py) and repaired by manage.py reconcile_ratings.
+    # rating_avg is 0 while no review has a rating, so unrated books sort last.
+    review_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_avg = models.FloatField(default=0, editable=False)
+    # updated_at also moves with every review change (books/ratings.py): it is
+    # the Last-Modified of the detail page, which shows the reviews (books/views.py)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = BookManager()
     """
     Indexing is a common technique for speeding up database performance. It
     is a separate data structure that allows faster searches and is typically only
@@ -61,10 +216,42 @@ class Book(models.Model):
     additional space on a disk so they must be used with care.
     A general rule of thumb is that if a given field is being
     used frequently, such as 10-25% of all queries, it is a prime candidate to be indexed.
+
+    The (field, id) composite indexes back the keyset paginated book list:
+    one per ?sort= ordering so every page is a single index range scan.
+    The top rated and most reviewed orderings sort on the aggregates, so they
+    never touch the reviews table.
+
+    Filters (books/facets.py): (written_by, title, id) and
+    (written_by, price, id) serve the book list filtered by author and the
+    author pages, and the second one also covers the grouped facet count
+    query (written_by and price are all it reads). A
+    price band sorted by title uses the partial (title, id) index of that
+    band: the band indexes hold every book exactly once, so together they
+    are no bigger than one full index. They are only used when the query
+    repeats the index condition, so both are built by price_band_q().
+
+    The primary key has its own unique index; the old id_index repeated it,
+    costing disk and a second index write per insert for nothing.
     """
     class Meta:
         indexes = [  # new
-            models.Index(fields=['id'], name='id_index'),
+            models.Index(fields=['title', 'id'], name='book_title_id_idx'),
+            models.Index(fields=['author', 'id'], name='book_author_id_idx'),
+            models.Index(fields=['price', 'id'], name='book_price_id_idx'),
+            models.Index(fields=['-rating_avg', '-rating_count', 'id'], name='book_top_rated_idx'),
+            models.Index(fields=['-review_count', 'id'], name='book_most_reviewed_idx'),
+            models.Index(fields=['written_by', 'title', 'id'], name='book_writer_title_id_idx'),
+            models.Index(fields=['written_by', 'price', 'id'], name='book_writer_price_id_idx'),
+        ] + [
+            models.Index(fields=['title', 'id'], name='book_band%d_title_id_idx' % number,
+                         condition=price_band_q(low, high))
+            for number, (slug, label, low, high) in enumerate(PRICE_BANDS)
+        ]
+        # (title, author) is the natural key of a book, the catalog import
+        # (manage.py import_books) upserts on it
+        constraints = [
+            models.UniqueConstraint(fields=['title', 'author'], name='book_natural_key'),
         ]
         # Custom Permission Configuration via Meta class 
         permissions = [
@@ -83,6 +270,47 @@ class Book(models.Model):
     def get_absolute_url(self):
         return reverse('book_detail', args=[str(self.id)])
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        book = super().from_db(db, field_names, values)
+        # save() only looks the author up again when the name changed
+        book._loaded_author = book.__dict__.get('author')
+        return book
+
+    def resolve_author(self):
+        """ point written_by at the Author of author, unless it already does """
+        if self.written_by_id is not None and 'author' in self.get_deferred_fields():
+            return  # not loaded, so not changed either
+        if self.written_by_id is None or self.author != getattr(self, '_loaded_author', None):
+            self.written_by_id = Author.objects.ids_for([self.author])[self.author]
+            self._loaded_author = self.author
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'author' in update_fields:
+            self.resolve_author()
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'written_by'}
+        if kwargs.get('update_fields'):
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'updated_at', 'version'}
+        bump = not self._state.adding
+        if bump:
+            # in the database: this instance may be older than a review that
+            # already used version + 1, the fragments cached under that
+            # number would be served for the new title too
+            self.version = models.F('version') + 1
+            if kwargs.get('update_fields') is None:
+                # the aggregates may have moved on since this instance was
+                # loaded, writing them back would undo those reviews
+                deferred = self.get_deferred_fields()
+                kwargs['update_fields'] = [
+                    field.attname for field in self._meta.concrete_fields
+                    if not field.primary_key and field.attname not in deferred
+                    and field.name not in AGGREGATE_FIELDS]
+        super().save(*args, **kwargs)
+        if bump:
+            self.refresh_from_db(using=self._state.db, fields=['version'])
+
 
 """ 
 we can create dedicated review app but lets keep things simple and update books app.
@@ -110,13 +338,45 @@ class Review(models.Model):
     )
     # The review field contains the actual content which perhaps could be a TextField
     review = models.CharField(max_length=255)
+    # one to five stars, optional: older reviews are text only
+    rating = models.PositiveSmallIntegerField(
+        null=True, blank=True,
+        choices=[(stars, '\u2605' * stars) for stars in range(1, 6)],
+        validators=[MinValueValidator(1), MaxValueValidator(5)])
     # we’ll also link to the author field to auto-populate the current user with the review.
     author = models.ForeignKey(
         # And we’re using get_user_model to reference our custom user model.
         get_user_model(),
         on_delete=models.CASCADE,
     )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # the reviews of a book are keyset paginated by id
+            models.Index(fields=['book', 'id'], name='review_book_id_idx'),
+        ]
 
     def __str__(self):
         return self.review
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        review = super().from_db(db, field_names, values)
+        # the rating as stored, a changed rating moves the book's rating_sum by the difference
+        if 'rating' in field_names:
+            review._stored_rating = review.rating
+        return review
+
+    # the book's aggregates are updated by the post_save/post_delete handlers
+    # (books/signals.py); one transaction, so the review and its book agree
+    def save(self, *args, **kwargs):
+        with transaction.atomic(using=router.db_for_write(Review, instance=self)):
+            super().save(*args, **kwargs)
+        self._stored_rating = self.rating
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic(using=router.db_for_write(Review, instance=self)):
+            return super().delete(*args, **kwargs)
+
@@ -0,0 +1,139 @@
+import base64
+import json
+
+from django.db.models import Q
+from django.http import Http404
+
+"""
+Keyset (cursor) pagination
+
+Django's Paginator uses LIMIT/OFFSET: to show page 5000 the database still
+has to walk over the 99,980 rows in front of it and throw them away, so every
+page deeper into the catalog is slower than the one before.
+
+Keyset pagination remembers the sort key of the last row we showed and asks
+for the rows that come *after* it:
+
+    WHERE (title > 'Harry Potter') OR (title = 'Harry Potter' AND id > '...')
+    ORDER BY title, id
+    LIMIT 21
+
+With a composite index on (title, id) this is a single index range scan, so
+every page costs O(page size) no matter how deep the user pages.
+The id is always the last key so the ordering is total (two books can share a
+title but never an id).
+
+The position is handed to the client as an opaque ?cursor= token
+(urlsafe base64 of a small JSON document) so we are free to change its
+contents later without breaking links.
+"""
+
+
+class KeysetPage:
+    """ A page of results plus the cursors needed to move forwards and backwards. """
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """
+    keys is the ordering, e.g. ('title', 'id') or ('-rating_avg', 'id').
+    A leading '-' sorts that key descending. The last key must be unique.
+    name is stored inside the cursor so a cursor made for one ordering
+    can't be replayed against another one.
+    """
+
+    def __init__(self, queryset, keys, per_page, name=''):
+        self.queryset = queryset
+        self.keys = tuple(keys)
+        self.per_page = per_page
+        self.name = name
+
+    def _fields(self):
+        return [key.lstrip('-') for key in self.keys]
+
+    def _values(self, obj):
+        # JSON can't hold UUIDs, Decimals or datetimes; str() round-trips
+        # through the ORM which casts the string back to the field type.
+        values = []
+        for field in self._fields():
+            value = getattr(obj, field) if not isinstance(obj, dict) else obj[field]
+            values.append(value if value is None or isinstance(value, (int, float)) else str(value))
+        return values
+
+    def encode_cursor(self, obj, direction):
+        payload = {'o': self.name, 'd': direction, 'v': self._values(obj)}
+        raw = json.dumps(payload, separators=(',', ':')).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            payload = json.loads(raw)
+            direction, values = payload['d'], payload['v']
+        except (ValueError, TypeError, KeyError):
+            raise Http404('Invalid cursor.')
+        if (payload.get('o') != self.name or direction not in ('n', 'p')
+                or not isinstance(values, list) or len(values) != len(self.keys)):
+            raise Http404('Invalid cursor.')
+        return direction, values
+
+    def _seek(self, values, forward):
+        """
+        Build (k1 > v1) OR (k1 = v1 AND k2 > v2) OR ... for the given keys.
+        Descending keys and backwards paging flip the comparison.
+        """
+        condition = Q()
+        equal = {}
+        for key, value in zip(self.keys, values):
+            field = key.lstrip('-')
+            ascending = not key.startswith('-')
+            lookup = 'gt' if ascending == forward else 'lt'
+            condition |= Q(**equal, **{'%s__%s' % (field, lookup): value})
+            equal[field] = value
+        return condition
+
+    def _ordering(self, forward):
+        if forward:
+            return list(self.keys)
+        return [key[1:] if key.startswith('-') else '-' + key for key in self.keys]
+
+    def page(self, cursor=None):
+        forward = True
+        queryset = self.queryset
+        if cursor:
+            direction, values = self.decode_cursor(cursor)
+            forward = direction == 'n'
+            queryset = queryset.filter(self._seek(values, forward))
+        # fetch one extra row to find out whether there is another page
+        rows = list(queryset.order_by(*self._ordering(forward))[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if not forward:
+            rows.reverse()
+
+        next_cursor = previous_cursor = None
+        if rows:
+            if has_more or not forward:
+                next_cursor = self.encode_cursor(rows[-1], 'n')
+            if cursor and (forward or has_more):
+                previous_cursor = self.encode_cursor(rows[0], 'p')
+        return KeysetPage(rows, next_cursor, previous_cursor)
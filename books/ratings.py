@@ -0,0 +1,109 @@
+from django.db import router, transaction
+from django.db.models import Case, Count, F, FloatField, IntegerField, Sum, Value, When
+from django.db.models.functions import Cast
+from django.utils import timezone
+from .models import AGGREGATE_FIELDS, Book, Review
+
+"""
+Per-book review aggregates
+
+"Top rated" and "most reviewed" would otherwise need a COUNT/AVG with
+GROUP BY over the whole reviews table on every request. Instead every book
+carries review_count, rating_count (reviews with stars), rating_sum and
+rating_avg, and each review change moves them with a single UPDATE of
+relative F() expressions (together with the version bump the fragment cache
+needs and the updated_at the detail page validators read,
+books/signals.py and books/views.py):
+
+    UPDATE books_book SET review_count = review_count + 1,
+        rating_count = rating_count + 1, rating_sum = rating_sum + 4,
+        rating_avg = CAST(rating_sum + 4 AS float) / (rating_count + 1), ...
+    WHERE id = ...
+
+The database applies concurrent updates one after the other on the row, so
+no review gets lost the way a read-modify-write in Python would lose it.
+rating_avg is computed from the old values in the same statement.
+
+Anything that bypasses the model signals (queryset.update(), bulk_create(),
+raw SQL, manage.py seed_catalog) leaves the aggregates behind;
+manage.py reconcile_ratings recomputes them.
+"""
+
+
+def review_changed(book_id, reviews=0, old_rating=None, new_rating=None):
+    """ reviews is +1 for a new review, -1 for a deleted one, 0 for an edit """
+    rated = (new_rating is not None) - (old_rating is not None)
+    stars = (new_rating or 0) - (old_rating or 0)
+    changes = {'version': F('version') + 1, 'updated_at': timezone.now()}
+    if reviews:
+        changes['review_count'] = F('review_count') + reviews
+    if rated or stars:
+        changes['rating_count'] = F('rating_count') + rated
+        changes['rating_sum'] = F('rating_sum') + stars
+        changes['rating_avg'] = Case(
+            When(rating_count__gt=-rated, then=(
+                Cast(F('rating_sum') + stars, FloatField()) / Cast(F('rating_count') + rated, FloatField()))),
+            default=Value(0.0), output_field=FloatField())
+    return Book.objects.filter(pk=book_id).update(**changes)
+
+
+def _aggregates(book_ids, using):
+    """ {book id: the aggregate values} computed from the reviews """
+    totals = {pk: {'review_count': 0, 'rating_count': 0, 'rating_sum': 0, 'rating_avg': 0.0} for pk in book_ids}
+    rows = (Review.objects.using(using).filter(book_id__in=book_ids).order_by().values('book_id')
+            .annotate(reviews=Count('id'), rated=Count('rating'),
+                      stars=Sum('rating', output_field=IntegerField())))
+    for row in rows:
+        rated, stars = row['rated'], row['stars'] or 0
+        totals[row['book_id']] = {
+            'review_count': row['reviews'], 'rating_count': rated,
+            'rating_sum': stars, 'rating_avg': stars / rated if rated else 0.0,
+        }
+    return totals
+
+
+def _drifted(book, expected):
+    for field in AGGREGATE_FIELDS:
+        if field == 'rating_avg':
+            if abs(book.rating_avg - expected['rating_avg']) > 1e-9:
+                return True
+        elif getattr(book, field) != expected[field]:
+            return True
+    return False
+
+
+def reconcile(batch_size=1000, dry_run=False):
+    """
+    Recompute the aggregates of every book, batch by batch in primary key
+    order, and write the ones that drifted. Returns (books checked, books fixed).
+
+    Each batch locks its books (SELECT ... FOR UPDATE) before counting their
+    reviews. A review saved meanwhile has to update its book too, so it waits
+    for the batch; its F() update then lands on top of the repaired value.
+    """
+    checked = fixed = 0
+    last = None
+    using = router.db_for_write(Book)
+    while True:
+        with transaction.atomic(using=using):
+            books = Book.objects.using(using).order_by('pk').only('pk', *AGGREGATE_FIELDS)
+            if last is not None:
+                books = books.filter(pk__gt=last)
+            books = list(books.select_for_update()[:batch_size])
+            if not books:
+                return checked, fixed
+            expected = _aggregates([book.pk for book in books], using)
+            drifted = []
+            for book in books:
+                if _drifted(book, expected[book.pk]):
+                    for field, value in expected[book.pk].items():
+                        setattr(book, field, value)
+                    drifted.append(book)
+            if drifted and not dry_run:
+                Book.objects.using(using).bulk_update(drifted, AGGREGATE_FIELDS)
+                # the cached fragments show the old numbers
+                Book.objects.using(using).filter(pk__in=[book.pk for book in drifted]).update(
+                    version=F('version') + 1, updated_at=timezone.now())
+        checked += len(books)
+        fixed += len(drifted)
+        last = books[-1].pk
@@ -0,0 +1,87 @@
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    TrigramSimilarity,
+)
+from django.db import connections, router
+from django.db.models import F, Q
+from django.db.models.functions import Greatest, Upper
+from .models import Author, Book, author_sort_name
+
+"""
+Search engine for the books app.
+
+The original search was
+    Book.objects.filter(Q(title__icontains=q) | Q(author__icontains=q))
+which PostgreSQL can only answer with a sequential scan over every book.
+
+On PostgreSQL (our production database) we now use:
+1) full-text search: Book.search_vector is a tsvector over title (weight A)
+   and author (weight B), maintained by a database trigger and GIN indexed
+   (see migration 0007). websearch_to_tsquery understands "quoted phrases",
+   OR and -negation, and stems words so "potters" finds "Potter".
+2) trigram matching (pg_trgm): GIN indexes over UPPER(title) and
+   UPPER(author) with gin_trgm_ops. They make the old icontains lookups
+   (substring matches) index scans and power fuzzy matching, so "hary poter"
+   still finds "Harry Potter".
+3) ranking: results are ordered by ts_rank, then by trigram similarity.
+
+Any other database (SQLite in local experiments) falls back to the plain
+icontains filter so the site keeps working without PostgreSQL.
+
+Author matches don't compare the query with the author string of every
+book: the query is normalized like Author.sort_name (author_sort_name()),
+matched against the much smaller authors table, and the books are then
+joined on their integer written_by key through the (written_by, title, id)
+index. "rowling", "Rowling, J.K." and "j.k. rowling" all find JK Rowling.
+"""
+
+SEARCH_CONFIG = 'english'
+
+
+def search_books(query, queryset=None):
+    """ Return the books matching query, best matches first. """
+    queryset = Book.objects.all() if queryset is None else queryset
+    query = (query or '').strip()
+    if not query:
+        # a missing or blank ?q= used to match every book
+        return queryset.none()
+    vendor = connections[router.db_for_read(Book)].vendor
+    if vendor == 'postgresql':
+        return postgres_search(query, queryset)
+    return icontains_search(query, queryset)
+
+
+def author_match(query):
+    """ Q for the books of the authors whose sort name holds every word of query """
+    words = author_sort_name(query).split()
+    if not words:
+        return Q(pk__in=[])
+    authors = Author.objects.filter(*[Q(sort_name__contains=word) for word in words])
+    return Q(written_by__in=authors.values('pk'))
+
+
+def icontains_search(query, queryset):
+    return queryset.filter(
+        Q(title__icontains=query) | author_match(query)
+    ).order_by('title', 'id')
+
+
+def postgres_search(query, queryset):
+    search_query = SearchQuery(query, config=SEARCH_CONFIG, search_type='websearch')
+    upper_query = query.upper()
+    return queryset.annotate(
+        title_upper=Upper('title'),
+        author_upper=Upper('author'),
+        rank=SearchRank(F('search_vector'), search_query),
+        similarity=Greatest(
+            TrigramSimilarity('title_upper', upper_query),
+            TrigramSimilarity('author_upper', upper_query),
+        ),
+    ).filter(
+        Q(search_vector=search_query)
+        | Q(title__icontains=query)
+        | author_match(query)
+        | Q(title_upper__trigram_similar=upper_query)
+        | Q(author_upper__trigram_similar=upper_query)
+    ).order_by('-rank', '-similarity', 'id')
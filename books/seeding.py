@@ -0,0 +1,158 @@
+import hashlib
+from contextlib import contextmanager
+from itertools import islice
+import random
+import time
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connections, router, transaction
+from .models import Book, Review
+
+"""
+Synthetic catalog for benchmarks (manage.py seed_catalog, manage.py benchmark)
+
+Everything is derived from the seed, so two runs with the same seed and
+counts produce the same rows on any machine, and benchmark numbers of two
+releases are measured against the same data:
+- book number n gets the id book_id(seed, n), a UUID computed from the
+  seed, so reviews can point at books without reading the ids back,
+- titles and authors are picked from WORDS and NAMES by a seeded
+  random.Random; the number in the title keeps (title, author) unique,
+- users are seed-<seed>-<n> with the email seed-<seed>-<n>@example.com and
+  the password PASSWORD, hashed once for all of them (hashing millions of
+  passwords would take days).
+
+bulk_create() sends no signals, so the review aggregates of the books are
+computed afterwards by books/ratings.reconcile() (seed_catalog does that).
+
+Rows are written with bulk_create in batches, one transaction per batch.
+On PostgreSQL synchronous_commit is switched off for each of those
+transactions (SET LOCAL, not for the session: the connection goes back to
+the pool of config/db_pool afterwards), a batch then doesn't wait for its
+WAL flush (a crash can lose the last batches, which doesn't matter for
+generated data).
+"""
+
+WORDS = (
+    'harry potter lord rings hobbit dune foundation gatsby mockingbird '
+    'catcher rye pride prejudice war peace crime punishment odyssey iliad '
+    'hamlet macbeth ulysses dracula frankenstein emma persuasion moby dick '
+    'alchemist hunger games shining stand carrie it misery neuromancer '
+    'solaris ubik beloved rebecca jane eyre wuthering heights middlemarch'
+).split()
+NAMES = (
+    'rowling tolkien herbert asimov fitzgerald lee salinger austen tolstoy '
+    'dostoevsky homer shakespeare joyce stoker shelley melville coelho '
+    'collins king gibson lem dick morrison maurier bronte eliot'
+).split()
+REVIEWS = (
+    'Loved it', 'Could not put it down', 'A classic', 'Overrated',
+    'Slow start but worth it', 'Not for me', 'Read it twice', 'Beautifully written',
+)
+# no stars (a text only review) now and then, mostly good ones
+RATINGS = (None, 1, 2, 3, 3, 4, 4, 4, 5, 5)
+PASSWORD = 'seed-password'
+
+
+def book_id(seed, number):
+    digest = hashlib.md5(('%d:book:%d' % (seed, number)).encode()).digest()
+    return uuid.UUID(bytes=digest, version=4)
+
+
+def username(seed, number):
+    return 'seed-%d-%d' % (seed, number)
+
+
+def email(seed, number):
+    return '%s@example.com' % username(seed, number)
+
+
+def _batches(rows, batch_size):
+    """ one random generator draws every row in order, batching doesn't change them """
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+@contextmanager
+def _batch(model):
+    """ the transaction of one batch, committed without waiting for the WAL flush """
+    using = router.db_for_write(model)
+    with transaction.atomic(using=using):
+        connection = connections[using]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL synchronous_commit TO off')
+        yield
+
+
+def seed_users(count, seed, batch_size=5000):
+    User = get_user_model()
+    password = make_password(PASSWORD)
+    users = (User(username=username(seed, n), email=email(seed, n), password=password) for n in range(count))
+    for batch in _batches(users, batch_size):
+        with _batch(User):
+            User.objects.bulk_create(batch, ignore_conflicts=True)
+    return count
+
+
+def seed_books(count, seed, batch_size=5000):
+    rng = random.Random('%d:books' % seed)
+    books = (
+        Book(
+            id=book_id(seed, n),
+            title='%s %d' % (' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title(), n),
+            author=' '.join(rng.sample(NAMES, 2)).title(),
+            price=Decimal(rng.randint(100, 9999)) / 100,
+        )
+        for n in range(count)
+    )
+    for batch in _batches(books, batch_size):
+        with _batch(Book):
+            Book.objects.resolve_authors(batch)
+            Book.objects.bulk_create(batch, ignore_conflicts=True)
+    return count
+
+
+def seed_reviews(count, books, seed, batch_size=5000):
+    """ count reviews spread over the first `books` books by the users of this seed """
+    User = get_user_model()
+    user_ids = list(
+        User.objects.filter(username__startswith='seed-%d-' % seed).order_by('pk').values_list('pk', flat=True))
+    if not user_ids or not books:
+        return 0
+    rng = random.Random('%d:reviews' % seed)
+    reviews = (
+        Review(
+            book_id=book_id(seed, rng.randrange(books)),
+            author_id=rng.choice(user_ids),
+            review=rng.choice(REVIEWS),
+            rating=rng.choice(RATINGS),
+        )
+        for _ in range(count)
+    )
+    for batch in _batches(reviews, batch_size):
+        with _batch(Review):
+            Review.objects.bulk_create(batch)
+    return count
+
+
+def seed_catalog(books, reviews, users, seed=42, batch_size=5000, log=None):
+    """ users first (reviews need them), then books, then reviews; returns {table: seconds} """
+    timings = {}
+    for name, step in (
+            ('users', lambda: seed_users(users, seed, batch_size)),
+            ('books', lambda: seed_books(books, seed, batch_size)),
+            ('reviews', lambda: seed_reviews(reviews, books, seed, batch_size))):
+        start = time.perf_counter()
+        count = step()
+        timings[name] = time.perf_counter() - start
+        if log:
+            log('%-8s %10d rows in %7.1fs' % (name, count, timings[name]))
+    return timings
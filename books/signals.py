@@ -0,0 +1,57 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from . import autocomplete, ratings
+from .images import IMAGE_ERRORS, ensure_derivatives
+from .cache import bump_catalog_version
+from .models import Author, Book, Review
+
+"""
+Signal handlers of the books app, connected in BooksConfig.ready().
+https://docs.djangoproject.com/en/3.1/topics/signals/
+"""
+
+
+@receiver(post_save, sender=Book)
+def book_saved(sender, instance, **kwargs):
+    autocomplete.book_saved(instance)
+    if instance.cover:
+        # resized thumbnails of a new cover, a no-op when they already exist.
+        # A cover Pillow can't read is left alone, {% cover_picture %} then
+        # falls back to the original file.
+        try:
+            ensure_derivatives(instance.cover)
+        except IMAGE_ERRORS:
+            pass
+    bump_catalog_version()
+
+
+@receiver(post_delete, sender=Book)
+def book_deleted(sender, instance, **kwargs):
+    autocomplete.book_deleted(instance)
+    bump_catalog_version()
+
+
+# author names are on the author pages and in the cached facets
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+def author_changed(sender, instance, **kwargs):
+    bump_catalog_version()
+
+
+# review_changed() moves the book's aggregates and bumps its version: the
+# cached reviews block of the book is keyed on it
+@receiver(post_save, sender=Review)
+def review_saved(sender, instance, created, **kwargs):
+    if created:
+        ratings.review_changed(instance.book_id, reviews=1, new_rating=instance.rating)
+    else:
+        ratings.review_changed(
+            instance.book_id, old_rating=getattr(instance, '_stored_rating', None), new_rating=instance.rating)
+    bump_catalog_version()
+
+
+@receiver(post_delete, sender=Review)
+def review_deleted(sender, instance, **kwargs):
+    ratings.review_changed(
+        instance.book_id, reviews=-1, old_rating=getattr(instance, '_stored_rating', instance.rating))
+    bump_catalog_version()
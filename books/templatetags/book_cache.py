@@ -0,0 +1,81 @@
+import hashlib
+
+from django import template
+from django.conf import settings
+from django.core.cache import cache
+from books.cache import record_fragment
+
+"""
+Versioned fragment caching for the parts of a page that belong to one book.
+
+    {% load book_cache %}
+    {% bookcache 'row' book %} ... {% endbookcache %}
+
+It works like Django's {% cache %} tag, but the key is built from the book's
+primary key and its version (Book.version is bumped whenever the book is
+saved or one of its reviews changes). Unchanged books are served from the
+cache, an edited book gets a new key and is re-rendered at once, nothing has
+to be deleted. Any extra arguments are added to the key, e.g. a page cursor.
+
+{% prefetch_bookcache 'row' book_list %} fetches the fragments of a whole
+list with one get_many() instead of one cache round trip per book.
+"""
+
+register = template.Library()
+
+PREFETCH_KEY = 'book_cache_prefetched'
+
+
+def fragment_key(name, book, extra=()):
+    vary = hashlib.md5(':'.join(str(value) for value in extra).encode()).hexdigest()
+    return 'bookfrag:%s:%s:%s:%s' % (name, book.pk, book.version, vary)
+
+
+class BookCacheNode(template.Node):
+
+    def __init__(self, nodelist, name, book, extra):
+        self.nodelist = nodelist
+        self.name = name
+        self.book = book
+        self.extra = extra
+
+    def render(self, context):
+        key = fragment_key(
+            self.name.resolve(context),
+            self.book.resolve(context),
+            [value.resolve(context) for value in self.extra],
+        )
+        prefetched = context.render_context.get(PREFETCH_KEY, {})
+        content = prefetched[key] if key in prefetched else cache.get(key)
+        if content is None:
+            record_fragment(hit=False)
+            content = self.nodelist.render(context)
+            cache.set(key, content, getattr(settings, 'FRAGMENT_CACHE_SECONDS', 86400))
+        else:
+            record_fragment(hit=True)
+        return content
+
+
+@register.tag
+def bookcache(parser, token):
+    bits = token.split_contents()
+    if len(bits) < 3:
+        raise template.TemplateSyntaxError(
+            "'%s' takes at least two arguments: a fragment name and a book." % bits[0])
+    nodelist = parser.parse(('endbookcache',))
+    parser.delete_first_token()
+    return BookCacheNode(
+        nodelist,
+        parser.compile_filter(bits[1]),
+        parser.compile_filter(bits[2]),
+        [parser.compile_filter(bit) for bit in bits[3:]],
+    )
+
+
+@register.simple_tag(takes_context=True)
+def prefetch_bookcache(context, name, books):
+    keys = [fragment_key(name, book) for book in books]
+    found = cache.get_many(keys)
+    prefetched = context.render_context.setdefault(PREFETCH_KEY, {})
+    prefetched.update((key, found.get(key)) for key in keys)
+    return ''
@@ -0,0 +1,37 @@
+from django import template
+from django.utils.html import format_html
+from books.images import IMAGE_ERRORS, ensure_derivatives, derivative_name, srcset
+
+"""
+{% load book_covers %}
+{% cover_picture book %}
+
+Renders the cover of a book as a <picture> with WebP and JPEG srcsets of the
+resized derivatives (books/images.py) instead of the full size upload.
+sizes tells the browser how wide the image is displayed (.bookcover in
+static/css/base.css is 300px high, covers are about 2:3) so it can pick the
+right file for its screen density.
+"""
+
+register = template.Library()
+
+
+@register.simple_tag
+def cover_picture(book, css_class='bookcover', sizes='200px'):
+    if not book.cover:
+        return ''
+    try:
+        widths = ensure_derivatives(book.cover)
+    except IMAGE_ERRORS:
+        # missing or unreadable original: show whatever there is
+        return format_html('<img class="{}" src="{}" alt="{}">', css_class, book.cover.url, book.title)
+    fallback = book.cover.storage.url(
+        derivative_name(book.cover.name, widths[len(widths) // 2], 'jpg'))
+    return format_html(
+        '<picture>'
+        '<source type="image/webp" srcset="{}" sizes="{}">'
+        '<img class="{}" src="{}" srcset="{}" sizes="{}" alt="{}" loading="lazy">'
+        '</picture>',
+        srcset(book.cover, widths, 'webp'), sizes,
+        css_class, fallback, srcset(book.cover, widths, 'jpg'), sizes, book.title,
+    )
@@ -1,8 +1,28 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+
+from PIL import Image
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.template import Context, Template
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from .models import Book, Review
+from django.utils import timezone
+from . import autocomplete
+from .cache import catalog_version, fragment_stats, record_fragment
+from .images import derivative_name, ensure_derivatives
+from .models import Author, Book, Review, author_sort_name
 
 """
 we want to test both ListView and DetailView.
@@ -93,3 +113,795 @@ class BookTests(TestCase):
         # test that the book object contains the correct review.
         self.assertContains(response, 'An excellent review')
         self.assertTemplateUsed(response, 'books/book_detail.html')
+
+
+class BookListPaginationTests(TestCase):
+    """
+    The book list is keyset paginated: walk every page forwards and then
+    backwards again and make sure no book is skipped or shown twice.
+    """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='pageuser',
+            email='pageuser@email.com',
+            password='testpass123'
+        )
+        for number in range(45):
+            Book.objects.create(
+                title='Book %02d' % number,
+                author='Author %d' % (number % 3),
+                price='%d.00' % (number % 7),
+            )
+        self.client.login(email='pageuser@email.com', password='testpass123')
+
+    def walk(self, sort):
+        titles, pages, cursor = [], [], None
+        while True:
+            url = reverse('book_list') + '?sort=%s' % sort
+            response = self.client.get(url + ('&cursor=%s' % cursor if cursor else ''))
+            self.assertEqual(response.status_code, 200)
+            page = response.context['page_obj']
+            pages.append(page)
+            titles.extend(book.title for book in page)
+            if not page.has_next():
+                return titles, pages
+            cursor = page.next_cursor
+
+    def test_pages_cover_every_book_once(self):
+        for sort, key in (('title', 'title'), ('author', 'author'), ('price', 'price')):
+            titles, pages = self.walk(sort)
+            self.assertEqual(len(pages), 3)
+            self.assertEqual(len(titles), 45)
+            self.assertEqual(
+                titles, list(Book.objects.order_by(key, 'id').values_list('title', flat=True)))
+
+    def test_previous_cursor_returns_the_previous_page(self):
+        first = self.client.get(reverse('book_list')).context['page_obj']
+        self.assertFalse(first.has_previous())
+        second = self.client.get(
+            reverse('book_list') + '?cursor=' + first.next_cursor).context['page_obj']
+        back = self.client.get(
+            reverse('book_list') + '?cursor=' + second.previous_cursor).context['page_obj']
+        self.assertEqual(list(back), list(first))
+        self.assertFalse(back.has_previous())
+
+    def test_invalid_cursor_returns_404(self):
+        response = self.client.get(reverse('book_list') + '?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+        # a cursor made for one ordering can't be used with another one
+        first = self.client.get(reverse('book_list') + '?sort=price').context['page_obj']
+        response = self.client.get(
+            reverse('book_list') + '?sort=title&cursor=' + first.next_cursor)
+        self.assertEqual(response.status_code, 404)
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+        Book.objects.create(title='The Hobbit', author='JRR Tolkien', price='15.00')
+
+    def test_search_by_title_and_author(self):
+        response = self.client.get(reverse('search_results'), {'q': 'potter'})
+        self.assertContains(response, 'Harry Potter')
+        self.assertNotContains(response, 'The Hobbit')
+        response = self.client.get(reverse('search_results'), {'q': 'tolkien'})
+        self.assertContains(response, 'The Hobbit')
+
+    # a missing ?q= used to crash (icontains=None) or match every book
+    def test_missing_query_matches_nothing(self):
+        for params in ({}, {'q': '   '}):
+            response = self.client.get(reverse('search_results'), params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(list(response.context['book_list']), [])
+
+
+class AutocompleteTests(TestCase):
+
+    def setUp(self):
+        autocomplete.reset_index()
+        self.book = Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+        Book.objects.create(title='The Hobbit', author='JRR Tolkien', price='15.00')
+
+    def test_prefix_of_any_word_matches(self):
+        for prefix in ('harr', 'pot', 'rowl', 'Harry P'):
+            response = self.client.get(reverse('book_autocomplete'), {'q': prefix})
+            self.assertEqual(
+                [result['title'] for result in response.json()['results']], ['Harry Potter'])
+
+    def test_answered_from_memory(self):
+        autocomplete.get_index()
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('book_autocomplete'), {'q': 'hob'})
+        self.assertEqual(response.json()['results'][0]['url'], reverse('book_detail', args=[
+            Book.objects.get(title='The Hobbit').pk]))
+
+    # exact titles first, then title matches, then the most reviewed books
+    def test_matches_are_ranked_before_the_limit(self):
+        index = autocomplete.PrefixIndex()
+        index.bulk_load([
+            (1, 'Harry and the Hens', 'A Writer', 0),
+            (2, 'Harry Potter', 'JK Rowling', 50),
+            (3, 'Gardening', 'Harry Smith', 900),
+            (4, 'Harry', 'Some Author', 0),
+        ])
+        self.assertEqual([title for book_id, title, author in index.search('harry', limit=3)],
+                         ['Harry', 'Harry Potter', 'Harry and the Hens'])
+        self.assertEqual(index.search('harry', limit=1)[0][1], 'Harry')
+
+
+# TestCase never commits, these tests need the on_commit updates of the index
+class AutocompleteCommitTests(TransactionTestCase):
+
+    def setUp(self):
+        autocomplete.reset_index()
+        self.book = Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+
+    def test_index_follows_saves_and_deletes(self):
+        index = autocomplete.get_index()
+        self.book.title = 'Fantastic Beasts'
+        self.book.save()
+        self.assertEqual(index.search('harry'), [])
+        self.assertEqual(index.search('fant')[0][1], 'Fantastic Beasts')
+        self.book.delete()
+        self.assertEqual(index.search('fant'), [])
+
+    # a rolled back book would be a 404 link in the results
+    def test_rolled_back_save_is_not_indexed(self):
+        index = autocomplete.get_index()
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                Book.objects.create(title='Harry Hole', author='Jo Nesbo', price='10.00')
+                raise ValueError
+        self.assertEqual([title for book_id, title, author in index.search('harry')], ['Harry Potter'])
+        with transaction.atomic():
+            Book.objects.create(title='Harry Hole', author='Jo Nesbo', price='10.00')
+            self.assertEqual(len(index.search('harry')), 1)
+        self.assertEqual(len(index.search('harry')), 2)
+
+
+class BookReviewsTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='reviewuser',
+            email='reviewuser@email.com',
+            password='testpass123'
+        )
+        self.user.user_permissions.add(Permission.objects.get(codename='special_status'))
+        self.book = Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+        self.client.login(email='reviewuser@email.com', password='testpass123')
+
+    def add_reviews(self, count):
+        start = Review.objects.count()
+        for number in range(start, start + count):
+            reviewer = get_user_model().objects.create_user(
+                username='reader%d' % number, email='reader%d@email.com' % number)
+            Review.objects.create(book=self.book, author=reviewer, review='Review %d' % number)
+
+    def count_queries(self):
+        cache.clear()  # measure the view, not the page cache
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.book.get_absolute_url())
+        return len(queries)
+
+    # the number of queries must not grow with the number of reviews (no N+1)
+    def test_detail_view_query_count_is_constant(self):
+        self.add_reviews(1)
+        few = self.count_queries()
+        self.add_reviews(15)
+        self.assertEqual(self.count_queries(), few)
+
+    def test_reviews_are_paginated_with_fragments(self):
+        self.add_reviews(45)
+        response = self.client.get(self.book.get_absolute_url())
+        reviews = response.context['reviews']
+        self.assertEqual(len(reviews), 20)
+        self.assertContains(response, 'Load more reviews')
+        seen = [review.review for review in reviews]
+        cursor = reviews.next_cursor
+        while cursor:
+            fragment = self.client.get(
+                reverse('book_reviews', args=[self.book.pk]) + '?cursor=' + cursor)
+            self.assertTemplateUsed(fragment, 'books/_reviews.html')
+            self.assertNotContains(fragment, '<html')
+            page = fragment.context['reviews']
+            seen.extend(review.review for review in page)
+            cursor = page.next_cursor
+        self.assertEqual(seen, ['Review %d' % number for number in range(45)])
+
+    def test_fragment_requires_permission(self):
+        self.user.user_permissions.clear()
+        response = self.client.get(reverse('book_reviews', args=[self.book.pk]))
+        self.assertEqual(response.status_code, 403)
+
+    def test_fragment_of_unknown_book_is_404(self):
+        url = reverse('book_reviews', args=[self.book.pk])
+        self.book.delete()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+# the site cache is turned off so that we look at the fragments only
+@override_settings(CACHE_MIDDLEWARE_SECONDS=0)
+class FragmentCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            username='fraguser', email='fraguser@email.com', password='testpass123')
+        self.user.user_permissions.add(Permission.objects.get(codename='special_status'))
+        self.book = Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+        self.client.login(email='fraguser@email.com', password='testpass123')
+
+    def render_detail(self):
+        return self.client.get(self.book.get_absolute_url())
+
+    def test_unchanged_book_is_served_from_fragments(self):
+        before = fragment_stats()
+        self.render_detail()
+        middle = fragment_stats()
+        self.assertEqual(middle['misses'] - before['misses'], 2)
+        self.render_detail()
+        after = fragment_stats()
+        self.assertEqual(after['hits'] - middle['hits'], 2)
+
+    # gthread workers and the ASGI executor count from several threads
+    def test_stats_are_thread_safe(self):
+        before = fragment_stats()
+
+        def count():
+            for _ in range(1000):
+                record_fragment(hit=True)
+        threads = [threading.Thread(target=count) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(fragment_stats()['hits'] - before['hits'], 8000)
+
+    def test_edits_and_reviews_bump_the_version(self):
+        self.render_detail()
+        self.book.price = '30.00'
+        self.book.save()
+        self.assertContains(self.render_detail(), '30.00')
+        Review.objects.create(book=self.book, author=self.user, review='A new review')
+        self.assertContains(self.render_detail(), 'A new review')
+
+    def test_stale_instance_and_update_fields_bump_the_version(self):
+        stale = Book.objects.get(pk=self.book.pk)
+        Review.objects.create(book=self.book, author=self.user, review='A new review')
+        self.render_detail()  # header cached under the version the review set
+        stale.title = 'Harry Potter and the Philosopher\'s Stone'
+        stale.save()
+        self.assertEqual(stale.version, 3)
+        self.assertContains(self.render_detail(), 'Philosopher')
+        stale.price = '30.00'
+        stale.save(update_fields=['price'])
+        self.assertEqual(Book.objects.get(pk=self.book.pk).version, 4)
+        self.assertContains(self.render_detail(), '30.00')
+
+
+class CoverDerivativeTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, width, height):
+        buffer = BytesIO()
+        Image.new('RGB', (width, height), 'red').save(buffer, 'JPEG')
+        return SimpleUploadedFile('cover.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+    def test_derivatives_are_generated_on_upload(self):
+        book = Book.objects.create(
+            title='Harry Potter', author='JK Rowling', price='25.00', cover=self.upload(1000, 1500))
+        for width in (160, 320, 640):
+            for extension in ('webp', 'jpg'):
+                name = derivative_name(book.cover.name, width, extension)
+                self.assertTrue(book.cover.storage.exists(name), name)
+        with book.cover.storage.open(derivative_name(book.cover.name, 320, 'webp')) as thumb:
+            self.assertEqual(Image.open(thumb).size, (320, 480))
+
+    # an oversized upload is saved all the same, it just gets no derivatives
+    def test_decompression_bomb_does_not_fail_the_save(self):
+        with mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 1000):
+            book = Book.objects.create(
+                title='Harry Potter', author='JK Rowling', price='25.00', cover=self.upload(100, 100))
+        self.assertTrue(Book.objects.filter(pk=book.pk).exists())
+        self.assertFalse(book.cover.storage.exists(derivative_name(book.cover.name, 100, 'jpg')))
+
+    def test_small_covers_are_not_scaled_up(self):
+        book = Book.objects.create(
+            title='Harry Potter', author='JK Rowling', price='25.00', cover=self.upload(200, 300))
+        self.assertEqual(ensure_derivatives(book.cover), [160, 200])
+
+    def test_cover_as_wide_as_the_largest_width_gets_all(self):
+        book = Book.objects.create(
+            title='Harry Potter', author='JK Rowling', price='25.00', cover=self.upload(640, 960))
+        self.assertEqual(ensure_derivatives(book.cover), [160, 320, 640])
+
+    def test_template_renders_srcset(self):
+        book = Book.objects.create(
+            title='Harry Potter', author='JK Rowling', price='25.00', cover=self.upload(1000, 1500))
+        html = Template('{% load book_covers %}{% cover_picture book %}').render(Context({'book': book}))
+        self.assertIn('type="image/webp"', html)
+        self.assertIn(derivative_name(book.cover.url, 640, 'webp') + ' 640w', html)
+        self.assertIn(derivative_name(book.cover.url, 160, 'jpg') + ' 160w', html)
+
+
+class ImportBooksTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_csv_import_upserts_on_title_and_author(self):
+        Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+        path = self.write('books.csv', (
+            'title,author,price\n'
+            'Harry Potter,JK Rowling,19.99\n'
+            'The Hobbit,JRR Tolkien,15.00\n'
+            ',Nobody,1.00\n'
+            'Dune,Frank Herbert,not-a-price\n'
+        ))
+        out, err = StringIO(), StringIO()
+        call_command('import_books', path, batch_size=2, stdout=out, stderr=err)
+        self.assertIn('1 created, 1 updated, 2 rejected', out.getvalue())
+        self.assertEqual(Book.objects.count(), 2)
+        self.assertEqual(str(Book.objects.get(title='Harry Potter').price), '19.99')
+        self.assertFalse(os.path.exists(path + '.import-state'))
+
+    def test_jsonl_import_and_resume(self):
+        lines = ['{"title": "Book %d", "author": "Author", "price": "%d.00"}' % (n, n) for n in range(10)]
+        path = self.write('books.jsonl', '\n'.join(lines) + '\n')
+        # pretend a previous run died after committing the first 6 rows
+        with open(path + '.import-state', 'w') as f:
+            json.dump({'path': os.path.abspath(path), 'rows': 6}, f)
+        call_command('import_books', path, resume=True, stdout=StringIO())
+        self.assertEqual(
+            sorted(Book.objects.values_list('title', flat=True)), ['Book 6', 'Book 7', 'Book 8', 'Book 9'])
+
+    def test_import_attaches_covers(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        covers = os.path.join(self.directory, 'covers')
+        os.mkdir(covers)
+        Image.new('RGB', (20, 30)).save(os.path.join(covers, 'hp.jpg'))
+        path = self.write('books.csv', 'title,author,price,cover\nHarry Potter,JK Rowling,25.00,hp.jpg\n')
+        with override_settings(MEDIA_ROOT=media_root):
+            call_command('import_books', path, covers=covers, stdout=StringIO())
+            book = Book.objects.get()
+            self.assertEqual(book.cover.name, 'covers/hp.jpg')
+            self.assertTrue(book.cover.storage.exists('covers/hp.jpg'))
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        self.staff = get_user_model().objects.create_user(
+            username='staff', email='staff@email.com', password='testpass123', is_staff=True)
+        self.book = Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+        Review.objects.create(book=self.book, author=self.staff, review='An excellent review')
+
+    def test_staff_gets_streamed_csv(self):
+        self.client.login(email='staff@email.com', password='testpass123')
+        response = self.client.get(reverse('book_export', args=['books', 'csv']))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,title,author,price,cover')
+        self.assertEqual(lines[1], '%s,Harry Potter,JK Rowling,25.00,' % self.book.pk)
+
+    def test_reviews_as_jsonl(self):
+        self.client.login(email='staff@email.com', password='testpass123')
+        response = self.client.get(reverse('book_export', args=['reviews', 'jsonl']))
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(rows[0]['book__title'], 'Harry Potter')
+        self.assertEqual(rows[0]['author__email'], 'staff@email.com')
+
+    def test_export_is_staff_only(self):
+        get_user_model().objects.create_user(
+            username='reader', email='reader@email.com', password='testpass123')
+        self.client.login(email='reader@email.com', password='testpass123')
+        self.assertEqual(self.client.get(reverse('book_export', args=['books', 'csv'])).status_code, 403)
+        self.client.login(email='staff@email.com', password='testpass123')
+        self.assertEqual(self.client.get(reverse('book_export', args=['users', 'csv'])).status_code, 404)
+
+    def test_export_books_command(self):
+        out, err = StringIO(), StringIO()
+        call_command('export_books', format='jsonl', stdout=out, stderr=err)
+        self.assertEqual(json.loads(out.getvalue())['title'], 'Harry Potter')
+        self.assertIn('exported 1 books', err.getvalue())
+
+
+class ApiTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='reader', email='reader@email.com', password='testpass123')
+        self.user.user_permissions.add(Permission.objects.get(codename='special_status'))
+        self.client.login(email='reader@email.com', password='testpass123')
+        self.book = Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+        Review.objects.create(book=self.book, author=self.user, review='An excellent review', rating=4)
+
+    def test_list_with_sparse_fields(self):
+        response = self.client.get(reverse('api_book_list'), {'fields': 'title,price'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'], [{'title': 'Harry Potter', 'price': '25.00'}])
+        response = self.client.get(reverse('api_book_list'), {'fields': 'title,isbn'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_list_paginates_with_cursor(self):
+        for number in range(25):
+            Book.objects.create(title='Book %02d' % number, author='Author', price='1.00')
+        first = self.client.get(reverse('api_book_list'), {'fields': 'title'}).json()
+        self.assertEqual(len(first['results']), 20)
+        second = self.client.get(first['next']).json()
+        self.assertEqual([book['title'] for book in second['results']][-1], 'Harry Potter')
+        self.assertIsNone(second['next'])
+
+    def test_list_not_modified(self):
+        response = self.client.get(reverse('api_book_list'))
+        with CaptureQueriesContext(connection) as queries:
+            not_modified = self.client.get(
+                reverse('api_book_list'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        # only the session and user lookups, the catalog is not read
+        self.assertFalse([query for query in queries if 'books_book' in query['sql']])
+        self.assertEqual(not_modified.content, b'')
+        Book.objects.create(title='The Hobbit', author='JRR Tolkien', price='15.00')
+        changed = self.client.get(reverse('api_book_list'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+
+    def test_detail_with_reviews_and_etag(self):
+        url = reverse('api_book_detail', args=[self.book.pk])
+        response = self.client.get(url)
+        data = response.json()
+        self.assertEqual(data['title'], 'Harry Potter')
+        self.assertEqual(data['reviews'][0], {
+            'id': self.book.reviews.get().id, 'author': 'reader', 'review': 'An excellent review', 'rating': 4})
+        self.assertEqual((data['review_count'], data['rating_avg']), (1, 4.0))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        Review.objects.create(book=self.book, author=self.user, review='Another one')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_detail_last_modified_is_the_book_s(self):
+        url = reverse('api_book_detail', args=[self.book.pk])
+        Book.objects.filter(pk=self.book.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+        since = self.client.get(url)['Last-Modified']
+        # another book changing doesn't touch this one
+        Book.objects.create(title='The Hobbit', author='JRR Tolkien', price='15.00')
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=since).status_code, 304)
+        self.book.price = '20.00'
+        self.book.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=since).status_code, 200)
+
+    def test_detail_requires_permission(self):
+        self.user.user_permissions.clear()
+        response = self.client.get(reverse('api_book_detail', args=[self.book.pk]))
+        self.assertEqual(response.status_code, 403)
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('api_book_list')).status_code, 403)
+
+    def test_search(self):
+        response = self.client.get(reverse('api_search'), {'q': 'potter', 'fields': 'title,url'})
+        self.assertEqual(response.json()['results'], [{
+            'title': 'Harry Potter', 'url': reverse('api_book_detail', args=[self.book.pk])}])
+
+
+
+class ConditionalPageTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            username='reader', email='reader@email.com', password='testpass123')
+        self.user.user_permissions.add(Permission.objects.get(codename='special_status'))
+        self.client.login(email='reader@email.com', password='testpass123')
+        self.book = Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+
+    def test_list_not_modified(self):
+        response = self.client.get(reverse('book_list'))
+        self.assertEqual(response['Cache-Control'], 'max-age=0')
+        self.assertIn('Last-Modified', response)
+        with CaptureQueriesContext(connection) as queries:
+            not_modified = self.client.get(reverse('book_list'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, b'')
+        self.assertFalse([query for query in queries if 'books_' in query['sql']])
+        Book.objects.create(title='The Hobbit', author='JRR Tolkien', price='15.00')
+        changed = self.client.get(reverse('book_list'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertContains(changed, 'The Hobbit')
+
+    def test_etag_is_per_user(self):
+        url = reverse('search_results')
+        etag = self.client.get(url, {'q': 'potter'})['ETag']
+        self.client.logout()
+        response = self.client.get(url, {'q': 'potter'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'Harry Potter')
+        self.assertNotEqual(response['ETag'], etag)
+        # the anonymous page itself, from the view and from the site cache
+        for number in range(2):
+            self.assertEqual(self.client.get(
+                url, {'q': 'potter'}, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        # logged out the list redirects to the login page, an ETag changes nothing
+        list_etag = '"%s"' % ('0' * 32)
+        self.assertEqual(self.client.get(reverse('book_list'), HTTP_IF_NONE_MATCH=list_etag).status_code, 302)
+
+    def test_detail_follows_reviews_and_permission(self):
+        url = self.book.get_absolute_url()
+        response = self.client.get(url)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        updated_at = Book.objects.get(pk=self.book.pk).updated_at
+        review = Review.objects.create(book=self.book, author=self.user, review='An excellent review')
+        self.assertGreater(Book.objects.get(pk=self.book.pk).updated_at, updated_at)
+        self.assertIsNotNone(review.created_at)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertContains(response, 'An excellent review')
+        self.user.user_permissions.clear()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 403)
+
+    def test_save_with_update_fields_moves_updated_at(self):
+        updated_at = self.book.updated_at
+        self.book.price = '20.00'
+        self.book.save(update_fields=['price'])
+        self.assertGreater(Book.objects.get(pk=self.book.pk).updated_at, updated_at)
+
+class RatingTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='rater', email='rater@email.com', password='testpass123')
+        self.book = Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+        self.other = Book.objects.create(title='The Hobbit', author='JRR Tolkien', price='15.00')
+
+    def review(self, book, rating):
+        return Review.objects.create(book=book, author=self.user, review='Review', rating=rating)
+
+    def aggregates(self, book):
+        book.refresh_from_db()
+        return book.review_count, book.rating_count, book.rating_sum, book.rating_avg
+
+    def test_aggregates_follow_reviews(self):
+        first = self.review(self.book, 5)
+        self.review(self.book, 2)
+        self.review(self.book, None)
+        self.assertEqual(self.aggregates(self.book), (3, 2, 7, 3.5))
+        first.rating = 3
+        first.save()
+        self.assertEqual(self.aggregates(self.book), (3, 2, 5, 2.5))
+        first.delete()
+        self.assertEqual(self.aggregates(self.book), (2, 1, 2, 2.0))
+        Review.objects.filter(book=self.book).delete()
+        self.assertEqual(self.aggregates(self.book), (0, 0, 0, 0.0))
+
+    def test_saving_a_stale_book_keeps_the_aggregates(self):
+        stale = Book.objects.get(pk=self.book.pk)
+        self.review(self.book, 4)
+        stale.price = '20.00'
+        stale.save()
+        self.assertEqual(self.aggregates(self.book), (1, 1, 4, 4.0))
+        self.assertEqual(str(self.book.price), '20.00')
+
+    def test_reconcile_repairs_drift(self):
+        self.review(self.book, 4)
+        Review.objects.bulk_create([
+            Review(book=self.other, author=self.user, review='Bulk', rating=rating) for rating in (1, 2)])
+        Book.objects.filter(pk=self.book.pk).update(review_count=9)
+        out = StringIO()
+        call_command('reconcile_ratings', dry_run=True, stdout=out)
+        self.assertIn('2 books checked, 2 drifted', out.getvalue())
+        self.assertEqual(self.aggregates(self.book)[0], 9)
+        call_command('reconcile_ratings', batch_size=1, stdout=out)
+        self.assertEqual(self.aggregates(self.book), (1, 1, 4, 4.0))
+        self.assertEqual(self.aggregates(self.other), (2, 2, 3, 1.5))
+
+    def test_top_rated_listing_reads_only_books(self):
+        self.review(self.book, 3)
+        self.review(self.other, 5)
+        self.user.user_permissions.add(Permission.objects.get(codename='special_status'))
+        self.client.login(email='rater@email.com', password='testpass123')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('book_list'), {'sort': 'rating'})
+        self.assertNotIn('books_review', ' '.join(query['sql'] for query in queries))
+        self.assertEqual([book.title for book in response.context['book_list']], ['The Hobbit', 'Harry Potter'])
+        self.assertContains(response, '&#9733; 5.0 &middot; 1 review')
+        data = self.client.get(reverse('api_book_list'), {'sort': 'reviews', 'fields': 'title,review_count'}).json()
+        self.assertEqual(data['results'][0]['review_count'], 1)
+
+
+class FacetTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            username='browser', email='browser@email.com', password='testpass123')
+        self.client.login(email='browser@email.com', password='testpass123')
+        for title, author, price in (
+                ('Harry Potter', 'JK Rowling', '25.00'), ('Casual Vacancy', 'JK Rowling', '8.00'),
+                ('The Hobbit', 'JRR Tolkien', '15.00'), ('Silmarillion', 'JRR Tolkien', '60.00'),
+                ('Dune', 'Frank Herbert', '9.50')):
+            Book.objects.create(title=title, author=author, price=price)
+
+    def facet(self, response, name):
+        return {item['label']: item['count'] for item in response.context['facets'][name]}
+
+    def titles(self, response):
+        return [book.title for book in response.context['book_list']]
+
+    def test_filters_and_counts(self):
+        response = self.client.get(reverse('book_list'))
+        self.assertEqual(self.facet(response, 'author'), {'JK Rowling': 2, 'JRR Tolkien': 2, 'Frank Herbert': 1})
+        self.assertEqual(self.facet(response, 'price'), {
+            'Under $10': 2, '$10 to $25': 1, '$25 to $50': 1, '$50 and more': 1})
+
+        rowling = Author.objects.get(name='JK Rowling')
+        response = self.client.get(reverse('book_list'), {'author': rowling.pk})
+        self.assertEqual(self.titles(response), ['Casual Vacancy', 'Harry Potter'])
+        self.assertEqual(self.facet(response, 'price'), {
+            'Under $10': 1, '$10 to $25': 0, '$25 to $50': 1, '$50 and more': 0})
+        self.assertContains(response, 'href="?author=%d&amp;sort=price"' % rowling.pk)
+        # an unknown author id is no filter
+        response = self.client.get(reverse('book_list'), {'author': '999999999999999999999'})
+        self.assertEqual(len(self.titles(response)), 5)
+
+        response = self.client.get(reverse('book_list'), {'price': 'under-10', 'sort': 'price'})
+        self.assertEqual(self.titles(response), ['Casual Vacancy', 'Dune'])
+        self.assertEqual(self.facet(response, 'author'), {'JK Rowling': 1, 'Frank Herbert': 1})
+        # the selected band links back to the unfiltered list
+        selected = [item for item in response.context['facets']['price'] if item['selected']]
+        self.assertEqual(selected[0]['url'], '?sort=price')
+
+    def test_counts_are_cached_per_catalog_version(self):
+        self.client.get(reverse('book_list'))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('book_list'), {'price': '50-plus'})
+        self.assertFalse([query for query in queries if 'GROUP BY' in query['sql']])
+        Book.objects.create(title='Emma', author='Jane Austen', price='55.00')
+        response = self.client.get(reverse('book_list'), {'price': '50-plus'})
+        self.assertEqual(self.facet(response, 'price')['$50 and more'], 2)
+
+
+class AuthorTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='reader', email='reader@email.com', password='testpass123')
+        self.client.login(email='reader@email.com', password='testpass123')
+
+    def test_spellings_of_a_name_share_one_author(self):
+        self.assertEqual(author_sort_name('J.K. Rowling'), 'rowling jk')
+        self.assertEqual(author_sort_name('Rowling,  J. K.'), 'rowling j k')
+        self.assertEqual(author_sort_name('Émile Zola'), 'zola emile')
+        first = Book.objects.create(title='Harry Potter', author='J.K. Rowling', price='25.00')
+        second = Book.objects.create(title='Casual Vacancy', author='Rowling, JK', price='8.00')
+        self.assertEqual(first.written_by_id, second.written_by_id)
+        self.assertEqual(first.written_by.name, 'J.K. Rowling')
+
+        # renaming the author moves the book, saving anything else doesn't look it up
+        second.author = 'Robert Galbraith'
+        second.save()
+        self.assertEqual(Book.objects.get(pk=second.pk).written_by.name, 'Robert Galbraith')
+        book = Book.objects.get(pk=first.pk)
+        book.price = '20.00'
+        with CaptureQueriesContext(connection) as queries:
+            book.save()
+        self.assertFalse([query for query in queries if 'books_author' in query['sql']])
+
+    def test_renamed_author_is_found_by_the_new_name(self):
+        book = Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+        author = book.written_by
+        version = catalog_version()
+        author.name = 'Robert Galbraith'
+        author.save()
+        self.assertGreater(catalog_version(), version)
+        self.assertEqual(author.sort_name, 'galbraith robert')
+        other = Book.objects.create(title='The Cuckoo', author='Robert Galbraith', price='9.00')
+        self.assertEqual(other.written_by_id, author.pk)
+
+    def test_renaming_to_an_existing_author_merges(self):
+        first = Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+        second = Book.objects.create(title='The Cuckoo', author='Robert Galbraith', price='9.00')
+        author = first.written_by
+        author.name = 'Galbraith, Robert'
+        author.save()
+        self.assertEqual(author.pk, second.written_by_id)
+        self.assertEqual(Author.objects.get().name, 'Galbraith, Robert')
+        first = Book.objects.get(pk=first.pk)
+        self.assertEqual((first.written_by_id, first.version), (author.pk, 2))
+
+    def test_backfill_migration(self):
+        from importlib import import_module
+        from types import SimpleNamespace
+        from django.apps import apps
+        migration = import_module('books.migrations.0014_book_written_by_backfill')
+        for number in range(5):
+            Book.objects.create(title='Book %d' % number, author='JRR Tolkien' if number % 2 else 'Tolkien, J.R.R.',
+                                price='10.00')
+        Book.objects.update(written_by=None)
+        Author.objects.all().delete()
+        migration.BATCH_SIZE, batch_size = 2, migration.BATCH_SIZE
+        try:
+            migration.fill_written_by(apps, SimpleNamespace(connection=connection))
+        finally:
+            migration.BATCH_SIZE = batch_size
+        self.assertEqual(Author.objects.count(), 1)
+        self.assertFalse(Book.objects.filter(written_by=None).exists())
+
+    def test_author_page_paginates_the_bibliography(self):
+        for number in range(25):
+            Book.objects.create(title='Volume %02d' % number, author='Terry Pratchett', price='10.00')
+        Book.objects.create(title='Dune', author='Frank Herbert', price='9.50')
+        author = Author.objects.get(name='Terry Pratchett')
+        response = self.client.get(author.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        books = response.context['books']
+        self.assertEqual([book.title for book in books], ['Volume %02d' % number for number in range(20)])
+        response = self.client.get(author.get_absolute_url(), {'cursor': books.next_cursor})
+        self.assertEqual([book.title for book in response.context['books']],
+                         ['Volume %02d' % number for number in range(20, 25)])
+        self.assertNotContains(response, 'Dune')
+
+        self.client.logout()
+        response = self.client.get(author.get_absolute_url())
+        self.assertEqual(response.status_code, 302)
+
+    def test_search_matches_author_spellings(self):
+        Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+        Book.objects.create(title='The Hobbit', author='JRR Tolkien', price='15.00')
+        for query in ('rowling', 'Rowling, J.K.', 'j.k. rowling'):
+            response = self.client.get(reverse('search_results'), {'q': query})
+            self.assertEqual([book.title for book in response.context['book_list']], ['Harry Potter'])
+        response = self.client.get(reverse('search_results'), {'q': '.'})
+        self.assertEqual(list(response.context['book_list']), [])
+
+
+class SeedAndBenchmarkTests(TestCase):
+
+    def test_seed_catalog_is_deterministic(self):
+        call_command('seed_catalog', books=30, reviews=100, users=5, stdout=StringIO())
+        self.assertEqual(Book.objects.count(), 30)
+        self.assertEqual(Review.objects.count(), 100)
+        self.assertEqual(get_user_model().objects.filter(username__startswith='seed-42-').count(), 5)
+        first = list(Book.objects.order_by('pk').values_list('pk', 'title', 'author', 'price'))
+        with self.assertRaises(CommandError):
+            call_command('seed_catalog', books=30, reviews=0, users=0, stdout=StringIO())
+
+        Book.objects.all().delete()
+        call_command('seed_catalog', books=30, reviews=0, users=0, batch_size=7, stdout=StringIO())
+        self.assertEqual(list(Book.objects.order_by('pk').values_list('pk', 'title', 'author', 'price')), first)
+
+    def test_benchmark_writes_json_and_detects_regressions(self):
+        Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+        path = os.path.join(tempfile.mkdtemp(), 'bench.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        call_command('benchmark', 'home', 'book_detail', requests=5, warmup=1, output=path, stderr=StringIO())
+        with open(path) as f:
+            results = json.load(f)
+        self.assertEqual(results['environment']['books'], 1)
+        self.assertEqual(set(results['scenarios']), {'home', 'book_detail'})
+        detail = results['scenarios']['book_detail']
+        self.assertEqual(detail['errors'], 0)
+        self.assertTrue(0 < detail['p50'] <= detail['p95'] <= detail['p99'] <= detail['max'])
+
+        # a baseline that was impossibly fast
+        for result in results['scenarios'].values():
+            result.update(p95=0.001, throughput=10 ** 9)
+        with open(path, 'w') as f:
+            json.dump(results, f)
+        err = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('benchmark', 'home', requests=5, warmup=1, baseline=path, stderr=err)
+        self.assertIn('REGRESSION home p95', err.getvalue())
@@ -1,8 +1,29 @@
+from django.conf import settings
 from django.urls import path
-from .views import BookListView, BookDetailView, SearchResultsListView 
+from config.executor import async_view
+from .api import BookDetailApiView, BookListApiView, SearchApiView
+from .views import (
+    AuthorDetailView,
+    AutocompleteView,
+    BookDetailView,
+    BookExportView,
+    BookReviewsView,
+    BookListView,
+    SearchResultsListView,
+)
+
+# ASGI mode: async variants of the busiest endpoints, see config/executor.py
+serve = async_view if settings.ASGI else (lambda view: view)
 
 urlpatterns = [
-    path('', BookListView.as_view(), name='book_list'),
+    path('', serve(BookListView.as_view()), name='book_list'),
     path('<uuid:pk>', BookDetailView.as_view(), name='book_detail'),
-    path('search/', SearchResultsListView.as_view(), name='search_results'), 
+    path('<uuid:pk>/reviews/', BookReviewsView.as_view(), name='book_reviews'),
+    path('authors/<int:pk>/', AuthorDetailView.as_view(), name='author_detail'),
+    path('search/', serve(SearchResultsListView.as_view()), name='search_results'),
+    path('autocomplete/', serve(AutocompleteView.as_view()), name='book_autocomplete'),
+    path('api/', serve(BookListApiView.as_view()), name='api_book_list'),
+    path('api/<uuid:pk>', BookDetailApiView.as_view(), name='api_book_detail'),
+    path('api/search/', serve(SearchApiView.as_view()), name='api_search'),
+    path('export/<slug:dataset>.<slug:file_format>', BookExportView.as_view(), name='book_export'),
 ]
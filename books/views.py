@@ -1,10 +1,25 @@
+import hashlib
+from urllib.parse import urlencode
+
+from django.conf import settings
 from django.contrib.auth.mixins import (
     LoginRequiredMixin,
-    PermissionRequiredMixin
+    PermissionRequiredMixin,
+    UserPassesTestMixin
 )
-from django.db.models import Q
-from django.views.generic import ListView, DetailView
-from .models import Book
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.functional import SimpleLazyObject
+from django.utils.http import http_date
+from django.views.generic import DetailView, ListView, TemplateView, View
+from config.middleware import user_cache_fragment
+from . import autocomplete, export, facets
+from .cache import catalog_version
+from .models import Author, Book, Review
+from .pagination import KeysetPaginator
+from .search import search_books
 
 """
 LoginRequiredMixin Mixin:
@@ -44,16 +59,150 @@ Finally add a permission_required field which specifies the desired permission.
 """
 
 
-class BookListView(LoginRequiredMixin, ListView):
+"""
+Conditional responses:
+A reader paging back and forth or reloading a page usually has its current
+version already. ConditionalPageMixin gives the HTML pages an ETag and a
+Last-Modified, and a request that sends them back (If-None-Match,
+If-Modified-Since) gets a 304 without a body: get() answers it before the
+queryset is evaluated or the template rendered.
+
+The ETag is a hash of
+1) what the page shows: the catalog version (books/cache.py) for the list
+   and the search results, which any Book or Review change bumps, so the
+   check costs a cache lookup and no query; for the detail page the version
+   and updated_at of the book, one primary key lookup,
+2) who is asking, as in the site cache (config/middleware.py): the user and
+   a hash of their permissions, so a login, a logout or a granted
+   permission changes it, and the CSRF cookie, whose token is in the forms,
+3) CACHE_MIDDLEWARE_KEY_PREFIX, so changing it after a deploy that changed
+   the templates invalidates these like the site cache.
+The mixin comes after LoginRequiredMixin and PermissionRequiredMixin, whose
+checks run in dispatch(), before get(): only a visitor allowed to see the
+page ever gets a 304. "Cache-Control: max-age=0" and "Vary: Cookie" make
+browsers revalidate on every use and keep shared caches from mixing users.
+Last-Modified can't express the per-user part; clients that have the ETag
+send If-None-Match, which takes precedence.
+"""
+
+
+class ConditionalPageMixin:
+
+    def get_validators(self):
+        """ (the parts the ETag is made of, the Last-Modified timestamp), or None """
+        version = catalog_version()
+        return [version], version // 10 ** 6
+
+    def get(self, request, *args, **kwargs):
+        validators = self.get_validators()
+        if validators is None:
+            return super().get(request, *args, **kwargs)
+        parts, last_modified = validators
+        parts = parts + [
+            settings.CACHE_MIDDLEWARE_KEY_PREFIX,
+            user_cache_fragment(request.user),
+            request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''),
+        ]
+        etag = '"%s"' % hashlib.md5('|'.join(map(str, parts)).encode()).hexdigest()
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, max_age=0)
+        patch_vary_headers(response, ('Cookie',))
+        return response
+
+
+"""
+Pagination:
+Rendering every Book row on one page gets slower with every book we add, so the
+list is paginated with a keyset paginator (see books/pagination.py) instead of
+Django's OFFSET based Paginator. ?sort= picks one of the orderings below, each
+backed by a composite index in Book.Meta.indexes, and ?cursor= is the opaque
+position token rendered in the next/previous links.
+?author= (an Author id) and ?price= filter the list, with facet counts (books/facets.py).
+"""
+
+
+class BookListView(LoginRequiredMixin, ConditionalPageMixin, ListView):
     model = Book
     context_object_name = 'book_list'
     template_name = 'books/book_list.html'
     login_url = 'account_login'
+    paginate_by = 20
+    # ?sort= value -> keyset ordering, the unique id always comes last
+    orderings = {
+        'title': ('title', 'id'),
+        'author': ('author', 'id'),
+        'price': ('price', 'id'),
+        # top rated and most reviewed read the per-book aggregates (books/ratings.py)
+        'rating': ('-rating_avg', '-rating_count', 'id'),
+        'reviews': ('-review_count', 'id'),
+    }
+    default_sort = 'title'
+
+    def get_sort(self):
+        sort = self.request.GET.get('sort')
+        return sort if sort in self.orderings else self.default_sort
+
+    def get_filters(self):
+        """ (the selected Author or None, the selected price band or None) """
+        if not hasattr(self, '_filters'):
+            author = self.request.GET.get('author', '')
+            # an unknown or malformed author id means no author filter
+            author = Author.objects.filter(pk=author).first() if author.isdigit() and len(author) < 19 else None
+            band = self.request.GET.get('price')
+            self._filters = author, band if band in facets.BANDS else None
+        return self._filters
+
+    def get_queryset(self):
+        return facets.filter_books(super().get_queryset(), *self.get_filters())
+
+    def paginate_queryset(self, queryset, page_size):
+        sort = self.get_sort()
+        paginator = KeysetPaginator(
+            queryset, self.orderings[sort], page_size, name=sort)
+        page = paginator.page(self.request.GET.get('cursor'))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['sort'] = self.get_sort()
+        context['sort_options'] = list(self.orderings)
+        author, band = self.get_filters()
+        filters = {name: value for name, value in (('author', author and author.pk), ('price', band)) if value}
+        # put in front of sort= and cursor= in the sort and paging links
+        context['filter_query'] = urlencode(filters) + '&' if filters else ''
+        context['facets'] = facets.facets(dict(filters, sort=self.get_sort()), author, band)
+        return context
+
+
+"""
+Reviews on the detail page:
+Looping over book.reviews.all in the template and printing review.author runs
+one query for the reviews plus one query per review to load its author (the
+N+1 problem). select_related('author') joins the users into the same query,
+so the page costs the same number of queries however many reviews a book has.
+Popular books can have thousands of reviews, so only the first page is
+rendered with the book; the rest is fetched as HTML fragments from
+BookReviewsView when the reader clicks "Load more reviews".
+"""
+
+
+class ReviewPageMixin:
+    reviews_per_page = 20
+
+    def get_review_page(self, book_id, cursor=None):
+        reviews = Review.objects.filter(book_id=book_id).select_related('author')
+        return KeysetPaginator(reviews, ('id',), self.reviews_per_page, name='reviews').page(cursor)
 
 
 class BookDetailView(
         LoginRequiredMixin,
         PermissionRequiredMixin,
+        ConditionalPageMixin,
+        ReviewPageMixin,
         DetailView):
     model = Book
     context_object_name = 'book'
@@ -61,6 +210,64 @@ class BookDetailView(
     login_url = 'account_login'
     permission_required = 'books.special_status'
 
+    def get_validators(self):
+        # version and updated_at move with the book and with its reviews;
+        # an unknown book gets no validators and the usual 404
+        book = Book.objects.filter(pk=self.kwargs['pk']).values('version', 'updated_at').first()
+        if book is None:
+            return None
+        return [self.kwargs['pk'], book['version'], book['updated_at'].timestamp()], int(
+            book['updated_at'].timestamp())
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # lazy: when the reviews fragment is served from the cache the
+        # reviews query never runs
+        context['reviews'] = SimpleLazyObject(lambda: self.get_review_page(self.object.pk))
+        return context
+
+
+class BookReviewsView(
+        LoginRequiredMixin,
+        PermissionRequiredMixin,
+        ReviewPageMixin,
+        TemplateView):
+    """ The next page of reviews of a book, rendered as an HTML fragment. """
+    template_name = 'books/_reviews.html'
+    login_url = 'account_login'
+    permission_required = 'books.special_status'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # an unknown book is a 404, not an empty page of reviews
+        book = get_object_or_404(Book.objects.only('pk'), pk=self.kwargs['pk'])
+        context['book_id'] = book.pk
+        context['reviews'] = self.get_review_page(book.pk, self.request.GET.get('cursor'))
+        return context
+
+
+"""
+Author pages:
+An author's bibliography is read through the (written_by, title, id) index
+and keyset paginated like the book list, so a prolific author's last page
+costs the same as the first one.
+"""
+
+
+class AuthorDetailView(LoginRequiredMixin, DetailView):
+    model = Author
+    context_object_name = 'author'
+    template_name = 'books/author_detail.html'
+    login_url = 'account_login'
+    paginate_by = 20
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        books = Book.objects.filter(written_by=self.object)
+        paginator = KeysetPaginator(books, ('title', 'id'), self.paginate_by, name='bibliography')
+        context['books'] = paginator.page(self.request.GET.get('cursor'))
+        return context
+
 
 """
 Search functionality consists of two parts: 
@@ -70,19 +277,84 @@ Search functionality consists of two parts:
 
 all we need to do is configure URL, view, and template and query filter(Q objects).
 https://docs.djangoproject.com/en/3.1/topics/db/queries/#complex-lookups-with-q-objects
+
+The query itself now lives in books/search.py: ranked PostgreSQL full-text and
+trigram search instead of a sequential icontains scan. Results are ordered by
+relevance, which is computed per query, so they are paginated with Django's
+regular Paginator rather than the keyset paginator used by the book list.
 """
 
 
-class SearchResultsListView(ListView):
+class SearchResultsListView(ConditionalPageMixin, ListView):
     # model used for query
     model = Book
     context_object_name = 'book_list'
     # result page based on query
     template_name = 'books/search_results.html'
-    
+    paginate_by = 20
+
     # for any given search do the query based on provided filter, for example based on title or author of the book
     def get_queryset(self):
-        query = self.request.GET.get('q')
-        return Book.objects.filter(
-            Q(title__icontains=query) | Q(author__icontains=query)
-        )
+        return search_books(self.get_query())
+
+    def get_query(self):
+        return self.request.GET.get('q', '').strip()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['query'] = self.get_query()
+        return context
+
+
+"""
+Autocomplete: a small JSON endpoint the search box calls on every keystroke.
+It is answered from the in-memory prefix index in books/autocomplete.py and
+never touches the database once the index of the worker is built.
+GET /books/autocomplete/?q=harry%20po&limit=5
+"""
+
+
+class AutocompleteView(View):
+    default_limit = 10
+    max_limit = 20
+
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get('q', '')
+        try:
+            limit = min(int(request.GET.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            limit = self.default_limit
+        matches = autocomplete.get_index().search(query, limit=max(limit, 0))
+        return JsonResponse({
+            'query': query,
+            'results': [
+                {
+                    'id': book_id,
+                    'title': title,
+                    'author': author,
+                    'url': reverse('book_detail', args=[book_id]),
+                }
+                for book_id, title, author in matches
+            ],
+        })
+
+
+class BookExportView(LoginRequiredMixin, UserPassesTestMixin, View):
+    """
+    /books/export/books.csv, /books/export/reviews.jsonl ... for staff.
+    The body is generated while it is sent (StreamingHttpResponse), see
+    books/export.py. Parquet is only offered by manage.py export_books.
+    """
+    login_url = 'account_login'
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request, dataset, file_format):
+        if dataset not in export.DATASETS or file_format not in export.FORMATS:
+            raise Http404('Unknown export.')
+        response = StreamingHttpResponse(
+            export.iter_export(dataset, file_format), content_type=export.FORMATS[file_format])
+        response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (dataset, file_format)
+        response['Cache-Control'] = 'private, no-store'
+        return response
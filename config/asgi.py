@@ -5,12 +5,34 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/dev/howto/deployment/asgi/
+
+ASGI mode: uvicorn workers under gunicorn
+$ gunicorn config.asgi -k uvicorn.workers.UvicornWorker -b 0.0.0.0:8000
+Each worker runs an event loop, so slow clients (sending a request or reading
+a response byte by byte) only cost a socket, not a worker. The database work
+of the async views runs on a bounded thread pool, see config/executor.py.
+Compare with the sync workers using
+$ python manage.py bench_slow_clients http://127.0.0.1:8000/books/search/?q=book
+Streaming bodies (exports, media files) are also read on that pool, see
+StreamingASGIHandler. Like config/wsgi.py it warms the worker up before the
+first request.
 """
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.conf import settings
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+# switch books/urls.py to the async views (settings.ASGI)
+os.environ.setdefault('DJANGO_ASGI', 'True')
+
+# what get_asgi_application() does, with our handler
+django.setup(set_prefix=False)
+from .executor import StreamingASGIHandler  # noqa: E402 (needs the settings)
+
+application = StreamingASGIHandler()
 
-application = get_asgi_application()
+if settings.WARM_UP:
+    from .startup import warm_up
+    warm_up()
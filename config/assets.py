@@ -0,0 +1,244 @@
+import functools
+import posixpath
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.files.base import ContentFile
+from django.template.loader import get_template
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+"""
+Front-end asset pipeline
+
+Every page used to load Bootstrap, jQuery and Popper from three CDNs plus
+css/base.css and js/base.js: five render-blocking requests and three extra
+DNS lookups and TLS handshakes. Bootstrap and jQuery now live in
+static/vendor/ and collectstatic (AssetStorage) turns the sources named in
+settings.ASSET_BUNDLES into one file per asset type:
+
+    bundles/site.css  =  bootstrap.min.css + css/base.css
+    bundles/site.js   =  jquery.slim.min.js + bootstrap.bundle.min.js (with Popper) + js/base.js
+
+The sources are minified unless they already are (*.min.*), and CSS url()s
+are rewritten to stay valid from the bundle's directory. For each CSS
+bundle a critical subset (bundles/site.critical.css) is extracted as well:
+the rules whose selectors only use elements of the page shell and the
+classes of settings.ASSET_CRITICAL_TEMPLATES (_base.html). The templates
+inline it in a <style> so the header renders before the full stylesheet
+has arrived, and load the bundle itself without blocking (see
+pages/templatetags/assets.py).
+
+The bundles then go through the usual whitenoise post processing: a
+content hash in the file name (bundles/site.3f1c0a9e.css), and gzip and
+Brotli (with the brotli package installed) copies next to it, so whitenoise
+serves precompressed bytes without compressing anything per request. It
+also recognises the hashed names and sends them with
+"Cache-Control: max-age=315360000, public, immutable".
+
+With settings.ASSETS_BUNDLED off (the default with DEBUG), the templates
+link the sources one by one instead, so runserver works without
+collectstatic.
+"""
+
+ELEMENTS = {'', '*', 'html', 'body', 'header', 'nav', 'div', 'a'}
+URL_RE = re.compile(r'url\(\s*([\'"]?)(.*?)\1\s*\)')
+CLASS_RE = re.compile(r'class="([^"]*)"')
+STRING_RE = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')')
+PSEUDO_RE = re.compile(r'::?[a-zA-Z-]+(\([^()]*\))?')
+
+
+def _strip_comments(code, keep_licenses=True):
+    """ remove /* */ comments outside strings, except /*! license */ ones """
+    out, i, quote = [], 0, None
+    while i < len(code):
+        char = code[i]
+        if quote:
+            out.append(char)
+            if char == '\\':
+                out.append(code[i + 1:i + 2])
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+            out.append(char)
+        elif code.startswith('/*', i):
+            end = code.find('*/', i + 2)
+            end = len(code) if end == -1 else end + 2
+            if keep_licenses and code.startswith('/*!', i):
+                out.append(code[i:end] + '\n')
+            i = end
+            continue
+        else:
+            out.append(char)
+        i += 1
+    return ''.join(out)
+
+
+def minify_css(css):
+    parts = STRING_RE.split(_strip_comments(css))
+    # odd parts are the strings, they stay as they are
+    for i in range(0, len(parts), 2):
+        code = re.sub(r'\s+', ' ', parts[i])
+        # not before ':' (a :hover is not a:hover) or around '+'/'-' (calc() needs them)
+        code = re.sub(r' ?([{};,>]) ?', r'\1', code).replace(': ', ':')
+        # keep the license comments on their own line
+        parts[i] = code.replace(';}', '}').replace('*/ ', '*/').replace('*/', '*/\n')
+    return ''.join(parts).strip()
+
+
+def minify_js(js):
+    """
+    Whitespace and comment lines only: statements stay on their own lines,
+    so automatic semicolon insertion works as before.
+    """
+    lines = []
+    for line in js.splitlines():
+        line = line.strip()
+        if line and not line.startswith('//'):
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def _rebase_urls(css, source, bundle):
+    """ url(x) relative to source -> relative to bundle """
+    def rebase(match):
+        quote, url = match.groups()
+        if url.startswith(('data:', 'http:', 'https:', '//', '/', '#')):
+            return match.group(0)
+        path = posixpath.normpath(posixpath.join(posixpath.dirname(source), url))
+        return 'url(%s%s%s)' % (quote, posixpath.relpath(path, posixpath.dirname(bundle) or '.'), quote)
+    return URL_RE.sub(rebase, css)
+
+
+def build_bundle(name, sources, read):
+    """ the contents of bundle name, read(source) returns the text of a source """
+    parts = []
+    for source in sources:
+        code = read(source)
+        # the source maps are not collected next to the bundle
+        code = re.sub(r'^\s*(//|/\*)# sourceMappingURL=.*$', '', code, flags=re.M)
+        if name.endswith('.css'):
+            code = _rebase_urls(code, source, name)
+            parts.append(code.strip() if '.min.' in source else minify_css(code))
+        else:
+            parts.append(code.strip() if '.min.' in source else minify_js(code))
+    # a source that doesn't end its last statement must not run into the next one
+    return ('\n' if name.endswith('.css') else ';\n').join(parts) + '\n'
+
+
+def _blocks(css):
+    """ top level (prelude, body) pairs, body None for @import-like statements """
+    blocks, start, depth, quote, i = [], 0, 0, None, 0
+    while i < len(css):
+        char = css[i]
+        if quote:
+            if char == '\\':
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '{':
+            if depth == 0:
+                prelude, body_start = css[start:i].strip(), i + 1
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                blocks.append((prelude, css[body_start:i]))
+                start = i + 1
+        elif char == ';' and depth == 0:
+            blocks.append((css[start:i].strip(), None))
+            start = i + 1
+        i += 1
+    return blocks
+
+
+def _split_selectors(prelude):
+    selectors, depth, start = [], 0, 0
+    for i, char in enumerate(prelude):
+        depth += char == '('
+        depth -= char == ')'
+        if char == ',' and depth == 0:
+            selectors.append(prelude[start:i])
+            start = i + 1
+    return selectors + [prelude[start:]]
+
+
+def _is_critical(selector, classes):
+    selector = PSEUDO_RE.sub('', selector.strip())
+    if selector == '':
+        return True  # :root and friends
+    if '[' in selector or '#' in selector:
+        return False
+    for compound in re.split(r'[\s>+~]+', selector):
+        element, *names = compound.split('.')
+        if element.lower() not in ELEMENTS or not set(names) <= classes:
+            return False
+    return True
+
+
+def extract_critical(css, classes):
+    """ the rules of css whose selector only uses ELEMENTS and classes """
+    kept = []
+    for prelude, body in _blocks(_strip_comments(css, keep_licenses=False)):
+        if body is None:
+            continue
+        if prelude.startswith(('@media', '@supports')):
+            inner = extract_critical(body, classes)
+            if inner:
+                kept.append('%s{%s}' % (prelude, inner))
+        elif not prelude.startswith('@') and any(
+                _is_critical(selector, classes) for selector in _split_selectors(prelude)):
+            kept.append('%s{%s}' % (prelude, body))
+    return ''.join(kept)
+
+
+def critical_classes():
+    classes = set()
+    for name in settings.ASSET_CRITICAL_TEMPLATES:
+        for match in CLASS_RE.finditer(get_template(name).template.source):
+            classes.update(word for word in match.group(1).split() if '{' not in word)
+    return classes
+
+
+def critical_name(bundle):
+    root, extension = posixpath.splitext(bundle)
+    return '%s.critical%s' % (root, extension)
+
+
+class AssetStorage(CompressedManifestStaticFilesStorage):
+    """ CompressedManifestStaticFilesStorage that also writes ASSET_BUNDLES first """
+
+    def post_process(self, paths, dry_run=False, **options):
+        if not dry_run:
+            def read(source):
+                storage, path = paths[source]
+                with storage.open(path) as f:
+                    return f.read().decode('utf-8')
+
+            classes = critical_classes()
+            for name, sources in settings.ASSET_BUNDLES.items():
+                contents = build_bundle(name, sources, read)
+                files = {name: contents}
+                if name.endswith('.css'):
+                    files[critical_name(name)] = extract_critical(contents, classes)
+                for path, text in files.items():
+                    if self.exists(path):
+                        self.delete(path)
+                    self._save(path, ContentFile(text.encode('utf-8')))
+                    paths[path] = (self, path)
+        yield from super().post_process(paths, dry_run, **options)
+
+
+def bundles(extension):
+    return [name for name in settings.ASSET_BUNDLES if name.endswith(extension)]
+
+
+@functools.lru_cache(maxsize=None)
+def critical_css(bundle):
+    """ the collected critical CSS of bundle, read once per process """
+    with staticfiles_storage.open(staticfiles_storage.stored_name(critical_name(bundle))) as f:
+        return f.read().decode('utf-8')
@@ -0,0 +1,308 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from psycopg2 import OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+
+"""
+PostgreSQL connection pool
+
+Without CONN_MAX_AGE Django opens a new PostgreSQL connection for every
+request and closes it at the end: a TCP (and maybe TLS) handshake,
+authentication and a freshly forked backend process, several milliseconds
+each time. ENGINE = 'config.db_pool' (config/db_pool/base.py) is the regular
+postgresql backend, except that connecting takes a connection from a pool
+and closing puts it back. Django still "closes" its connection at the end of
+every request (CONN_MAX_AGE = 0), so a connection is only held while a
+request is being served and a few of them serve all threads of a worker.
+
+settings.DATABASES['default']['POOL'] (see config/settings.py):
+    MIN_SIZE        connections opened up front, when the worker first
+                    needs the database (its pool is created), and kept open
+    MAX_SIZE        at most this many connections per worker process
+    TIMEOUT         seconds to wait for a free connection before giving up
+    MAX_LIFETIME    connections are replaced after this many seconds (with
+                    some jitter so they don't all expire at once), so
+                    PostgreSQL backends don't grow forever and failovers or
+                    DNS changes are picked up
+    MAX_IDLE        idle connections above MIN_SIZE are closed after this
+    CHECK_INTERVAL  a connection that was idle longer than this is checked
+                    with SELECT 1 before it is handed out
+
+Broken connections (server restart, network) are detected when they come
+back (transaction status unknown) or by the check, and are replaced.
+
+Fork safety: gunicorn forks its workers from the master, which may have used
+the database (--preload). A pool belongs to the process that created it; a
+worker that finds a pool of its parent builds its own. Inherited connections
+are never used nor closed by the child (closing would end the parent's
+session on the server): they are only kept referenced so that garbage
+collection doesn't close them either.
+
+Every pool keeps counters (stats()) that config/metrics exposes.
+"""
+
+_pools = {}
+_pools_lock = threading.Lock()
+_inherited = []  # connections of a parent process, see "Fork safety" above
+
+DEFAULTS = {
+    'MIN_SIZE': 1,
+    'MAX_SIZE': 10,
+    'TIMEOUT': 10.0,
+    'MAX_LIFETIME': 3600.0,
+    'MAX_IDLE': 600.0,
+    'CHECK_INTERVAL': 30.0,
+}
+
+
+class PoolTimeout(OperationalError):
+    pass
+
+
+class _Entry:
+    __slots__ = ('connection', 'created', 'expires', 'last_used')
+
+    def __init__(self, connection, max_lifetime):
+        now = time.monotonic()
+        self.connection = connection
+        self.created = now
+        self.expires = now + max_lifetime * random.uniform(0.9, 1.0)
+        self.last_used = now
+
+
+class ConnectionPool:
+
+    def __init__(self, connect, options=None, name=None):
+        self.connect = connect
+        self.name = name  # host:port/database, the label of stats()
+        self.options = dict(DEFAULTS, **(options or {}))
+        self.pid = os.getpid()
+        self.idle = deque()  # _Entry, most recently used on the right
+        self.in_use = {}  # id(connection) -> _Entry
+        self.size = 0  # idle + in use + being opened
+        self.condition = threading.Condition()
+        self.counters = {
+            'connections_opened': 0,
+            'connections_closed': 0,
+            'connections_failed_check': 0,
+            'checkouts': 0,
+            'timeouts': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+        }
+
+    # taking and giving back
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.options['TIMEOUT']
+        with self.condition:
+            while True:
+                entry = self._pop_idle()
+                if entry is not None:
+                    break
+                if self.size < self.options['MAX_SIZE']:
+                    self.size += 1  # reserve the slot, connect outside the lock
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.counters['timeouts'] += 1
+                    raise PoolTimeout(
+                        'No database connection available within %.1fs (pool of %d).' % (
+                            self.options['TIMEOUT'], self.options['MAX_SIZE']))
+                self.condition.wait(remaining)
+
+        if entry is None:
+            entry = self._open()
+        elif not self._healthy(entry):
+            # replace it, keeping its slot
+            self._close(entry.connection)
+            entry = self._open()
+
+        waited = time.monotonic() - start
+        with self.condition:
+            self.in_use[id(entry.connection)] = entry
+            self.counters['checkouts'] += 1
+            self.counters['wait_seconds_total'] += waited
+            self.counters['wait_seconds_max'] = max(self.counters['wait_seconds_max'], waited)
+        return entry.connection
+
+    def putconn(self, connection):
+        with self.condition:
+            entry = self.in_use.pop(id(connection), None)
+        if entry is None:
+            # not ours (e.g. handed out before a fork), close it like Django would
+            connection.close()
+            return
+        now = time.monotonic()
+        reusable = not connection.closed and now < entry.expires
+        if reusable:
+            status = connection.get_transaction_status()
+            if status == TRANSACTION_STATUS_UNKNOWN:
+                reusable = False
+            elif status != TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except Exception:
+                    reusable = False
+        if not reusable:
+            self._discard(entry)
+            return
+        entry.last_used = now
+        with self.condition:
+            self.idle.append(entry)
+            self._close_surplus_idle(now)
+            self.condition.notify()
+
+    # bookkeeping
+
+    def _pop_idle(self):
+        now = time.monotonic()
+        while self.idle:
+            entry = self.idle.pop()  # LIFO: the warmest connection first
+            if now < entry.expires and not entry.connection.closed:
+                return entry
+            self.size -= 1
+            self._close(entry.connection)
+        return None
+
+    def _close_surplus_idle(self, now):
+        # the least recently used are on the left
+        while (self.idle and self.size > self.options['MIN_SIZE']
+               and now - self.idle[0].last_used > self.options['MAX_IDLE']):
+            entry = self.idle.popleft()
+            self.size -= 1
+            self._close(entry.connection)
+
+    def _healthy(self, entry):
+        if time.monotonic() - entry.last_used < self.options['CHECK_INTERVAL']:
+            return True
+        try:
+            with entry.connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            if entry.connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                entry.connection.rollback()
+            return True
+        except Exception:
+            with self.condition:
+                self.counters['connections_failed_check'] += 1
+            return False
+
+    def _open(self):
+        try:
+            connection = self.connect()
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.counters['connections_opened'] += 1
+        return _Entry(connection, self.options['MAX_LIFETIME'])
+
+    def _discard(self, entry):
+        self._close(entry.connection)
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    def _close(self, connection):
+        with self.condition:  # reentrant, may already be held
+            self.counters['connections_closed'] += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def fill(self):
+        """ open MIN_SIZE connections up front, get_pool() does when it creates the pool """
+        entries = []
+        try:
+            while True:
+                with self.condition:
+                    if self.size >= self.options['MIN_SIZE']:
+                        break
+                    self.size += 1
+                entries.append(self._open())
+        finally:
+            with self.condition:
+                self.idle.extend(entries)
+                self.condition.notify_all()
+
+    def close_all(self):
+        """ close the idle connections; the ones in use are closed when they come back """
+        with self.condition:
+            idle, self.idle = list(self.idle), deque()
+            self.size -= len(idle)
+            for entry in self.in_use.values():
+                entry.expires = 0
+        for entry in idle:
+            self._close(entry.connection)
+
+    def abandon(self):
+        """ after a fork: forget every connection without touching it """
+        with self.condition:
+            _inherited.extend(entry.connection for entry in self.idle)
+            _inherited.extend(entry.connection for entry in self.in_use.values())
+            self.idle.clear()
+            self.in_use.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats.update(
+                size=self.size,
+                idle=len(self.idle),
+                in_use=len(self.in_use),
+                max_size=self.options['MAX_SIZE'],
+            )
+        return stats
+
+
+def get_pool(key, connect, options, name=None):
+    """
+    The pool of this process for the given connection parameters (key),
+    created and filled on first use. A pool inherited from a parent process
+    is abandoned and replaced.
+    """
+    pid = os.getpid()
+    pool = _pools.get(key)
+    if pool is not None and pool.pid == pid:
+        return pool
+    created = False
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is not None and pool.pid != pid:
+            pool.abandon()
+            pool = None
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(connect, options, name)
+            created = True
+    if created:
+        try:
+            pool.fill()
+        except Exception:
+            pass  # the database is down: getconn() raises the error to the caller
+    return pool
+
+
+def close_all_pools():
+    for pool in list(_pools.values()):
+        if pool.pid == os.getpid():
+            pool.close_all()
+
+
+def pool_stats():
+    """
+    {host:port/database: stats} for the pools of this process. Not keyed by
+    database name alone: a primary and its replicas usually share it.
+    """
+    return {
+        pool.name or str(key[0]): pool.stats()
+        for key, pool in list(_pools.items()) if pool.pid == os.getpid()
+    }
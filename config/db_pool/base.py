@@ -0,0 +1,45 @@
+import os
+
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.creation import DatabaseCreation as PostgresCreation
+from . import close_all_pools, get_pool
+
+"""
+The postgresql backend with pooled connections, see config/db_pool/__init__.py
+DATABASES = {'default': {'ENGINE': 'config.db_pool', ..., 'POOL': {'MAX_SIZE': 10}}}
+"""
+
+
+class DatabaseCreation(PostgresCreation):
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # idle pooled connections would keep DROP DATABASE from succeeding
+        close_all_pools()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def get_new_connection(self, conn_params):
+        key = (conn_params.get('database'), tuple(sorted((k, str(v)) for k, v in conn_params.items())))
+        name = '%s:%s/%s' % (
+            conn_params.get('host') or 'localhost', conn_params.get('port') or 5432, conn_params.get('database'))
+        # a physical connection is made (once) exactly like the postgresql backend does
+        pool = get_pool(
+            key, lambda: super(DatabaseWrapper, self).get_new_connection(conn_params),
+            self.settings_dict.get('POOL'), name)
+        connection = pool.getconn()
+        self._pool, self._pool_pid = pool, os.getpid()
+        self.isolation_level = self.settings_dict['OPTIONS'].get(
+            'isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        if getattr(self, '_pool_pid', None) != os.getpid():
+            # checked out by the parent process before a fork: leave it alone
+            return
+        with self.wrap_database_errors:
+            self._pool.putconn(self.connection)
@@ -0,0 +1,31 @@
+import functools
+import socket
+
+from django.conf import settings
+
+"""
+django-debug-toolbar's SHOW_TOOLBAR_CALLBACK (settings.DEBUG_TOOLBAR_CONFIG)
+
+The toolbar shows for requests from settings.INTERNAL_IPS and, inside
+docker-compose, from the Docker host: the gateway of each network of the
+container (our own addresses with the last digit replaced by a 1). Finding
+those addresses takes a DNS lookup of our hostname, which used to run in
+config/settings.py on every import. Now it only runs on the first request
+in DEBUG, and a lookup that fails just leaves the Docker host out.
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def docker_host_ips():
+    try:
+        hostname, aliases, ips = socket.gethostbyname_ex(socket.gethostname())
+    except OSError:
+        return frozenset()
+    return frozenset(ip[:-1] + '1' for ip in ips)
+
+
+def show_toolbar(request):
+    if not settings.DEBUG:
+        return False
+    address = request.META.get('REMOTE_ADDR')
+    return address in settings.INTERNAL_IPS or address in docker_host_ips()
@@ -0,0 +1,149 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections
+
+"""
+Bounded thread pool for blocking work in ASGI mode
+
+The ORM (and the cache client, and template rendering that evaluates lazy
+querysets) is synchronous. Called from a coroutine it would block the event
+loop and with it every other connection of the worker, so Django refuses
+(SynchronousOnlyOperation). Async views therefore hand that work to a thread.
+
+asgiref's sync_to_async() either runs everything on one shared thread
+(thread_sensitive=True, so requests queue behind each other) or on the
+loop's default executor, which grows with the number of CPUs and is shared
+with everything else. DB_EXECUTOR is our own pool of ASYNC_DB_THREADS
+threads: at most that many database connections per worker, however many
+clients are connected, and the rest of the requests wait in the queue
+without holding a connection.
+
+Like a WSGI request, every job starts and ends with close_old_connections(),
+so CONN_MAX_AGE and broken connections are handled the same way.
+
+Streaming responses have the same problem after the view returned: Django
+3.1's ASGIHandler iterates a StreamingHttpResponse (the export of
+books/export.py, FileResponse and Range bodies of config/media.py) on the
+event loop, where the lazy queries of the export raise
+SynchronousOnlyOperation and the file reads block. StreamingASGIHandler
+iterates them in one DB_EXECUTOR job instead (one thread, so one database
+connection and server-side cursor for the whole body) and hands the chunks
+to the loop through a small queue: a slow client holds a thread, not the
+whole worker, and the thread waits for the client instead of buffering.
+"""
+
+DB_EXECUTOR = ThreadPoolExecutor(
+    max_workers=settings.ASYNC_DB_THREADS, thread_name_prefix='async-db')
+# chunks a streaming body may read ahead of the client
+STREAM_QUEUE_SIZE = 4
+
+
+def _call(func, args, kwargs):
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_in_db_thread(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        DB_EXECUTOR, functools.partial(context.run, _call, func, args, kwargs))
+
+
+def async_view(view):
+    """
+    Turn a regular (sync) view into an async one whose work, including
+    rendering a TemplateResponse, happens on DB_EXECUTOR. The event loop keeps
+    serving the other connections, e.g. slow clients still sending their
+    request or reading the response, which under sync workers would each
+    occupy a whole worker.
+    """
+    def render(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if hasattr(response, 'render') and callable(response.render):
+            response.render()
+        return response
+
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        return await run_in_db_thread(render, request, *args, **kwargs)
+    return wrapper
+
+
+async def iterate_in_db_thread(iterable):
+    """ Async iterator over a blocking iterable, which is consumed by one DB_EXECUTOR job. """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce():
+        try:
+            for chunk in iterable:
+                if stopped.is_set():
+                    return
+                put((chunk, None))
+        except Exception as error:
+            put((end, error))
+        else:
+            put((end, None))
+
+    job = asyncio.ensure_future(run_in_db_thread(produce))
+    try:
+        while True:
+            chunk, error = await queue.get()
+            if error is not None:
+                raise error
+            if chunk is end:
+                break
+            yield chunk
+    finally:
+        # the client went away: let a producer waiting on the full queue go
+        stopped.set()
+        while not queue.empty():
+            queue.get_nowait()
+        await job
+
+
+class StreamingASGIHandler(ASGIHandler):
+    """ ASGIHandler whose streaming bodies are produced on DB_EXECUTOR, see above. """
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            response_headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            response_headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': response_headers,
+        })
+        body = iterate_in_db_thread(response)
+        try:
+            async for part in body:
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            await body.aclose()
+        await send({'type': 'http.response.body'})
+        await sync_to_async(response.close, thread_sensitive=True)()
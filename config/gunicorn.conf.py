@@ -0,0 +1,29 @@
+import os
+import sys
+
+# gunicorn runs this file, the project directory isn't necessarily on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import server  # noqa: E402
+
+"""
+gunicorn configuration
+
+$ gunicorn -c config/gunicorn.conf.py config.wsgi
+$ WEB_WORKER_CLASS=gthread gunicorn -c config/gunicorn.conf.py config.wsgi
+$ WEB_WORKER_CLASS=uvicorn gunicorn -c config/gunicorn.conf.py config.asgi
+
+or simply python manage.py serve, which picks the right application.
+The settings come from the environment, see config/server.py.
+"""
+
+globals().update(server.gunicorn_settings())
+
+
+def post_fork(arbiter, worker):
+    from config import startup
+    startup.post_fork(arbiter, worker)
+
+
+def post_worker_init(worker):
+    server.start_watchdog(worker)
@@ -0,0 +1,165 @@
+import hashlib
+import mimetypes
+import re
+from pathlib import Path
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+from books.images import is_derivative
+
+"""
+Serving user uploaded media (book covers) in production
+
+static(settings.MEDIA_URL, ...) only works with DEBUG = True, so in production
+the covers had no way to reach the browser. serve_media is a small view that
+does it properly:
+- a strong ETag (hash of the file contents) and Last-Modified, so browsers
+  revalidate with If-None-Match/If-Modified-Since and get a 304 without body,
+- HTTP Range requests (206 Partial Content / 416), e.g. resumed downloads,
+- long lived Cache-Control headers: uploads get a unique name from the
+  storage, so a file at a given URL never changes. The resized covers
+  (books/images.py) can be rebuilt under the same name, they are cached
+  for MEDIA_DERIVATIVE_MAX_AGE and without immutable,
+- optionally the actual bytes are not sent by gunicorn at all: with
+  DJANGO_MEDIA_ACCEL=x-accel-redirect (nginx) or x-sendfile (Apache, lighttpd)
+  the view only answers with a header telling the front proxy which file to
+  send, so workers are not busy streaming images to slow clients.
+
+nginx example for x-accel-redirect (MEDIA_ACCEL_PREFIX = '/protected-media/'):
+    location /protected-media/ {
+        internal;
+        alias /code/media/;
+    }
+"""
+
+CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _media_file(path):
+    root = Path(settings.MEDIA_ROOT).resolve()
+    full_path = (root / path).resolve()
+    try:
+        full_path.relative_to(root)  # no ../ out of MEDIA_ROOT
+    except ValueError:
+        raise Http404('Not found.')
+    if not full_path.is_file():
+        raise Http404('Not found.')
+    return full_path
+
+
+def _strong_etag(full_path, stat):
+    """ sha1 of the contents, remembered for as long as size and mtime don't change """
+    key = 'media-etag:%s' % hashlib.md5(
+        ('%s:%d:%d' % (full_path, stat.st_size, stat.st_mtime_ns)).encode()).hexdigest()
+    etag = cache.get(key)
+    if etag is None:
+        digest = hashlib.sha1()
+        with open(full_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        etag = quote_etag(digest.hexdigest())
+        cache.set(key, etag, None)
+    return etag
+
+
+def _parse_range(header, size):
+    """
+    (start, end) of a single 'bytes=' range, None to serve the whole file,
+    or False when the range can't be satisfied. Multiple ranges are rare,
+    the RFC lets us answer them with the whole file, and an invalid one
+    (last before first) must be ignored (RFC 7233, 2.1 and 3.1).
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    first, last = match.groups()
+    if first == '':  # bytes=-500: the last 500 bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return False
+    end = min(int(last), size - 1) if last else size - 1
+    return start, end
+
+
+def _read_range(full_path, start, length):
+    with open(full_path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _set_caching_headers(response, etag, last_modified, path):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    if is_derivative(path):
+        response['Cache-Control'] = 'public, max-age=%d' % settings.MEDIA_DERIVATIVE_MAX_AGE
+    else:
+        response['Cache-Control'] = 'public, max-age=%d, immutable' % settings.MEDIA_CACHE_MAX_AGE
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+@require_safe
+def serve_media(request, path):
+    full_path = _media_file(path)
+    stat = full_path.stat()
+    etag = _strong_etag(full_path, stat)
+    last_modified = int(stat.st_mtime)
+
+    # If-None-Match / If-Modified-Since (304) and If-Match / If-Unmodified-Since (412)
+    conditional = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if conditional is not None:
+        return _set_caching_headers(conditional, etag, last_modified, path)
+
+    content_type, encoding = mimetypes.guess_type(str(full_path))
+    content_type = content_type or 'application/octet-stream'
+
+    accel = settings.MEDIA_ACCEL
+    if accel:
+        # the front proxy sends the file, and handles Range itself
+        response = HttpResponse(content_type=content_type)
+        if accel == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + quote(path)
+        else:
+            response['X-Sendfile'] = str(full_path)
+        return _set_caching_headers(response, etag, last_modified, path)
+
+    byte_range = None
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if range_header and (not if_range or if_range == etag):
+        byte_range = _parse_range(range_header, stat.st_size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % stat.st_size
+        return _set_caching_headers(response, etag, last_modified, path)
+
+    if byte_range is None:
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+    else:
+        start, end = byte_range
+        length = end - start + 1
+        response = StreamingHttpResponse(
+            _read_range(full_path, start, length), status=206, content_type=content_type)
+        response['Content-Length'] = str(length)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, stat.st_size)
+    if encoding:
+        response['Content-Encoding'] = encoding
+    return _set_caching_headers(response, etag, last_modified, path)
@@ -0,0 +1,403 @@
+import atexit
+import contextvars
+import hashlib
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+from django.urls import Resolver404, resolve
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.http import require_safe
+from .db_pool import pool_stats
+
+"""
+Request metrics: Server-Timing header and a Prometheus endpoint
+
+debug_toolbar only works in DEBUG, so in production we were blind.
+ProfilingMiddleware (config/middleware.py) measures every request cheaply
+(two clock reads and a few dict updates) and, for a sample of
+METRICS_SAMPLE_RATE of them, also
+- the time spent in SQL and the number of queries (an execute wrapper that
+  every database connection gets, see sql_timer below),
+- the time spent rendering the template,
+- the cache hits and misses (site cache and {% bookcache %} fragments).
+
+Every response gets a Server-Timing header with the total, which browsers
+show in the network panel. The db/tpl/cache details of sampled requests
+tell too much about the backend for everybody, they are only added in
+DEBUG and for requests that may read /metrics:
+    Server-Timing: total;dur=41.2, db;dur=12.5;desc="7 queries", tpl;dur=20.1, cache;desc="hit=3 miss=1"
+
+Per view and method the latencies are kept in a histogram; methods outside
+METHODS share the label 'other', or any client could add series at will
+(every name is a set of shared cache keys). Each worker process counts
+in memory and every METRICS_FLUSH_SECONDS (and at exit) adds what it
+counted since the last flush to shared totals, one cache.incr() per series
+(seconds as integer microseconds). The totals outlive the workers: a
+worker recycled by gunicorn's max_requests takes nothing with it, so the
+counters never go down, which Prometheus would read as a counter reset.
+The names of the series are kept in SERIES_KEY; a name lost to two
+workers updating it at the same time is added back on the next flush.
+
+The database pools (config/db_pool) are gauges of the live workers
+instead: every worker keeps its pool stats in a slot of its own, claimed
+with cache.add() and expiring when the worker stops flushing.
+
+GET /metrics renders all that in the Prometheus text format. Access needs
+METRICS_TOKEN (Authorization: Bearer <token>); without one set, /metrics is
+off. METRICS_ALLOWED_IPS, when set, also limits the addresses: not on its
+own, behind a reverse proxy on the same host every request comes from
+127.0.0.1.
+"""
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SERIES_KEY = 'metrics:series'
+WORKER_SLOTS = 128
+MICROSECONDS = 10 ** 6
+METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'))
+
+
+_profile = contextvars.ContextVar('request_profile', default=None)
+
+
+class RequestProfile:
+    __slots__ = ('sql_time', 'queries', 'template_time', 'cache_hits', 'cache_misses')
+
+    def __init__(self):
+        self.sql_time = self.template_time = 0.0
+        self.queries = self.cache_hits = self.cache_misses = 0
+
+    def server_timing(self):
+        return 'db;dur=%.1f;desc="%d queries", tpl;dur=%.1f, cache;desc="hit=%d miss=%d"' % (
+            self.sql_time * 1000, self.queries, self.template_time * 1000,
+            self.cache_hits, self.cache_misses)
+
+
+def start_profile():
+    return _profile.set(RequestProfile())
+
+
+def end_profile(token):
+    profile = _profile.get()
+    _profile.reset(token)
+    return profile
+
+
+def sql_timer(execute, sql, params, many, context):
+    profile = _profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.sql_time += time.perf_counter() - start
+        profile.queries += 1
+
+
+def install_sql_timer(sender, connection, **kwargs):
+    if sql_timer not in connection.execute_wrappers:
+        connection.execute_wrappers.append(sql_timer)
+
+
+connection_created.connect(install_sql_timer)
+
+
+def time_render(response):
+    """
+    time the rendering of a TemplateResponse of the sampled request: it is
+    rendered right after process_template_response. A post render callback,
+    not a wrapped render(), so the response can still be pickled by the site cache.
+    """
+    profile = _profile.get()
+    if profile is None:
+        return
+    start = time.perf_counter()
+
+    def rendered(response):
+        profile.template_time += time.perf_counter() - start
+
+    response.add_post_render_callback(rendered)
+
+
+def _label(match):
+    return match.view_name or match._func_path
+
+
+@lru_cache(maxsize=1024)
+def _resolve_label(path):
+    try:
+        return _label(resolve(path))
+    except Resolver404:
+        return '<unresolved>'
+
+
+def view_name(request):
+    """ the label of a request: its URL name, or the view's dotted path """
+    if request.resolver_match is None:
+        # answered before URL resolution (site cache hit, static file, redirect);
+        # resolving costs more than everything else here, remember the popular paths
+        return _resolve_label(request.path_info)
+    return _label(request.resolver_match)
+
+
+def method_label(request):
+    """ the method of a request as a label, anything unusual is 'other' (labels are series) """
+    return request.method if request.method in METHODS else 'other'
+
+
+def _series_key(series):
+    return 'metrics:total:%s' % hashlib.md5(repr(series).encode()).hexdigest()
+
+
+def _slot_key(slot):
+    return 'metrics:worker-slot:%d' % slot
+
+
+def _add(key, count):
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key, count)
+    except ValueError:  # evicted between add() and incr()
+        cache.set(key, count, None)
+
+
+class Registry:
+    """ What this worker process counted since its last flush. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.token = uuid.uuid4().hex
+        self.slot = None
+        self.published = set()  # series this worker has put into SERIES_KEY
+        self.latency = {}  # (view, method) -> [bucket counts..., +Inf, sum]
+        self.sampled = {}  # view -> [requests, sql seconds, queries, template seconds]
+        self.cache = {}  # (cache, result) -> count
+        self.last_flush = time.monotonic()
+
+    def observe(self, view, method, duration, profile=None):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()  # numbers inherited from the parent process
+            histogram = self.latency.get((view, method))
+            if histogram is None:
+                histogram = self.latency[(view, method)] = [0] * (len(BUCKETS) + 1) + [0.0]
+            histogram[bisect_left(BUCKETS, duration)] += 1
+            histogram[-1] += duration
+            if profile is not None:
+                sampled = self.sampled.setdefault(view, [0, 0.0, 0, 0.0])
+                sampled[0] += 1
+                sampled[1] += profile.sql_time
+                sampled[2] += profile.queries
+                sampled[3] += profile.template_time
+            due = time.monotonic() - self.last_flush >= settings.METRICS_FLUSH_SECONDS
+        if due:
+            self.flush()
+
+    def count_cache(self, name, hit, count=1):
+        key = (name, 'hit' if hit else 'miss')
+        with self.lock:
+            self.cache[key] = self.cache.get(key, 0) + count
+
+    def take(self):
+        """ {series: count} of everything counted since the last flush, and start over """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+            latency, sampled, caches = self.latency, self.sampled, self.cache
+            self.latency, self.sampled, self.cache = {}, {}, {}
+            self.last_flush = time.monotonic()
+        counts = {}
+        for (view, method), values in latency.items():
+            for bucket, count in enumerate(values[:-1]):
+                counts[('latency', view, method, bucket)] = count
+            counts[('latency', view, method, 'sum')] = round(values[-1] * MICROSECONDS)
+        for view, values in sampled.items():
+            counts[('sampled', view, 0)] = values[0]
+            counts[('sampled', view, 1)] = round(values[1] * MICROSECONDS)
+            counts[('sampled', view, 2)] = values[2]
+            counts[('sampled', view, 3)] = round(values[3] * MICROSECONDS)
+        for (name, result), count in caches.items():
+            counts[('cache', name, result)] = count
+        return {series: count for series, count in counts.items() if count}
+
+    def give_back(self, counts):
+        """ a failed flush: the counts go into the next one """
+        with self.lock:
+            for series, count in counts.items():
+                if series[0] == 'latency':
+                    histogram = self.latency.setdefault(series[1:3], [0] * (len(BUCKETS) + 1) + [0.0])
+                    if series[3] == 'sum':
+                        histogram[-1] += count / MICROSECONDS
+                    else:
+                        histogram[series[3]] += count
+                elif series[0] == 'sampled':
+                    sampled = self.sampled.setdefault(series[1], [0, 0.0, 0, 0.0])
+                    sampled[series[2]] += count / MICROSECONDS if series[2] in (1, 3) else count
+                else:
+                    self.cache[series[1:]] = self.cache.get(series[1:], 0) + count
+
+    def flush(self):
+        """ add the counts to the shared totals, publish the pool gauges """
+        counts = self.take()
+        added = set()
+        try:
+            for series, count in counts.items():
+                _add(_series_key(series), count)
+                added.add(series)
+            self.published.update(counts)
+            known = cache.get(SERIES_KEY) or set()
+            if not self.published <= known:
+                cache.set(SERIES_KEY, known | self.published, None)
+            self.publish_gauges()
+        except Exception:
+            # metrics must never break a request; what wasn't added yet
+            # goes into the next flush
+            self.give_back({series: count for series, count in counts.items() if series not in added})
+
+    def publish_gauges(self):
+        value = (self.token, pool_stats())
+        timeout = settings.METRICS_FLUSH_SECONDS * 6
+        if self.slot is not None:
+            owner = cache.get(_slot_key(self.slot))
+            if owner is None or owner[0] == self.token:
+                cache.set(_slot_key(self.slot), value, timeout)
+                return
+        # the first free slot, starting somewhere else for every worker
+        first = os.getpid() % WORKER_SLOTS
+        for offset in range(WORKER_SLOTS):
+            slot = (first + offset) % WORKER_SLOTS
+            if cache.add(_slot_key(slot), value, timeout):
+                self.slot = slot
+                return
+        self.slot = None
+
+
+registry = Registry()
+
+
+@atexit.register
+def _flush_at_exit():
+    registry.flush()
+    # not a live worker any more
+    if registry.slot is not None and (cache.get(_slot_key(registry.slot)) or [None])[0] == registry.token:
+        cache.delete(_slot_key(registry.slot))
+
+
+def record_cache(name, hit, count=1):
+    """ called by the site cache and the fragment cache on every lookup """
+    registry.count_cache(name, hit, count)
+    profile = _profile.get()
+    if profile is not None:
+        if hit:
+            profile.cache_hits += count
+        else:
+            profile.cache_misses += count
+
+
+def collect():
+    """ ({series: shared total}, [pool stats of every live worker]) """
+    series = list(cache.get(SERIES_KEY) or ())
+    keys = {_series_key(name): name for name in series}
+    totals = {keys[key]: count for key, count in cache.get_many(list(keys)).items()}
+    slots = cache.get_many([_slot_key(slot) for slot in range(WORKER_SLOTS)])
+    return totals, [stats for token, stats in slots.values()]
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                    for name, value in labels.items())
+
+
+def render_prometheus(totals, workers):
+    latency, sampled, caches, pools = {}, {}, {}, {}
+    for series, count in totals.items():
+        if series[0] == 'latency':
+            histogram = latency.setdefault(series[1:3], [0] * (len(BUCKETS) + 1) + [0.0])
+            if series[3] == 'sum':
+                histogram[-1] = count / MICROSECONDS
+            else:
+                histogram[series[3]] = count
+        elif series[0] == 'sampled':
+            values = sampled.setdefault(series[1], [0, 0.0, 0, 0.0])
+            values[series[2]] = count / MICROSECONDS if series[2] in (1, 3) else count
+        else:
+            caches[series[1:]] = count
+    for stats_by_database in workers:
+        for database, stats in stats_by_database.items():
+            total = pools.setdefault(database, {})
+            for name, value in stats.items():
+                if name == 'wait_seconds_max':
+                    total[name] = max(total.get(name, 0), value)
+                else:
+                    total[name] = total.get(name, 0) + value
+
+    lines = [
+        '# HELP django_request_duration_seconds Request latency per view.',
+        '# TYPE django_request_duration_seconds histogram',
+    ]
+    for (view, method), values in sorted(latency.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), values):
+            cumulative += count
+            lines.append('django_request_duration_seconds_bucket{%s} %d' % (
+                _labels(view=view, method=method, le=bound), cumulative))
+        lines.append('django_request_duration_seconds_sum{%s} %f' % (
+            _labels(view=view, method=method), values[-1]))
+        lines.append('django_request_duration_seconds_count{%s} %d' % (
+            _labels(view=view, method=method), cumulative))
+
+    for name, index, kind, help_text in (
+            ('django_sampled_requests_total', 0, 'counter', 'Requests profiled in detail.'),
+            ('django_sampled_db_seconds_total', 1, 'counter', 'SQL time of the sampled requests.'),
+            ('django_sampled_db_queries_total', 2, 'counter', 'Queries of the sampled requests.'),
+            ('django_sampled_template_seconds_total', 3, 'counter',
+             'Template render time of the sampled requests.')):
+        lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s %s' % (name, kind)]
+        for view, values in sorted(sampled.items()):
+            lines.append('%s{%s} %s' % (name, _labels(view=view), values[index]))
+
+    lines += ['# HELP django_cache_lookups_total Site and fragment cache lookups.',
+              '# TYPE django_cache_lookups_total counter']
+    for (name, result), count in sorted(caches.items()):
+        lines.append('django_cache_lookups_total{%s} %d' % (_labels(cache=name, result=result), count))
+
+    for database, stats in sorted(pools.items()):
+        for name, value in sorted(stats.items()):
+            lines.append('django_db_pool_%s{%s} %s' % (name, _labels(database=database), value))
+
+    lines += ['# HELP django_metrics_workers Worker processes reporting.',
+              '# TYPE django_metrics_workers gauge',
+              'django_metrics_workers %d' % len(workers)]
+    return '\n'.join(lines) + '\n'
+
+
+def allowed(request):
+    token = settings.METRICS_TOKEN
+    if not token:
+        return False
+    if settings.METRICS_ALLOWED_IPS and request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return False
+    return constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer %s' % token)
+
+
+@require_safe
+def metrics_view(request):
+    if not allowed(request):
+        return HttpResponseForbidden()
+    # this worker's latest numbers are in the totals too
+    registry.flush()
+    response = HttpResponse(render_prometheus(*collect()), content_type='text/plain; version=0.0.4')
+    response['Cache-Control'] = 'no-store'
+    return response
@@ -0,0 +1,257 @@
+import asyncio
+import hashlib
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.cache import cc_delim_re, get_conditional_response
+from django.utils.http import parse_http_date_safe
+from whitenoise.middleware import WhiteNoiseMiddleware
+from books.cache import catalog_version
+from . import metrics, routers
+from .executor import run_in_db_thread
+
+"""
+Site cache
+
+Django's per-site cache (UpdateCacheMiddleware/FetchFromCacheMiddleware) was
+not a good fit for this project:
+- entries were never invalidated, so a book edit could stay invisible for
+  CACHE_MIDDLEWARE_SECONDS (a week),
+- without CACHES every gunicorn worker had its own LocMemCache, so workers
+  disagreed with each other about what a page looked like,
+- pages of logged in users vary on the whole Cookie header, so every session
+  got its own entry anyway and csrftoken changes kept missing.
+
+SiteCacheMiddleware replaces both middlewares. A cache key is made of
+1) the catalog version (books/cache.py), bumped by signals whenever a Book or
+   a Review changes, so edits are visible on the next request,
+2) who is asking: "anon" for anonymous visitors, otherwise the user id plus a
+   hash of their staff/superuser flags and permissions. Users never see each
+   other's pages, and a user whose permissions change gets new keys (e.g. the
+   permission gated book detail page turns into a 403 straight away),
+3) the full URL including the query string.
+Entries live in the shared CACHES['default'] (memcached in docker-compose),
+so all workers and nodes share them.
+
+A page stored with an ETag (books/views.py) is answered with a 304 when
+the client sends it back, like the view would have.
+
+Only complete 200 GET responses are stored, and never a response that
+contains a CSRF token, sets cookies, is marked private/no-store or varies on
+anything other than Cookie.
+
+The middleware works in both modes (sync_capable/async_capable). Under ASGI a
+sync-only middleware would force Django to run the rest of the chain, views
+included, in a thread per request; in async mode the cache lookup, which
+needs request.user (a database query), runs on the bounded pool of
+config/executor.py instead.
+"""
+
+
+class AsyncCapableMiddleware:
+    """ The part of Django's MiddlewareMixin that switches to async mode. """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            # tells Django (asyncio.iscoroutinefunction) this instance is async
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        return self.handle(request)
+
+
+class SiteCacheMiddleware(AsyncCapableMiddleware):
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.cache = caches[settings.CACHE_MIDDLEWARE_ALIAS]
+        self.timeout = settings.CACHE_MIDDLEWARE_SECONDS
+        self.key_prefix = settings.CACHE_MIDDLEWARE_KEY_PREFIX
+
+    def handle(self, request):
+        if not self.applies_to(request):
+            return self.get_response(request)
+        key, response = self.lookup(request)
+        if response is not None:
+            return response
+        return self.store(request, key, self.get_response(request))
+
+    async def __acall__(self, request):
+        if not self.applies_to(request):
+            return await self.get_response(request)
+        key, response = await run_in_db_thread(self.lookup, request)
+        if response is not None:
+            return response
+        response = await self.get_response(request)
+        return await run_in_db_thread(self.store, request, key, response)
+
+    def applies_to(self, request):
+        # media files have their own ETag/Cache-Control handling (config/media.py)
+        return (request.method in ('GET', 'HEAD') and self.timeout
+                and not request.path_info.startswith(settings.MEDIA_URL))
+
+    def lookup(self, request):
+        key = self.get_cache_key(request)
+        response = self.cache.get(key)
+        metrics.record_cache('site', response is not None)
+        if response is not None:
+            response['X-Cache'] = 'HIT'
+            if response.has_header('ETag'):
+                # the validators of the stored page are still current: they
+                # are made of the same catalog version and user (books/views.py)
+                response = get_conditional_response(
+                    request, etag=response['ETag'],
+                    last_modified=parse_http_date_safe(response.get('Last-Modified', '')),
+                    response=response)
+        return key, response
+
+    def store(self, request, key, response):
+        if request.method == 'GET' and self.is_cacheable(request, response):
+            self.cache.set(key, response, self.timeout)
+        response['X-Cache'] = 'MISS'
+        return response
+
+    def get_cache_key(self, request):
+        parts = [
+            self.key_prefix,
+            str(catalog_version()),
+            user_cache_fragment(request.user),
+            request.build_absolute_uri(),
+        ]
+        digest = hashlib.md5('|'.join(parts).encode()).hexdigest()
+        return 'sitecache.%s' % digest
+
+    def is_cacheable(self, request, response):
+        if response.status_code != 200 or response.streaming or response.cookies:
+            return False
+        # the page contains a csrf token bound to this visitor's cookie
+        if request.META.get('CSRF_COOKIE_USED'):
+            return False
+        if response.has_header('Cache-Control'):
+            directives = response['Cache-Control'].lower()
+            if 'private' in directives or 'no-store' in directives or 'no-cache' in directives:
+                return False
+        if response.has_header('Vary'):
+            vary = {header.strip().lower() for header in cc_delim_re.split(response['Vary'])}
+            if vary - {'cookie'}:
+                return False
+        return True
+
+
+def user_cache_fragment(user):
+    """
+    A short string that changes whenever what the user may see changes.
+    The permissions come from the cross-request permission cache
+    (accounts/backends.py), so a cache hit runs no permission query.
+    """
+    if not user.is_authenticated:
+        return 'anon'
+    state = '%s:%s:%s' % (
+        user.is_staff, user.is_superuser, ','.join(sorted(user.get_all_permissions())))
+    return 'user%s.%s' % (user.pk, hashlib.md5(state.encode()).hexdigest()[:12])
+
+
+class AsyncWhiteNoiseMiddleware(AsyncCapableMiddleware, WhiteNoiseMiddleware):
+    """
+    WhiteNoise 5 is sync only. Looking a URL up among the static files is a
+    dict lookup, so it can run on the event loop; serving the file is left to
+    the (sync) file response iterator as before.
+    """
+
+    def __init__(self, get_response=None, settings=settings):
+        WhiteNoiseMiddleware.__init__(self, get_response, settings=settings)
+        AsyncCapableMiddleware.__init__(self, get_response)
+
+    def handle(self, request):
+        return WhiteNoiseMiddleware.__call__(self, request)
+
+    async def __acall__(self, request):
+        response = self.process_request(request)
+        if response is None:
+            response = await self.get_response(request)
+        return response
+
+
+class PrimaryPinningMiddleware(AsyncCapableMiddleware):
+    """
+    Read-your-writes for the replica router (config/routers.py): a request
+    from a pinned client reads from the primary, and a request that wrote
+    pins its client for DATABASE_PIN_SECONDS with a cookie.
+    """
+
+    def handle(self, request):
+        token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            state = routers.end_request(token)
+        return self.finish(state, response)
+
+    async def __acall__(self, request):
+        token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            state = routers.end_request(token)
+        return self.finish(state, response)
+
+    def start(self, request):
+        return routers.start_request(pinned=routers.pinned_until(request) > time.time())
+
+    def finish(self, state, response):
+        if state.wrote and settings.DATABASE_REPLICAS:
+            response.set_cookie(
+                settings.DATABASE_PIN_COOKIE, routers.pin_cookie_value(),
+                max_age=settings.DATABASE_PIN_SECONDS, httponly=True,
+                secure=settings.SESSION_COOKIE_SECURE, samesite='Lax')
+        return response
+
+
+class ProfilingMiddleware(AsyncCapableMiddleware):
+    """
+    Server-Timing header and per-view latency histograms (config/metrics.py).
+    Outermost, so the total includes every other middleware.
+    """
+
+    def handle(self, request):
+        start = time.perf_counter()
+        token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            profile = metrics.end_profile(token) if token else None
+        return self.finish(request, response, start, profile)
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            profile = metrics.end_profile(token) if token else None
+        return self.finish(request, response, start, profile)
+
+    def start(self, request):
+        if random.random() < settings.METRICS_SAMPLE_RATE:
+            return metrics.start_profile()
+        return None
+
+    def process_template_response(self, request, response):
+        metrics.time_render(response)
+        return response
+
+    def finish(self, request, response, start, profile):
+        duration = time.perf_counter() - start
+        metrics.registry.observe(metrics.view_name(request), metrics.method_label(request), duration, profile)
+        timing = 'total;dur=%.1f' % (duration * 1000)
+        if profile is not None and (settings.DEBUG or metrics.allowed(request)):
+            timing += ', ' + profile.server_timing()
+        response['Server-Timing'] = timing
+        return response
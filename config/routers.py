@@ -0,0 +1,108 @@
+import contextvars
+import random
+import time
+
+from django.conf import settings
+from django.db import connections
+from books.cache import catalog_version
+
+"""
+Read replicas with read-your-writes
+
+PrimaryReplicaRouter sends the reads of the books and accounts apps (the
+book list, search and detail pages, the user lookup of every request) to
+one of settings.DATABASE_REPLICAS, and every write to the primary
+('default'). Everything else (sessions, permissions, allauth, sites, admin
+log) stays on the primary.
+
+Replicas lag behind the primary a little. A user who just wrote something
+(a review, a profile change, logging in) would not find it on the next
+page, so:
+- the request that wrote reads from the primary for the rest of the request,
+- PrimaryPinningMiddleware then sets a cookie that pins the user to the
+  primary for DATABASE_PIN_SECONDS, long enough for the replicas to catch up.
+Reads inside a transaction, and reads outside of a request (management
+commands, shell), always use the primary.
+
+The catalog version (books/cache.py) is bumped when a change commits on
+the primary, and the site cache, the facet counts and the ETags of the book
+pages are keyed on it. A page read from a replica that hasn't caught up yet
+would be stored under the new version and served for days. So for
+DATABASE_PIN_SECONDS after a catalog change every request reads from the
+primary; the version is a timestamp, one cache lookup per request tells.
+
+Locally, two SQLite files work fine (no replication of course, pointing
+both at the same file shows the routing without stale reads):
+DJANGO_DATABASE_REPLICA_URLS=sqlite:////code/db.sqlite3
+"""
+
+ROUTED_APPS = {'books', 'accounts'}
+
+
+class RequestDatabaseState:
+    __slots__ = ('pinned', 'wrote', 'settled')
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+        self.settled = None
+
+    def catalog_settled(self):
+        """ whether the replicas had DATABASE_PIN_SECONDS to apply the last catalog change """
+        if self.settled is None:
+            age = time.time() - catalog_version() / 10 ** 6
+            self.settled = age > settings.DATABASE_PIN_SECONDS
+        return self.settled
+
+
+# set by PrimaryPinningMiddleware for the duration of a request; a mutable
+# object, so a write noticed in a thread pool (config/executor.py) is seen
+_request_state = contextvars.ContextVar('database_request_state', default=None)
+
+
+def start_request(pinned):
+    return _request_state.set(RequestDatabaseState(pinned))
+
+
+def end_request(token):
+    state = _request_state.get()
+    _request_state.reset(token)
+    return state
+
+
+def pinned_until(request):
+    try:
+        return float(request.COOKIES.get(settings.DATABASE_PIN_COOKIE, 0))
+    except ValueError:
+        return 0.0
+
+
+class PrimaryReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label not in ROUTED_APPS or not settings.DATABASE_REPLICAS:
+            return 'default'
+        state = _request_state.get()
+        if state is None or state.pinned or state.wrote or connections['default'].in_atomic_block:
+            return 'default'
+        if not state.catalog_settled():
+            return 'default'
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label in ROUTED_APPS:
+            state = _request_state.get()
+            if state is not None:
+                state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+def pin_cookie_value():
+    return '%.0f' % (time.time() + settings.DATABASE_PIN_SECONDS)
@@ -0,0 +1,148 @@
+import os
+import signal
+import threading
+
+"""
+Production server settings (config/gunicorn.conf.py, manage.py serve)
+
+gunicorn reads this before Django is set up, so nothing here may import
+Django settings. Everything comes from the environment:
+
+    WEB_WORKER_CLASS         sync (default), gthread or uvicorn
+    WEB_CONCURRENCY          worker processes, by default from the cores:
+                             sync 2 * cores + 1, gthread and uvicorn cores + 1
+    WEB_THREADS              threads per gthread worker (4)
+    WEB_MAX_REQUESTS         recycle a worker after that many requests (1000),
+    WEB_MAX_REQUESTS_JITTER  plus up to that many (100), so they don't all restart at once
+    WEB_MAX_RSS_MB           recycle a worker whose resident memory grew over it (0: off),
+    WEB_RSS_CHECK_SECONDS    checked that often (5)
+    WEB_KEEPALIVE            seconds an idle keep-alive connection stays open (5)
+    WEB_TIMEOUT              seconds before a silent worker is killed (30)
+    PORT                     the port to bind on 0.0.0.0 (8000)
+
+Which worker class:
+- sync: one request at a time per process. The simplest and fastest per
+  request, as long as the clients are fast (a buffering proxy in front).
+- gthread: threads in each process. Cheaper in memory per concurrent
+  request and keeps connections alive; the threads share the GIL, so it
+  helps with waiting (database, cache) not with CPU work.
+- uvicorn: the ASGI application (config/asgi.py) on an event loop, for
+  slow clients and long connections (manage.py bench_slow_clients).
+
+Recycling: Python rarely hands freed memory back to the OS, so a worker
+that once rendered a huge page stays big. max_requests (with jitter)
+restarts workers regularly; the RSS watchdog restarts the ones that grew
+over WEB_MAX_RSS_MB right away. Either way the worker finishes its
+requests first (SIGTERM is gunicorn's graceful shutdown) and the master
+forks a fresh one from the preloaded application.
+"""
+
+WORKER_CLASSES = {
+    'sync': 'sync',
+    'gthread': 'gthread',
+    'uvicorn': 'uvicorn.workers.UvicornWorker',
+}
+# the application each worker class serves
+APPLICATIONS = {
+    'sync': 'config.wsgi:application',
+    'gthread': 'config.wsgi:application',
+    'uvicorn': 'config.asgi:application',
+}
+
+
+def cores():
+    try:
+        return len(os.sched_getaffinity(0))  # the cores this container may use
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def default_workers(worker_class, count):
+    if worker_class == 'sync':
+        return 2 * count + 1
+    return count + 1
+
+
+def gunicorn_settings(environ=None):
+    """ the gunicorn settings for config/gunicorn.conf.py """
+    environ = os.environ if environ is None else environ
+    worker_class = environ.get('WEB_WORKER_CLASS', 'sync')
+    if worker_class not in WORKER_CLASSES:
+        raise ValueError('WEB_WORKER_CLASS must be one of %s, not %r.' % (', '.join(WORKER_CLASSES), worker_class))
+    settings = {
+        'bind': '0.0.0.0:%s' % environ.get('PORT', '8000'),
+        'worker_class': WORKER_CLASSES[worker_class],
+        'workers': int(environ.get('WEB_CONCURRENCY') or default_workers(worker_class, cores())),
+        'max_requests': int(environ.get('WEB_MAX_REQUESTS', 1000)),
+        'max_requests_jitter': int(environ.get('WEB_MAX_REQUESTS_JITTER', 100)),
+        'keepalive': int(environ.get('WEB_KEEPALIVE', 5)),
+        'timeout': int(environ.get('WEB_TIMEOUT', 30)),
+        'graceful_timeout': int(environ.get('WEB_TIMEOUT', 30)),
+        # load (and warm up, config/startup.py) the application once in the master
+        'preload_app': True,
+    }
+    if worker_class == 'gthread':
+        settings['threads'] = int(environ.get('WEB_THREADS', 4))
+    if os.path.isdir('/dev/shm'):
+        # the heartbeat file: on a container's overlay filesystem a write can
+        # block long enough for the master to think the worker hangs
+        settings['worker_tmp_dir'] = '/dev/shm'
+    return settings
+
+
+def rss_bytes():
+    """ resident memory of this process, 0 when it can't be read """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # the peak rather than the current size, in KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+class RssWatchdog(threading.Thread):
+    """
+    Checks the RSS of its worker every interval seconds and asks it to
+    restart (SIGTERM to itself) once it is over limit bytes. A thread, so it
+    works the same for every worker class, the uvicorn one included.
+    """
+
+    def __init__(self, limit, interval=5.0, log=None):
+        super().__init__(name='rss-watchdog', daemon=True)
+        self.limit = limit
+        self.interval = interval
+        self.log = log
+        self.stopped = threading.Event()
+
+    def check(self):
+        rss = rss_bytes()
+        if rss <= self.limit:
+            return False
+        if self.log is not None:
+            self.log('worker %d uses %d MB, over %d MB: restarting it' % (
+                os.getpid(), rss // 2 ** 20, self.limit // 2 ** 20))
+        os.kill(os.getpid(), signal.SIGTERM)
+        return True
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if self.check():
+                return
+
+
+def start_watchdog(worker, environ=None):
+    """ gunicorn post_worker_init hook body """
+    environ = os.environ if environ is None else environ
+    limit = int(environ.get('WEB_MAX_RSS_MB', 0)) * 2 ** 20
+    if not limit:
+        return None
+    watchdog = RssWatchdog(limit, float(environ.get('WEB_RSS_CHECK_SECONDS', 5)), worker.log.warning)
+    watchdog.start()
+    worker.rss_watchdog = watchdog
+    return watchdog
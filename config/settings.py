@@ -11,8 +11,9 @@ $ docker-compose exec web pipenv install 'environs[django]==8.0.0'
 $ docker-compose down
 $ docker-compose up -d --build
 """
-import socket
+import dj_database_url
 from environs import Env
+from marshmallow.validate import OneOf
 from pathlib import Path
 
 
@@ -199,34 +200,49 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
 
     'django.contrib.sites',  # django site framework configuration
+    'django.contrib.postgres',  # full-text search and trigram lookups
 
     # Third-party
     'crispy_forms',
     'allauth',
     'allauth.account',
-    'debug_toolbar',  # debug_toolbar config part1
 
     # Local
-    'accounts',
+    'accounts.apps.AccountsConfig',
     'pages',
-    'books',
+    'books.apps.BooksConfig',
 ]
 
 MIDDLEWARE = [
-    'django.middleware.cache.UpdateCacheMiddleware',  # per-site cache config part1
+    # Server-Timing and /metrics (config/metrics.py), first so it times everything
+    'config.middleware.ProfilingMiddleware',
     # whitenoise configuration part2 - after SecurityMiddleware
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    # WhiteNoiseMiddleware that also works in async mode (ASGI)
+    'config.middleware.AsyncWhiteNoiseMiddleware',
+    # read-your-writes for the read replicas (config/routers.py)
+    'config.middleware.PrimaryPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # last activity and rolling expiry, written behind (accounts/sessions.py)
+    'accounts.middleware.SessionActivityMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'debug_toolbar.middleware.DebugToolbarMiddleware',  # debug_toolbar config part2
-    'django.middleware.cache.FetchFromCacheMiddleware',  # per-site cache config part2
+    # per-site cache config part2 - versioned, per-user aware site cache (needs request.user)
+    'config.middleware.SiteCacheMiddleware',
 ]
 
+
+# debug_toolbar config part1 and part2 - only in DEBUG, where it is used. Its
+# middleware is sync only: under ASGI it would push every request onto a thread.
+if DEBUG:
+    INSTALLED_APPS.append('debug_toolbar')
+    MIDDLEWARE.insert(
+        MIDDLEWARE.index('config.middleware.SiteCacheMiddleware'),
+        'debug_toolbar.middleware.DebugToolbarMiddleware')
+
 ROOT_URLCONF = 'config.urls'
 """
 We'll also update TEMPLATES so
@@ -282,6 +298,35 @@ $ docker-compose exec web pipenv install psycopg2-binary==2.8.5
 DATABASES = {  # postgres config part2
     "default": env.dj_db_url("DATABASE_URL", default="postgres://postgres@db/postgres")
 }
+# Read replicas (config/routers.py): reads of the books and accounts apps go to
+# one of these, writes to "default". Users who just wrote are pinned to the
+# primary for DATABASE_PIN_SECONDS so they read their own writes, and so is
+# everybody for that long after a catalog change (the version keyed caches).
+DATABASE_REPLICAS = []
+for number, url in enumerate(env.list("DJANGO_DATABASE_REPLICA_URLS", default=[]), start=1):
+    alias = "replica%d" % number
+    DATABASES[alias] = dj_database_url.parse(url)
+    DATABASES[alias]["TEST"] = {"MIRROR": "default"}
+    DATABASE_REPLICAS.append(alias)
+DATABASE_ROUTERS = ["config.routers.PrimaryReplicaRouter"]
+DATABASE_PIN_SECONDS = env.int("DJANGO_DATABASE_PIN_SECONDS", default=10)
+DATABASE_PIN_COOKIE = "primary_until"
+
+# Pooled PostgreSQL connections (config/db_pool): one pool per worker process,
+# connections are reused across requests instead of being opened for each one.
+for database in DATABASES.values():
+    if not env.bool("DJANGO_DB_POOL", default=True) or \
+            database["ENGINE"] != "django.db.backends.postgresql":
+        continue
+    database["ENGINE"] = "config.db_pool"
+    database["POOL"] = {
+        "MIN_SIZE": env.int("DJANGO_DB_POOL_MIN_SIZE", default=1),
+        "MAX_SIZE": env.int("DJANGO_DB_POOL_MAX_SIZE", default=10),
+        "TIMEOUT": env.float("DJANGO_DB_POOL_TIMEOUT", default=10.0),
+        "MAX_LIFETIME": env.float("DJANGO_DB_POOL_MAX_LIFETIME", default=3600.0),
+        "MAX_IDLE": env.float("DJANGO_DB_POOL_MAX_IDLE", default=600.0),
+        "CHECK_INTERVAL": env.float("DJANGO_DB_POOL_CHECK_INTERVAL", default=30.0),
+    }
 
 # Password validation
 # https://docs.djangoproject.com/en/dev/ref/settings/#auth-password-validators
@@ -353,10 +398,11 @@ ACCOUNT_LOGOUT_REDIRECT = 'home'
 SITE_ID = 1  # optional django site framework configuration that represent number of supported sites by django project
 
 AUTHENTICATION_BACKENDS = (
-    'django.contrib.auth.backends.ModelBackend',
+    # ModelBackend and allauth's backend, with permissions cached across requests (accounts/backends.py)
+    'accounts.backends.CachedModelBackend',
     # explicit the implicit django settings ,
     # which is used when Django attempts to authenticate a user.
-    'allauth.account.auth_backends.AuthenticationBackend',
+    'accounts.backends.CachedAuthenticationBackend',
     # allauth configuration: which will allow us to switch over to using login via e-mail.
 
 )
@@ -427,9 +473,74 @@ MEDIA_URL = '/media/'
 # MEDIA_ROOT is the absolute file system path to the directory for user-uploaded files.
 MEDIA_ROOT = str(BASE_DIR.joinpath('media'))
 
-# django-debug-toolbar  config part3 - it ensures that our INTERNAL_IPS matches that of our Docker host.
-hostname, _, ips = socket.gethostbyname_ex(socket.gethostname())
-INTERNAL_IPS = [ip[:-1] + "1" for ip in ips]
+# Media in production is served by config.media.serve_media (ETag, Range, caching headers).
+# Set DJANGO_MEDIA_ACCEL to 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache/lighttpd)
+# to let the front proxy send the bytes instead of a gunicorn worker.
+MEDIA_ACCEL = env.str("DJANGO_MEDIA_ACCEL", default="", validate=OneOf(["", "x-accel-redirect", "x-sendfile"]))
+MEDIA_ACCEL_PREFIX = env.str("DJANGO_MEDIA_ACCEL_PREFIX", default="/protected-media/")
+MEDIA_CACHE_MAX_AGE = env.int("DJANGO_MEDIA_CACHE_MAX_AGE", default=31536000)  # one year
+# resized covers can be rebuilt under the same name (books/images.py)
+MEDIA_DERIVATIVE_MAX_AGE = env.int("DJANGO_MEDIA_DERIVATIVE_MAX_AGE", default=86400)  # one day
+
+# django-debug-toolbar  config part3 - who gets the toolbar. Matching the
+# Docker host used to take a DNS lookup of our hostname right here, on every
+# import of the settings (every worker boot, every manage.py call, in
+# production too), so slow DNS slowed down and broken DNS broke all of them.
+# config/debug.py now does that lookup on the first request with DEBUG on.
+INTERNAL_IPS = env.list("DJANGO_INTERNAL_IPS", default=["127.0.0.1"])
+DEBUG_TOOLBAR_CONFIG = {'SHOW_TOOLBAR_CALLBACK': 'config.debug.show_toolbar'}
+
+# Startup (config/startup.py): warm the URL resolvers, templates and
+# translations when the WSGI/ASGI application is created, i.e. once in the
+# gunicorn master with --preload. manage.py startup_profile fails when
+# getting there takes longer than STARTUP_BUDGET_MS.
+WARM_UP = env.bool("DJANGO_WARM_UP", default=not DEBUG)
+# app templates compiled by the warm-up besides all of templates/
+WARM_UP_APP_TEMPLATES = ['%s/' % CRISPY_TEMPLATE_PACK, 'account/']
+STARTUP_BUDGET_MS = env.int("DJANGO_STARTUP_BUDGET_MS", default=2000)
+
+# ASGI mode (config/asgi.py sets DJANGO_ASGI): the list, search and autocomplete
+# views are served by async views that do their blocking work on a pool of
+# ASYNC_DB_THREADS threads per worker (config/executor.py).
+ASGI = env.bool("DJANGO_ASGI", default=False)
+ASYNC_DB_THREADS = env.int("DJANGO_ASYNC_DB_THREADS", default=8)
+
+# sessions live in the shared cache, the database only gets real changes right
+# away; activity/expiry updates are coalesced and written behind (accounts/sessions.py)
+SESSION_ENGINE = 'accounts.sessions'
+SESSION_ACTIVITY_RESOLUTION = env.int("DJANGO_SESSION_ACTIVITY_RESOLUTION", default=300)
+SESSION_WRITE_BEHIND_SECONDS = env.int("DJANGO_SESSION_WRITE_BEHIND_SECONDS", default=30)
+SESSION_WRITE_BEHIND_BATCH = env.int("DJANGO_SESSION_WRITE_BEHIND_BATCH", default=500)
+SESSION_PURGE_BATCH_SIZE = env.int("DJANGO_SESSION_PURGE_BATCH_SIZE", default=5000)
+
+# request metrics (config/metrics.py): every request is timed, METRICS_SAMPLE_RATE
+# of them also get SQL/template/cache details. /metrics needs METRICS_TOKEN
+# (Authorization: Bearer ...), and a request from METRICS_ALLOWED_IPS when set.
+METRICS_SAMPLE_RATE = env.float("DJANGO_METRICS_SAMPLE_RATE", default=0.05)
+METRICS_FLUSH_SECONDS = env.int("DJANGO_METRICS_FLUSH_SECONDS", default=10)
+METRICS_TOKEN = env.str("DJANGO_METRICS_TOKEN", default="")
+METRICS_ALLOWED_IPS = env.list("DJANGO_METRICS_ALLOWED_IPS", default=[])
+
+# cached permission sets are invalidated by signals, this only bounds unused entries
+PERMISSION_CACHE_SECONDS = env.int("DJANGO_PERMISSION_CACHE_SECONDS", default=86400)
+
+# books autocomplete: each worker rebuilds its in-memory prefix index after this many seconds
+AUTOCOMPLETE_MAX_AGE = env.int("DJANGO_AUTOCOMPLETE_MAX_AGE", default=300)
+# matches read to rank the autocomplete results (books/autocomplete.py)
+AUTOCOMPLETE_CANDIDATES = env.int("DJANGO_AUTOCOMPLETE_CANDIDATES", default=5000)
+
+# per-site cache config part1 - a cache shared by every worker and node.
+# docker-compose points CACHE_URL at memcached (pymemcached://memcached:11211),
+# without it each process falls back to its own in-memory cache.
+CACHES = {
+    "default": env.dj_cache_url("CACHE_URL", default="locmem://"),
+}
+
+# {% bookcache %} fragments are versioned per book, this only bounds how long unused ones linger
+FRAGMENT_CACHE_SECONDS = env.int("DJANGO_FRAGMENT_CACHE_SECONDS", default=86400)
+
+# book list facet counts (books/facets.py) are keyed on the catalog version, this bounds stale ones
+FACET_CACHE_SECONDS = env.int("DJANGO_FACET_CACHE_SECONDS", default=3600)
 
 # per-site cache config part3
 CACHE_MIDDLEWARE_ALIAS = 'default'
@@ -447,7 +558,25 @@ CSRF_COOKIE_SECURE = env.bool("DJANGO_CSRF_COOKIE_SECURE", default=True)
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
 # whitenoise configuration part3 - storage
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+# whitenoise's CompressedManifestStaticFilesStorage plus the asset bundles
+# (config/assets.py): collectstatic writes them, hashes them and stores gzip
+# and Brotli copies, whitenoise serves them with Cache-Control: immutable.
+STATICFILES_STORAGE = 'config.assets.AssetStorage'
+ASSET_BUNDLES = {
+    'bundles/site.css': [
+        'vendor/bootstrap-4.5.3/css/bootstrap.min.css',
+        'css/base.css',
+    ],
+    'bundles/site.js': [
+        'vendor/jquery-3.5.1/jquery.slim.min.js',
+        'vendor/bootstrap-4.5.3/js/bootstrap.bundle.min.js',  # includes Popper
+        'js/base.js',
+    ],
+}
+# the classes used in these templates make up the inlined critical CSS
+ASSET_CRITICAL_TEMPLATES = ['_base.html']
+# link the bundles (they only exist after collectstatic), or every source on its own
+ASSETS_BUNDLED = env.bool("DJANGO_ASSETS_BUNDLED", default=not DEBUG)
 
 
 """
@@ -485,4 +614,10 @@ FetchFromCacheMiddleware at the very bottom. Also set three additional
 fields CACHE_MIDDLEWARE_ALIAS,
 CACHE_MIDDLEWARE_SECONDS, and
 CACHE_MIDDLEWARE_KEY_PREFIX.
+
+We have since replaced the two Django middlewares with
+config.middleware.SiteCacheMiddleware: entries are versioned by the catalog
+version (bumped by signals when a Book or Review changes), are keyed per user
+and permission set, and live in the shared CACHES['default'] so all workers
+agree. The three CACHE_MIDDLEWARE_* settings above still configure it.
 """
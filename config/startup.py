@@ -0,0 +1,99 @@
+import os
+import random
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.template import engines
+from django.template.backends.django import DjangoTemplates
+from django.template.utils import get_app_template_dirs
+from django.urls import get_resolver
+from django.utils import translation
+
+"""
+Worker startup
+
+Django does a lot of its setup on the first request instead of at import:
+the URLconf modules (and with them every view module) are imported, the
+reverse lookup tables are built, the templates are read from disk and
+compiled by the cached template loader, and the translation catalogs of
+every app are loaded. With several workers each one pays for that on its
+first request, and those requests are the slow ones in the latency
+histograms after every deploy.
+
+warm_up() does all of that up front. config/wsgi.py and config/asgi.py call
+it (settings.WARM_UP, on unless DEBUG) right after creating the application:
+- with gunicorn --preload the application is created once in the master,
+  so warm_up() runs once and the workers inherit the result when they are
+  forked (copy-on-write, the pages stay shared while nobody writes to them),
+- without it, every worker warms itself up before accepting connections.
+
+Fork safety: nothing created before the fork may be used by two processes.
+warm_up() never needs the database or the cache, but closes any connection
+of either that something opened anyway, and starts no threads. post_fork()
+(a gunicorn server hook) also gives every worker its own random state;
+config/db_pool and the metrics registry (config/metrics.py) notice a new
+pid on their own.
+"""
+
+
+def _template_names(directory):
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if name.endswith(('.html', '.txt')):
+                yield os.path.relpath(os.path.join(root, name), directory).replace(os.sep, '/')
+
+
+def warm_up_urls():
+    resolver = get_resolver()
+    # importing every urlconf imports every view module, the reverse
+    # tables of the root and each namespace are built on first use
+    resolver.reverse_dict
+    for namespace, (prefix, sub_resolver) in resolver.namespace_dict.items():
+        sub_resolver.reverse_dict
+
+
+def warm_up_templates():
+    """
+    Compile the project templates (TEMPLATES DIRS) and the app templates
+    under settings.WARM_UP_APP_TEMPLATES into the cached loaders. Not all
+    app templates: the admin's are rarely needed and crispy_forms alone
+    ships 129 templates for five CSS frameworks.
+    """
+    names = set()
+    for directory in get_app_template_dirs('templates'):
+        names.update(name for name in _template_names(str(directory))
+                     if name.startswith(tuple(settings.WARM_UP_APP_TEMPLATES)))
+    for engine in engines.all():
+        if not isinstance(engine, DjangoTemplates):
+            continue
+        for directory in engine.engine.dirs:
+            names.update(_template_names(str(directory)))
+        for name in names:
+            engine.get_template(name)
+    return len(names)
+
+
+def warm_up_translations():
+    with translation.override(settings.LANGUAGE_CODE):
+        translation.gettext('Books')  # loads the catalogs of every app
+
+
+def close_connections():
+    connections.close_all()
+    for cache in caches.all():
+        cache.close()
+
+
+def warm_up():
+    warm_up_urls()
+    warm_up_templates()
+    warm_up_translations()
+    close_connections()
+
+
+def post_fork(server, worker):
+    # forked workers start with the master's random state, without this the
+    # request sampling of ProfilingMiddleware (config/middleware.py) would
+    # pick the same requests in every worker
+    random.seed()
@@ -0,0 +1,627 @@
+import asyncio
+import importlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser, Permission
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.http import HttpResponse
+from django.template import engines
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from books.cache import CATALOG_VERSION_KEY, bump_catalog_version
+from books.models import Book, Review
+from books.views import AutocompleteView
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS, TRANSACTION_STATUS_UNKNOWN
+from . import assets, db_pool, debug, metrics, server, startup
+from .executor import StreamingASGIHandler, async_view
+from . import routers
+from .middleware import PrimaryPinningMiddleware, SiteCacheMiddleware
+
+"""
+Tests for the project wide pieces living in config/ (middleware, ...).
+"""
+
+
+class SiteCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.book = Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+        self.user = get_user_model().objects.create_user(
+            username='cacheuser', email='cacheuser@email.com', password='testpass123')
+        self.other = get_user_model().objects.create_user(
+            username='otheruser', email='otheruser@email.com', password='testpass123')
+        self.user.user_permissions.add(Permission.objects.get(codename='special_status'))
+
+    def test_pages_are_served_from_cache(self):
+        first = self.client.get(reverse('about'))
+        second = self.client.get(reverse('about'))
+        self.assertEqual(first['X-Cache'], 'MISS')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(first.content, second.content)
+
+    def test_book_changes_invalidate_cached_pages(self):
+        url = reverse('search_results') + '?q=harry'
+        self.assertContains(self.client.get(url), '25.00')
+        self.assertEqual(self.client.get(url)['X-Cache'], 'HIT')
+        self.book.price = '30.00'
+        self.book.save()
+        response = self.client.get(url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertContains(response, '30.00')
+
+    def test_reviews_invalidate_cached_pages(self):
+        self.client.login(email='cacheuser@email.com', password='testpass123')
+        self.client.get(self.book.get_absolute_url())
+        Review.objects.create(book=self.book, author=self.user, review='Loved it')
+        self.assertContains(self.client.get(self.book.get_absolute_url()), 'Loved it')
+
+    def test_users_do_not_share_entries(self):
+        self.client.login(email='cacheuser@email.com', password='testpass123')
+        self.assertEqual(self.client.get(reverse('book_list'))['X-Cache'], 'MISS')
+        self.client.login(email='otheruser@email.com', password='testpass123')
+        self.assertEqual(self.client.get(reverse('book_list'))['X-Cache'], 'MISS')
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('book_list')).status_code, 302)
+
+    def test_permission_changes_are_respected(self):
+        self.client.login(email='cacheuser@email.com', password='testpass123')
+        self.assertEqual(self.client.get(self.book.get_absolute_url()).status_code, 200)
+        self.user.user_permissions.clear()
+        self.assertEqual(self.client.get(self.book.get_absolute_url()).status_code, 403)
+
+    # the per-user key must not cost the permission queries the hit saves
+    def test_hits_run_no_permission_query(self):
+        self.client.login(email='cacheuser@email.com', password='testpass123')
+        self.client.get(self.book.get_absolute_url())
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(self.book.get_absolute_url())['X-Cache'], 'HIT')
+        self.assertEqual([query['sql'] for query in queries if 'auth_permission' in query['sql']], [])
+
+    def test_pages_with_csrf_tokens_are_not_cached(self):
+        self.client.get(reverse('account_login'))
+        self.assertEqual(self.client.get(reverse('account_login'))['X-Cache'], 'MISS')
+
+
+class MediaServingTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        os.mkdir(os.path.join(self.media_root, 'covers'))
+        self.content = bytes(range(256)) * 4
+        with open(os.path.join(self.media_root, 'covers', 'cover.jpg'), 'wb') as f:
+            f.write(self.content)
+        self.url = '/media/covers/cover.jpg'
+
+    def test_full_file_with_caching_headers(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertFalse(response['ETag'].startswith('W/'))
+
+    def test_derivatives_are_not_immutable(self):
+        with open(os.path.join(self.media_root, 'covers', 'cover.w160.webp'), 'wb') as f:
+            f.write(self.content)
+        response = self.client.get('/media/covers/cover.w160.webp')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=%d' % settings.MEDIA_DERIVATIVE_MAX_AGE)
+        self.assertIn('immutable', self.client.get(self.url)['Cache-Control'])
+
+    def test_conditional_requests_get_304(self):
+        response = self.client.get(self.url)
+        not_modified = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, b'')
+        not_modified = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_range_requests(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/1024')
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-24')
+        self.assertEqual(b''.join(response.streaming_content), self.content[-24:])
+        response = self.client.get(self.url, HTTP_RANGE='bytes=5000-')
+        self.assertEqual(response.status_code, 416)
+        # an invalid range is ignored
+        response = self.client.get(self.url, HTTP_RANGE='bytes=500-100')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        # a stale If-Range gets the whole (changed) file
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_path_traversal_and_missing_files_are_404(self):
+        self.assertEqual(self.client.get('/media/covers/missing.jpg').status_code, 404)
+        self.assertEqual(self.client.get('/media/../config/settings.py').status_code, 404)
+        self.assertEqual(self.client.get('/media/%2e%2e/config/settings.py').status_code, 404)
+
+    @override_settings(MEDIA_ACCEL='x-accel-redirect')
+    def test_accel_redirect_hands_off_to_the_proxy(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/covers/cover.jpg')
+        self.assertEqual(response.content, b'')
+
+
+class AsyncModeTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.request = RequestFactory().get('/about/')
+        self.request.user = AnonymousUser()
+
+    def test_async_view_runs_on_the_db_pool(self):
+        threads = []
+
+        def view(request):
+            threads.append(threading.current_thread().name)
+            return HttpResponse('ok')
+
+        wrapped = async_view(view)
+        self.assertTrue(asyncio.iscoroutinefunction(wrapped))
+        response = asyncio.run(wrapped(self.request))
+        self.assertEqual(response.content, b'ok')
+        self.assertTrue(threads[0].startswith('async-db'))
+
+    def test_async_autocomplete(self):
+        request = RequestFactory().get('/books/autocomplete/', {'q': 'zzz'})
+        response = asyncio.run(async_view(AutocompleteView.as_view())(request))
+        self.assertEqual(response.status_code, 200)
+
+    def test_site_cache_middleware_in_async_mode(self):
+        async def get_response(request):
+            return HttpResponse('page')
+
+        middleware = SiteCacheMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        self.assertEqual(asyncio.run(middleware(self.request))['X-Cache'], 'MISS')
+        self.assertEqual(asyncio.run(middleware(self.request))['X-Cache'], 'HIT')
+
+
+# the body of a streaming response is read on the executor, not on the loop
+# where the export's queries raise SynchronousOnlyOperation
+class StreamingASGITests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+        staff = get_user_model().objects.create_user(
+            username='staff', email='staff@email.com', password='testpass123', is_staff=True)
+        self.client.force_login(staff)
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+
+    def get(self, path, headers=()):
+        headers = [(b'host', b'testserver'),
+                   (b'cookie', ('sessionid=%s' % self.client.cookies['sessionid'].value).encode())]
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'',
+            'headers': headers, 'server': ('testserver', 80), 'client': ('127.0.0.1', 1234),
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(StreamingASGIHandler()(scope, receive, send))
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        return messages[0]['status'], body
+
+    def test_export_body(self):
+        status, body = self.get(reverse('book_export', args=['books', 'csv']))
+        self.assertEqual(status, 200)
+        self.assertEqual(body.decode().splitlines()[0], 'id,title,author,price,cover')
+        self.assertIn('Harry Potter', body.decode())
+
+    def test_media_body(self):
+        content = os.urandom(300 * 1024)
+        with open(os.path.join(self.media_root, 'cover.jpg'), 'wb') as f:
+            f.write(content)
+        with override_settings(MEDIA_ROOT=self.media_root):
+            self.assertEqual(self.get('/media/cover.jpg'), (200, content))
+
+
+class FakeConnection:
+    """ just what the pool looks at of a psycopg2 connection """
+
+    def __init__(self):
+        self.closed = False
+        self.status = TRANSACTION_STATUS_IDLE
+        self.rolled_back = False
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rolled_back = True
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(SimpleTestCase):
+
+    def pool(self, **options):
+        self.opened = []
+
+        def connect():
+            self.opened.append(FakeConnection())
+            return self.opened[-1]
+        return db_pool.ConnectionPool(connect, options)
+
+    def test_connections_are_reused(self):
+        pool = self.pool()
+        for _ in range(3):
+            pool.putconn(pool.getconn())
+        self.assertEqual(len(self.opened), 1)
+        stats = pool.stats()
+        self.assertEqual((stats['checkouts'], stats['size'], stats['idle']), (3, 1, 1))
+
+    def test_max_size_and_timeout(self):
+        pool = self.pool(MAX_SIZE=2, TIMEOUT=0.05)
+        pool.getconn(), pool.getconn()
+        with self.assertRaises(db_pool.PoolTimeout):
+            pool.getconn()
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+    def test_dirty_and_broken_connections(self):
+        pool = self.pool()
+        connection = pool.getconn()
+        connection.status = TRANSACTION_STATUS_INTRANS
+        pool.putconn(connection)
+        self.assertTrue(connection.rolled_back)
+        self.assertIs(pool.getconn(), connection)
+        connection.status = TRANSACTION_STATUS_UNKNOWN
+        pool.putconn(connection)
+        self.assertTrue(connection.closed)
+        self.assertIsNot(pool.getconn(), connection)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_max_lifetime(self):
+        pool = self.pool(MAX_LIFETIME=0)
+        connection = pool.getconn()
+        pool.putconn(connection)
+        self.assertTrue(connection.closed)
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_min_size_is_opened_when_the_pool_is_created(self):
+        key = ('bookstore', 'min-size')
+        self.addCleanup(db_pool._pools.pop, key, None)
+        pool = db_pool.get_pool(key, FakeConnection, {'MIN_SIZE': 3})
+        stats = pool.stats()
+        self.assertEqual((stats['connections_opened'], stats['idle']), (3, 3))
+        self.assertIs(db_pool.get_pool(key, FakeConnection, {'MIN_SIZE': 3}), pool)
+        self.assertEqual(pool.stats()['connections_opened'], 3)
+
+    # a primary and its replica usually have the same database name
+    def test_stats_per_server(self):
+        for host in ('primary', 'replica'):
+            key = ('bookstore', host)
+            self.addCleanup(db_pool._pools.pop, key, None)
+            db_pool.get_pool(key, FakeConnection, {}, '%s:5432/bookstore' % host)
+        stats = db_pool.pool_stats()
+        self.assertIn('primary:5432/bookstore', stats)
+        self.assertIn('replica:5432/bookstore', stats)
+
+    def test_pools_are_per_process(self):
+        key = ('bookstore', 'test')
+        self.addCleanup(db_pool._pools.pop, key, None)
+        pool = db_pool.get_pool(key, FakeConnection, {})
+        inherited = pool.getconn()
+        pool.pid = -1  # as seen from a forked child
+        child_pool = db_pool.get_pool(key, FakeConnection, {})
+        self.assertIsNot(child_pool, pool)
+        # the parent's connection is left alone
+        self.assertFalse(inherited.closed)
+        self.assertIn(inherited, db_pool._inherited)
+        db_pool._inherited.remove(inherited)
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2'])
+class ReplicaRouterTests(SimpleTestCase):
+    # a TestCase would run everything inside a transaction, which reads from the primary
+
+    def setUp(self):
+        self.router = routers.PrimaryReplicaRouter()
+        # the last catalog change is an hour old, the replicas have it
+        cache.set(CATALOG_VERSION_KEY, (time.time_ns() // 1000) - 3600 * 10 ** 6, None)
+        self.addCleanup(cache.delete, CATALOG_VERSION_KEY)
+
+    def read_in_request(self, model, pinned=False):
+        token = routers.start_request(pinned)
+        try:
+            return self.router.db_for_read(model)
+        finally:
+            routers.end_request(token)
+
+    def test_reads_go_to_replicas_and_writes_to_primary(self):
+        with override_settings(DATABASE_REPLICAS=['replica1']):
+            self.assertEqual(self.read_in_request(Book), 'replica1')
+        self.assertEqual(self.router.db_for_write(Book), 'default')
+        # not a routed app
+        self.assertEqual(self.read_in_request(Permission), 'default')
+        # no request (management commands, shell)
+        self.assertEqual(self.router.db_for_read(Book), 'default')
+
+    def test_pinned_clients_and_writers_read_from_primary(self):
+        self.assertEqual(self.read_in_request(Book, pinned=True), 'default')
+        token = routers.start_request(False)
+        self.router.db_for_write(Review)
+        self.assertEqual(self.router.db_for_read(Book), 'default')
+        routers.end_request(token)
+
+    @override_settings(DATABASE_REPLICAS=['replica1'])
+    def test_primary_while_replicas_may_lag_behind_a_catalog_change(self):
+        bump_catalog_version()
+        # a page read from the replica now would be cached under the new version
+        self.assertEqual(self.read_in_request(Book), 'default')
+        with override_settings(DATABASE_PIN_SECONDS=0):
+            self.assertEqual(self.read_in_request(Book), 'replica1')
+
+    def test_middleware_pins_after_a_write(self):
+        def writing_view(request):
+            # what Book.objects.create() asks the router
+            self.router.db_for_write(Book)
+            return HttpResponse('ok')
+
+        def reading_view(request):
+            return HttpResponse(self.router.db_for_read(Book))
+
+        request = RequestFactory().post('/')
+        response = PrimaryPinningMiddleware(writing_view)(request)
+        cookie = response.cookies[settings.DATABASE_PIN_COOKIE]
+        self.assertEqual(cookie['max-age'], settings.DATABASE_PIN_SECONDS)
+
+        request = RequestFactory().get('/')
+        request.COOKIES[settings.DATABASE_PIN_COOKIE] = cookie.value
+        self.assertEqual(PrimaryPinningMiddleware(reading_view)(request).content, b'default')
+        request.COOKIES[settings.DATABASE_PIN_COOKIE] = '0'
+        self.assertIn(PrimaryPinningMiddleware(reading_view)(request).content, (b'replica1', b'replica2'))
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        metrics.registry.reset()
+        self.book = Book.objects.create(title='Harry Potter', author='JK Rowling', price='25.00')
+        self.user = get_user_model().objects.create_user(
+            username='metricsuser', email='metricsuser@email.com', password='testpass123')
+        self.client.login(email='metricsuser@email.com', password='testpass123')
+
+    @override_settings(METRICS_SAMPLE_RATE=0)
+    def test_every_response_has_a_total(self):
+        timing = self.client.get(reverse('home'))['Server-Timing']
+        self.assertRegex(timing, r'^total;dur=[0-9.]+$')
+
+    @override_settings(METRICS_SAMPLE_RATE=1, METRICS_TOKEN='s3cret')
+    def test_sampled_responses_have_details(self):
+        timing = self.client.get(reverse('book_list'), HTTP_AUTHORIZATION='Bearer s3cret')['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[0-9.]+;desc="[1-9][0-9]* queries", tpl;dur=[0-9.]+')
+        self.assertIn('cache;desc="hit=0 miss=', timing)
+        # served from the site cache the second time
+        self.assertIn('cache;desc="hit=1 ', self.client.get(
+            reverse('book_list'), HTTP_AUTHORIZATION='Bearer s3cret')['Server-Timing'])
+        # everybody else only gets the total
+        self.assertRegex(self.client.get(reverse('book_list'))['Server-Timing'], r'^total;dur=[0-9.]+$')
+
+    @override_settings(METRICS_SAMPLE_RATE=1, METRICS_TOKEN='s3cret')
+    def test_prometheus_endpoint(self):
+        self.client.get(reverse('book_list'))
+        self.client.get(reverse('book_list'))
+        body = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer s3cret').content.decode()
+        self.assertIn('django_request_duration_seconds_count{view="book_list",method="GET"} 2', body)
+        self.assertIn('django_sampled_requests_total{view="book_list"} 2', body)
+        self.assertIn('django_cache_lookups_total{cache="site",result="hit"} 1', body)
+
+    # any client can send any method, each would be a new series
+    @override_settings(METRICS_SAMPLE_RATE=0)
+    def test_unknown_methods_share_one_label(self):
+        for method in ('X0', 'X1', 'X2'):
+            self.client.generic(method, reverse('book_list'))
+        self.assertEqual([key for key in metrics.registry.latency if key[0] == 'book_list'],
+                         [('book_list', 'other')])
+
+    def test_other_workers_are_added_up(self):
+        other = metrics.Registry()
+        other.observe('home', 'GET', 0.004)
+        other.count_cache('site', False, 3)
+        other.flush()
+        metrics.registry.observe('home', 'GET', 0.2)
+        metrics.registry.flush()
+        body = metrics.render_prometheus(*metrics.collect())
+        self.assertIn('django_request_duration_seconds_bucket{view="home",method="GET",le="0.005"} 1', body)
+        self.assertIn('django_request_duration_seconds_count{view="home",method="GET"} 2', body)
+        self.assertIn('django_request_duration_seconds_sum{view="home",method="GET"} 0.204000', body)
+        self.assertIn('django_cache_lookups_total{cache="site",result="miss"} 3', body)
+        self.assertIn('django_metrics_workers 2', body)
+
+    def test_counters_survive_departed_workers(self):
+        departed = metrics.Registry()
+        departed.observe('home', 'GET', 0.004)
+        departed.flush()
+        # recycled: its slot expires, its counts stay in the totals
+        cache.delete('metrics:worker-slot:%d' % departed.slot)
+        metrics.registry.observe('home', 'GET', 0.004)
+        metrics.registry.flush()
+        body = metrics.render_prometheus(*metrics.collect())
+        self.assertIn('django_request_duration_seconds_count{view="home",method="GET"} 2', body)
+        self.assertIn('django_metrics_workers 1', body)
+
+    def test_series_lost_to_a_concurrent_update_come_back(self):
+        metrics.registry.observe('home', 'GET', 0.004)
+        metrics.registry.flush()
+        # another worker wrote the series names it knew at the same time
+        cache.set(metrics.SERIES_KEY, set(), None)
+        metrics.registry.observe('about', 'GET', 0.004)
+        metrics.registry.flush()
+        body = metrics.render_prometheus(*metrics.collect())
+        self.assertIn('django_request_duration_seconds_count{view="home",method="GET"} 1', body)
+
+    def test_access(self):
+        self.client.logout()
+        # no token, no metrics, not even from the local reverse proxy
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='127.0.0.1').status_code, 403)
+        with override_settings(METRICS_TOKEN='s3cret'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer s3cret')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Cache-Control'], 'no-store')
+            with override_settings(METRICS_ALLOWED_IPS=['10.0.0.1']):
+                self.assertEqual(self.client.get(
+                    reverse('metrics'), HTTP_AUTHORIZATION='Bearer s3cret').status_code, 403)
+                self.assertEqual(self.client.get(
+                    reverse('metrics'), HTTP_AUTHORIZATION='Bearer s3cret', REMOTE_ADDR='10.0.0.1').status_code, 200)
+
+
+class AssetPipelineTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_minify_and_bundle(self):
+        self.assertEqual(
+            assets.minify_css('/*! keep */\n/* drop */ a :hover , b > i {\n  content: "a , b" ;\n}\n'),
+            '/*! keep */\na :hover,b>i{content:"a , b"}')
+        sources = {
+            'vendor/lib/css/lib.min.css': '.x{background:url(../img/x.png)}\n/*# sourceMappingURL=lib.min.css.map */',
+            'css/base.css': 'h1 {\n  color: red;\n}\n',
+        }
+        self.assertEqual(
+            assets.build_bundle('bundles/site.css', list(sources), sources.get),
+            '.x{background:url(../vendor/lib/img/x.png)}\nh1{color:red}\n')
+        self.assertEqual(assets.minify_js('// comment\nvar a = 1\n\n  a += 1\n'), 'var a = 1\na += 1')
+
+    def test_critical_css(self):
+        css = ('body{margin:0}h1{color:red}.p-2{padding:.5rem}.card .p-2{padding:0}[hidden]{display:none}'
+               '@media (min-width:768px){.mr-md-3{margin-right:1rem}.col-md-6{width:50%}}'
+               '@keyframes spin{to{transform:rotate(1turn)}}')
+        self.assertEqual(
+            assets.extract_critical(css, {'p-2', 'mr-md-3'}),
+            'body{margin:0}.p-2{padding:.5rem}@media (min-width:768px){.mr-md-3{margin-right:1rem}}')
+
+    def test_pages_use_the_bundles(self):
+        response = self.client.get(reverse('home'))
+        css, js = staticfiles_storage.url('bundles/site.css'), staticfiles_storage.url('bundles/site.js')
+        self.assertContains(response, '<style>:root{')
+        self.assertContains(response, '<link rel="preload" href="%s" as="style" />' % css)
+        self.assertContains(response, '<link rel="preload" href="%s" as="script" />' % js)
+        self.assertContains(response, 'href="%s" media="print"' % css)
+        self.assertContains(response, '<script src="%s" defer></script>' % js)
+        for host in ('stackpath.bootstrapcdn.com', 'code.jquery.com', 'cdn.jsdelivr.net'):
+            self.assertNotContains(response, host)
+
+        with override_settings(ASSETS_BUNDLED=False):
+            cache.clear()
+            response = self.client.get(reverse('home'))
+        self.assertNotContains(response, '<style>')
+        for source in settings.ASSET_BUNDLES['bundles/site.js']:
+            self.assertContains(response, '<script src="%s" defer></script>' % staticfiles_storage.url(source))
+
+    def test_bundles_are_precompressed_and_immutable(self):
+        url = staticfiles_storage.url('bundles/site.css')
+        self.assertNotEqual(url, settings.STATIC_URL + 'bundles/site.css')  # hashed
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertIn('immutable', response['Cache-Control'])
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+
+class StartupTests(SimpleTestCase):
+
+    def test_settings_import_does_no_dns_lookup(self):
+        import config.settings
+        with mock.patch('socket.gethostbyname_ex', side_effect=AssertionError('DNS lookup')):
+            importlib.reload(config.settings)
+
+    def test_toolbar_only_in_debug_for_internal_ips(self):
+        request = RequestFactory().get('/', REMOTE_ADDR='10.0.0.5')
+        debug.docker_host_ips.cache_clear()
+        self.addCleanup(debug.docker_host_ips.cache_clear)
+        with mock.patch('config.debug.socket.gethostbyname_ex', side_effect=OSError) as lookup:
+            self.assertFalse(debug.show_toolbar(request))
+            lookup.assert_not_called()
+            with override_settings(DEBUG=True, INTERNAL_IPS=['10.0.0.5']):
+                self.assertTrue(debug.show_toolbar(request))
+            with override_settings(DEBUG=True, INTERNAL_IPS=[]):
+                # a broken DNS lookup leaves the Docker host out, nothing more
+                self.assertFalse(debug.show_toolbar(request))
+
+    def test_warm_up_compiles_the_templates(self):
+        loader = engines['django'].engine.template_loaders[0]
+        loader.reset()
+        startup.warm_up()
+        self.assertIn('_base.html', loader.get_template_cache)
+        self.assertIn('books/book_list.html', loader.get_template_cache)
+
+    def test_startup_profile_budget(self):
+        out = StringIO()
+        call_command('startup_profile', repeat=1, budget=60000, stdout=out)
+        self.assertIn('templates', out.getvalue())
+        self.assertIn('django', out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('startup_profile', repeat=1, budget=1, stdout=StringIO())
+
+
+class ServerTests(SimpleTestCase):
+
+    def test_gunicorn_settings(self):
+        with mock.patch('config.server.cores', return_value=4):
+            sync = server.gunicorn_settings({})
+            gthread = server.gunicorn_settings({'WEB_WORKER_CLASS': 'gthread', 'WEB_THREADS': '8'})
+            uvicorn = server.gunicorn_settings({'WEB_WORKER_CLASS': 'uvicorn', 'WEB_CONCURRENCY': '3'})
+        self.assertEqual((sync['worker_class'], sync['workers']), ('sync', 9))
+        self.assertTrue(sync['preload_app'])
+        self.assertNotIn('threads', sync)
+        self.assertEqual((gthread['workers'], gthread['threads']), (5, 8))
+        self.assertEqual((uvicorn['worker_class'], uvicorn['workers']), ('uvicorn.workers.UvicornWorker', 3))
+        self.assertEqual((sync['max_requests'], sync['max_requests_jitter']), (1000, 100))
+        with self.assertRaises(ValueError):
+            server.gunicorn_settings({'WEB_WORKER_CLASS': 'eventlet'})
+
+    def test_rss_watchdog_restarts_its_worker(self):
+        worker = mock.Mock()
+        self.assertIsNone(server.start_watchdog(worker, {}))
+        with mock.patch('config.server.os.kill') as kill:
+            self.assertFalse(server.RssWatchdog(server.rss_bytes() * 2).check())
+            kill.assert_not_called()
+            self.assertTrue(server.RssWatchdog(2 ** 20, log=worker.log.warning).check())
+            kill.assert_called_once_with(os.getpid(), server.signal.SIGTERM)
+        worker.log.warning.assert_called_once()
+
+    def test_serve_command(self):
+        out = StringIO()
+        call_command('serve', worker_class='uvicorn', workers=2, max_rss=300, dry_run=True, stdout=out)
+        self.assertIn('2 uvicorn.workers.UvicornWorker workers', out.getvalue())
+        self.assertIn('max RSS 300 MB', out.getvalue())
+        self.assertIn('gunicorn.conf.py config.asgi:application', out.getvalue())
+        with mock.patch('os.execvpe') as execvpe, mock.patch('shutil.which', return_value='/bin/gunicorn'):
+            call_command('serve', worker_class='gthread', threads=8, stdout=StringIO())
+        executable, argv, environ = execvpe.call_args[0]
+        self.assertEqual(argv[-1], 'config.wsgi:application')
+        self.assertEqual((environ['WEB_WORKER_CLASS'], environ['WEB_THREADS']), ('gthread', '8'))
@@ -1,7 +1,10 @@
+import re
+
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
+from .media import serve_media
+from .metrics import metrics_view
 
 urlpatterns = [
     # Django admin
@@ -13,7 +16,13 @@ urlpatterns = [
     # Local apps
     path('', include('pages.urls')),
     path('books/', include('books.urls')),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+
+    # Prometheus metrics (config/metrics.py)
+    path('metrics', metrics_view, name='metrics'),
+
+    # User uploaded media (book covers), in DEBUG and in production alike
+    re_path(r'^%s(?P<path>.+)$' % re.escape(settings.MEDIA_URL.lstrip('/')), serve_media, name='media'),
+]
 
 # django debug_toolbar config part4
 if settings.DEBUG:
@@ -5,12 +5,21 @@ It exposes the WSGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/dev/howto/deployment/wsgi/
+
+With settings.WARM_UP the URL resolvers, templates and translations are
+loaded here and not on the first request (config/startup.py); run gunicorn
+with --preload to do that once in the master instead of in every worker.
 """
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_wsgi_application()
+
+if settings.WARM_UP:
+    from .startup import warm_up
+    warm_up()
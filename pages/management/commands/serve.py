@@ -0,0 +1,64 @@
+import os
+import shutil
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from config import server
+
+"""
+Run the production server: gunicorn with config/gunicorn.conf.py
+
+$ python manage.py serve
+$ python manage.py serve --worker-class gthread --threads 8
+$ python manage.py serve --worker-class uvicorn --max-rss 300
+
+The options override the WEB_* environment variables config/server.py
+reads (so the defaults are the environment's, then the cores of the
+machine), and the application matches the worker class: config.wsgi for
+sync and gthread, config.asgi for uvicorn. gunicorn then replaces this
+process, so it gets the signals of the container directly.
+"""
+
+
+class Command(BaseCommand):
+    help = 'Serve the site with gunicorn and config/gunicorn.conf.py.'
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('--worker-class', choices=list(server.WORKER_CLASSES))
+        parser.add_argument('--workers', type=int)
+        parser.add_argument('--threads', type=int, help='threads per gthread worker')
+        parser.add_argument('--port', type=int)
+        parser.add_argument('--max-requests', type=int)
+        parser.add_argument('--max-rss', type=int, help='restart a worker over this many MB of resident memory')
+        parser.add_argument('--dry-run', action='store_true', help='print the command instead of running it')
+
+    def handle(self, *args, **options):
+        environ = dict(os.environ)
+        for option, variable in (
+                ('worker_class', 'WEB_WORKER_CLASS'), ('workers', 'WEB_CONCURRENCY'),
+                ('threads', 'WEB_THREADS'), ('port', 'PORT'),
+                ('max_requests', 'WEB_MAX_REQUESTS'), ('max_rss', 'WEB_MAX_RSS_MB')):
+            if options[option] is not None:
+                environ[variable] = str(options[option])
+        try:
+            gunicorn_settings = server.gunicorn_settings(environ)
+        except ValueError as error:
+            raise CommandError(error)
+        application = server.APPLICATIONS[environ.get('WEB_WORKER_CLASS', 'sync')]
+        config = os.path.join(str(settings.BASE_DIR), 'config', 'gunicorn.conf.py')
+        argv = ['gunicorn', '-c', config, application]
+
+        self.stdout.write('%s: %d %s workers%s, max_requests %d (+%d), max RSS %s' % (
+            application, gunicorn_settings['workers'], gunicorn_settings['worker_class'],
+            ' x %d threads' % gunicorn_settings['threads'] if 'threads' in gunicorn_settings else '',
+            gunicorn_settings['max_requests'], gunicorn_settings['max_requests_jitter'],
+            '%s MB' % environ['WEB_MAX_RSS_MB'] if environ.get('WEB_MAX_RSS_MB', '0') != '0' else 'unlimited'))
+        if options['dry_run']:
+            self.stdout.write(' '.join(argv))
+            return
+        executable = shutil.which('gunicorn')
+        if executable is None:
+            raise CommandError('gunicorn is not installed.')
+        self.stdout.flush()
+        os.execvpe(executable, argv, environ)
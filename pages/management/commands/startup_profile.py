@@ -0,0 +1,100 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+"""
+How long does it take to get a process ready to serve?
+
+$ docker-compose exec web python manage.py startup_profile
+$ docker-compose exec web python manage.py startup_profile --budget 1500 --repeat 5
+
+Starts a fresh python -X importtime that goes through what a worker does
+before its first request, phase by phase:
+
+    settings      import django.conf and config/settings.py
+    apps          django.setup(): every app and its models
+    urls          the URLconf, every view module, the reverse tables
+    templates     compiling the project templates
+    translations  loading the translation catalogs
+
+and prints the time of each phase and the import time per top level
+package (self time, so django's share doesn't include allauth's). The best
+of --repeat runs counts. The command fails when that is over --budget
+milliseconds (default settings.STARTUP_BUDGET_MS), so CI catches an
+import-time DNS lookup or a heavy module pulled into the settings before
+it reaches the workers.
+"""
+
+PHASES = ('settings', 'apps', 'urls', 'templates', 'translations')
+
+SCRIPT = '''
+import json, time
+marks = [time.perf_counter()]
+from django.conf import settings
+settings.INSTALLED_APPS
+marks.append(time.perf_counter())
+import django
+django.setup()
+marks.append(time.perf_counter())
+from config import startup
+startup.warm_up_urls()
+marks.append(time.perf_counter())
+startup.warm_up_templates()
+marks.append(time.perf_counter())
+startup.warm_up_translations()
+marks.append(time.perf_counter())
+print(json.dumps([(b - a) * 1000 for a, b in zip(marks, marks[1:])]))
+'''
+
+IMPORT_TIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+\d+ \| *(\S+)$')
+
+
+def run_once():
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', SCRIPT],
+        cwd=str(settings.BASE_DIR), env=env, capture_output=True, text=True)
+    wall = (time.perf_counter() - start) * 1000
+    if result.returncode:
+        raise CommandError('The startup failed:\n%s' % result.stderr[-2000:])
+    packages = Counter()
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_RE.match(line)
+        if match:
+            packages[match.group(2).split('.')[0]] += int(match.group(1)) / 1000
+    phases = dict(zip(PHASES, json.loads(result.stdout.strip().splitlines()[-1])))
+    return {'total': sum(phases.values()), 'wall': wall, 'phases': phases, 'packages': packages}
+
+
+class Command(BaseCommand):
+    help = 'Profile the startup of a worker and fail when it is over budget.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--budget', type=float, default=None,
+                            help='milliseconds, settings.STARTUP_BUDGET_MS by default')
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--top', type=int, default=15)
+
+    def handle(self, *args, **options):
+        budget = options['budget'] if options['budget'] is not None else settings.STARTUP_BUDGET_MS
+        best = min((run_once() for _ in range(max(options['repeat'], 1))), key=lambda run: run['total'])
+
+        self.stdout.write('startup %.0f ms (budget %.0f ms), process %.0f ms, best of %d' % (
+            best['total'], budget, best['wall'], options['repeat']))
+        for phase in PHASES:
+            self.stdout.write('  %-14s %8.1f ms' % (phase, best['phases'][phase]))
+        self.stdout.write('import time by package (self)')
+        for package, milliseconds in best['packages'].most_common(options['top']):
+            self.stdout.write('  %-14s %8.1f ms' % (package, milliseconds))
+
+        if best['total'] > budget:
+            raise CommandError('Startup took %.0f ms, over the budget of %.0f ms.' % (best['total'], budget))
@@ -0,0 +1,76 @@
+from django import template
+from django.conf import settings
+from django.templatetags.static import static
+from django.utils.html import format_html_join
+from django.utils.safestring import mark_safe
+from config import assets
+
+"""
+{% load assets %}
+<head>
+  {% critical_css %}
+  {% preload_assets %}
+  {% stylesheets %}
+</head>
+<body>
+  ...
+  {% javascripts %}
+</body>
+
+The tags of the asset pipeline (config/assets.py). With ASSETS_BUNDLED:
+- critical_css inlines the critical rules of the CSS bundles, enough to
+  render the page shell (the header) without waiting for any stylesheet,
+- preload_assets starts downloading the bundles right away, before the
+  parser reaches the tags that use them,
+- stylesheets applies the CSS bundle without blocking rendering (media
+  print until it has loaded, a plain <link> for browsers without
+  JavaScript),
+- javascripts adds the JS bundle, deferred.
+Otherwise (DEBUG) stylesheets and javascripts link every source on its own
+and the other two render nothing.
+"""
+
+register = template.Library()
+
+
+def _sources(extension):
+    if settings.ASSETS_BUNDLED:
+        return assets.bundles(extension)
+    return [source for name in assets.bundles(extension) for source in settings.ASSET_BUNDLES[name]]
+
+
+@register.simple_tag
+def critical_css():
+    if not settings.ASSETS_BUNDLED:
+        return ''
+    css = ''.join(assets.critical_css(name) for name in assets.bundles('.css'))
+    # nothing in the CSS may close the <style> element
+    return mark_safe('<style>%s</style>' % css.replace('</', '<\\/'))
+
+
+@register.simple_tag
+def preload_assets():
+    if not settings.ASSETS_BUNDLED:
+        return ''
+    return format_html_join('\n', '<link rel="preload" href="{}" as="{}" />', (
+        (static(name), 'style' if name.endswith('.css') else 'script')
+        for name in assets.bundles('.css') + assets.bundles('.js')))
+
+
+@register.simple_tag
+def stylesheets():
+    if not settings.ASSETS_BUNDLED:
+        return format_html_join('\n', '<link rel="stylesheet" href="{}" />', (
+            (static(name),) for name in _sources('.css')))
+    return format_html_join('\n', (
+        '<link rel="stylesheet" href="{0}" media="print" onload="this.media=\'all\'" />'
+        '<noscript><link rel="stylesheet" href="{0}" /></noscript>'), (
+        (static(name),) for name in _sources('.css')))
+
+
+@register.simple_tag
+def javascripts():
+    # deferred scripts run in order once the document is parsed, like the
+    # scripts at the end of <body> did
+    return format_html_join('\n', '<script src="{}" defer></script>', (
+        (static(name),) for name in _sources('.js')))
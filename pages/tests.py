@@ -1,3 +1,4 @@
+from django.core.cache import cache
 from django.test import SimpleTestCase
 from django.urls import reverse, resolve
 from .views import HomePageView, AboutPageView
@@ -17,6 +18,9 @@ class HomepageTests(SimpleTestCase):
 
     # When a setUp() method is defined, the test runner will run that method prior to each test. setUp() executed before each test !
     def setUp(self):
+        # start every test with an empty site cache, otherwise the page is served
+        # from the cache entry of the previous test and no template is rendered.
+        cache.clear()
         # calling the URL name of home via the reverse method.
         # if we change the actual route of this page in the future, we can still refer to it by the same home URL name.
         url = reverse('home')
@@ -55,6 +59,7 @@ class AboutPageTests(SimpleTestCase):
 
     # When a setUp() method is defined, the test runner will run that method prior to each test. setUp() executed before each test !
     def setUp(self):
+        cache.clear()
         # calling the URL name of about via the reverse method.
         # if we change the actual route of this page in the future, we can still refer to it by the same home URL name.
         url = reverse('about')
@@ -0,0 +1,34 @@
+console.log('JavaScript here!')
+
+// Search box typeahead: fill a <datalist> from the autocomplete endpoint.
+document.querySelectorAll('input[data-autocomplete-url]').forEach(function (input) {
+  var list = document.getElementById(input.getAttribute('list'))
+  var timer = null
+  input.addEventListener('input', function () {
+    clearTimeout(timer)
+    timer = setTimeout(function () {
+      if (!input.value.trim()) { return }
+      fetch(input.dataset.autocompleteUrl + '?q=' + encodeURIComponent(input.value))
+        .then(function (response) { return response.json() })
+        .then(function (data) {
+          list.innerHTML = ''
+          data.results.forEach(function (book) {
+            var option = document.createElement('option')
+            option.value = book.title
+            option.label = book.author
+            list.appendChild(option)
+          })
+        })
+    }, 100)
+  })
+})
+
+// "Load more" buttons fetch an HTML fragment and put it where the button was.
+document.addEventListener('click', function (event) {
+  var button = event.target.closest('[data-load-more]')
+  if (!button) { return }
+  button.disabled = true
+  fetch(button.dataset.loadMore, { credentials: 'same-origin' })
+    .then(function (response) { return response.text() })
+    .then(function (html) { button.outerHTML = html })
+})